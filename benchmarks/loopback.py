@@ -0,0 +1,252 @@
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SERVER_DIR = os.path.join(REPO_ROOT, 'src', 'server')
+CLIENT_DIR = os.path.join(REPO_ROOT, 'src', 'client')
+HOST = '127.0.0.1'
+SUBNETMASK = '255.255.255.0'
+# every case gets its own ports, so sockets of the previous case in TIME_WAIT never collide
+BASE_PORT = 41000
+PORTS_PER_CASE = 5
+SERVER_START_TIMEOUT = 10.0
+BYTES_IN_GB = 1_000_000_000
+BYTES_IN_MB = 1024 * 1024
+
+SIZES = {'1K': 1024, '1M': 1024 * 1024, '64M': 64 * 1024 * 1024, '1G': 1024 * 1024 * 1024}
+STREAMS = [1, 4, 16]
+MIXES = ['tcp', 'udp', 'mixed']
+
+# metrics compared against the baseline, and whether a higher value is better
+COMPARED_METRICS = {'bits_per_second': True, 'cpu_seconds_per_gb': False,
+                    'server_peak_rss_mb': False, 'client_peak_rss_mb': False}
+DEFAULT_TOLERANCE = 0.10
+# UDP loss is compared in absolute percentage points, not relative to the baseline
+DEFAULT_LOSS_TOLERANCE = 1.0
+
+
+class BenchmarkCase:
+    """
+    A single point of the matrix: the payload size of every stream, the amount of
+    streams and how they are split between TCP and UDP
+    """
+    size_name: str
+    size: int
+    streams: int
+    mix: str
+
+    def __init__(self, size_name: str, streams: int, mix: str):
+        self.size_name = size_name
+        self.size = SIZES[size_name]
+        self.streams = streams
+        self.mix = mix
+
+    def name(self) -> str:
+        return f'{self.mix}-{self.size_name}-x{self.streams}'
+
+    def connections(self) -> tuple[int, int]:
+        """
+        Returns the amount of TCP and UDP connections
+        """
+        if self.mix == 'tcp':
+            return self.streams, 0
+        if self.mix == 'udp':
+            return 0, self.streams
+        tcp: int = max(1, self.streams // 2)
+        return tcp, max(1, self.streams - tcp)
+
+
+class ProcessUsage:
+    """
+    CPU time and peak memory of a finished process
+    """
+    cpu_seconds: float
+    peak_rss_mb: float
+    exit_code: int
+
+    def __init__(self, cpu_seconds: float, peak_rss_mb: float, exit_code: int):
+        self.cpu_seconds = cpu_seconds
+        self.peak_rss_mb = peak_rss_mb
+        self.exit_code = exit_code
+
+
+def wait_with_usage(process: subprocess.Popen) -> ProcessUsage:
+    """
+    Waits for a child process, collecting its resource usage with wait4
+    """
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    # ru_maxrss is in kilobytes on Linux, and in bytes on macOS
+    rss_bytes: int = usage.ru_maxrss if sys.platform == 'darwin' else usage.ru_maxrss * 1024
+    return ProcessUsage(usage.ru_utime + usage.ru_stime, rss_bytes / BYTES_IN_MB, process.returncode)
+
+
+def wait_for_port(port: int, timeout: float) -> bool:
+    """
+    Waits until a TCP port accepts connections
+    """
+    deadline: float = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection((HOST, port), timeout=0.5).close()
+            return True
+        except OSError:
+            time.sleep(0.05)
+    return False
+
+
+def run_case(case: BenchmarkCase, port: int, rounds: int, round_timeout: float, server_args: list[str],
+             client_args: list[str]) -> dict:
+    """
+    Runs a case with the server and the client as separate processes, and returns its metrics
+    """
+    udp_port, tcp_port, broadcast_port, client_port = port, port + 1, port + 2, port + 3
+    tcp_connections, udp_connections = case.connections()
+    server: subprocess.Popen = subprocess.Popen(
+        [sys.executable, 'main.py', str(udp_port), str(tcp_port), str(broadcast_port), SUBNETMASK,
+         '--no-animation'] + server_args,
+        cwd=SERVER_DIR, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        if not wait_for_port(tcp_port, SERVER_START_TIMEOUT):
+            raise RuntimeError(f'server did not start on port {tcp_port}')
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            results_path: str = os.path.join(tmp_dir, 'results.jsonl')
+            client: subprocess.Popen = subprocess.Popen(
+                [sys.executable, 'main.py', str(client_port), '--size', str(case.size),
+                 '--tcp', str(tcp_connections), '--udp', str(udp_connections), '--rounds', str(rounds),
+                 '--timeout', str(round_timeout), '--server', f'{HOST}:{udp_port}:{tcp_port}',
+                 '--output', results_path] + client_args,
+                cwd=CLIENT_DIR, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            client_usage: ProcessUsage = wait_with_usage(client)
+            records: list[dict] = []
+            if os.path.exists(results_path):
+                with open(results_path) as results_file:
+                    records = [json.loads(line) for line in results_file]
+    finally:
+        server.stdin.write(b'\n')
+        server.stdin.close()
+        server_usage: ProcessUsage = wait_with_usage(server)
+
+    transfers: list[dict] = [record for record in records if record['record_type'] == 'transfer']
+    summaries: list[dict] = [record for record in records if record['record_type'] == 'summary']
+    udp_losses: list[float] = [record['loss_percent'] for record in transfers if record['protocol'] == 'UDP']
+    total_bytes: int = sum(record['bytes'] for record in transfers)
+    cpu_seconds: float = server_usage.cpu_seconds + client_usage.cpu_seconds
+    return {'case': case.name(), 'size': case.size, 'tcp_connections': tcp_connections,
+            'udp_connections': udp_connections, 'client_exit_code': client_usage.exit_code,
+            'bits_per_second': statistics.median(summary['aggregate_bits_per_second'] for summary in summaries)
+            if summaries else 0.0,
+            'bytes': total_bytes,
+            'server_cpu_seconds': server_usage.cpu_seconds, 'client_cpu_seconds': client_usage.cpu_seconds,
+            'cpu_seconds_per_gb': cpu_seconds / (total_bytes / BYTES_IN_GB) if total_bytes else 0.0,
+            'server_peak_rss_mb': server_usage.peak_rss_mb, 'client_peak_rss_mb': client_usage.peak_rss_mb,
+            'udp_loss_percent': statistics.mean(udp_losses) if udp_losses else None}
+
+
+def compare(result: dict, baseline: dict, tolerance: float, loss_tolerance: float) -> list[str]:
+    """
+    Compares the metrics of a case with its baseline.
+    Returns a description of every metric which got worse by more than the tolerance
+    """
+    regressions: list[str] = []
+    for metric, higher_is_better in COMPARED_METRICS.items():
+        old: float = baseline.get(metric, 0.0)
+        new: float = result[metric]
+        if old <= 0:
+            continue
+        change: float = (new - old) / old
+        if (higher_is_better and change < -tolerance) or (not higher_is_better and change > tolerance):
+            regressions.append(f'{metric} {old:.4g} -> {new:.4g} ({change:+.1%})')
+    old_loss: float | None = baseline.get('udp_loss_percent')
+    new_loss: float | None = result['udp_loss_percent']
+    if old_loss is not None and new_loss is not None and new_loss - old_loss > loss_tolerance:
+        regressions.append(f'udp_loss_percent {old_loss:.2f}% -> {new_loss:.2f}%')
+    return regressions
+
+
+def format_result(result: dict) -> str:
+    loss: str = '-' if result['udp_loss_percent'] is None else f'{result["udp_loss_percent"]:.2f}%'
+    return (f'{result["case"]:<18} {result["bits_per_second"] / 1e9:>9.3f} Gbit/s '
+            f'{result["cpu_seconds_per_gb"]:>8.3f} CPU s/GB '
+            f'{result["server_peak_rss_mb"]:>7.1f} / {result["client_peak_rss_mb"]:>7.1f} MiB RSS '
+            f'{loss:>7} UDP loss')
+
+
+def parse_list(value: str) -> list[str]:
+    return [item.strip() for item in value.split(',') if item.strip()]
+
+
+def parse_args() -> argparse.Namespace:
+    parser: argparse.ArgumentParser = argparse.ArgumentParser(
+        description='Loopback benchmark of the speed test server and client')
+    parser.add_argument('--sizes', type=parse_list, default=list(SIZES),
+                        help=f'payload sizes per stream (default: {",".join(SIZES)})')
+    parser.add_argument('--streams', type=parse_list, default=[str(streams) for streams in STREAMS],
+                        help=f'stream counts (default: {",".join(map(str, STREAMS))})')
+    parser.add_argument('--mixes', type=parse_list, default=MIXES,
+                        help=f'protocol mixes (default: {",".join(MIXES)})')
+    parser.add_argument('--rounds', type=int, default=3, help='rounds per case, the median is kept (default: 3)')
+    parser.add_argument('--round-timeout', type=float, default=300.0, help='seconds per round (default: 300)')
+    parser.add_argument('--base-port', type=int, default=BASE_PORT)
+    parser.add_argument('--server-args', default='', help='extra arguments for the server, e.g. "--mode event"')
+    parser.add_argument('--client-args', default='', help='extra arguments for the client, e.g. "--verify"')
+    parser.add_argument('--output', help='write the results of this run to a JSON file')
+    parser.add_argument('--save-baseline', help='write the results of this run as the new baseline file')
+    parser.add_argument('--baseline', help='compare this run with a baseline file')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help=f'relative change allowed before flagging a regression (default: {DEFAULT_TOLERANCE})')
+    parser.add_argument('--loss-tolerance', type=float, default=DEFAULT_LOSS_TOLERANCE,
+                        help='percentage points of additional UDP loss allowed (default: '
+                             f'{DEFAULT_LOSS_TOLERANCE})')
+    args: argparse.Namespace = parser.parse_args()
+    unknown: list[str] = [size for size in args.sizes if size not in SIZES] + \
+        [mix for mix in args.mixes if mix not in MIXES] + [streams for streams in args.streams if not streams.isdigit()]
+    if unknown:
+        parser.error(f'unknown matrix values: {", ".join(unknown)}')
+    return args
+
+
+def main() -> None:
+    args: argparse.Namespace = parse_args()
+    cases: list[BenchmarkCase] = [BenchmarkCase(size, int(streams), mix)
+                                  for size in args.sizes for streams in args.streams for mix in args.mixes]
+    baseline: dict = {}
+    if args.baseline is not None:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+
+    results: dict[str, dict] = {}
+    regressions: dict[str, list[str]] = {}
+    for case_idx, case in enumerate(cases):
+        result: dict = run_case(case, args.base_port + case_idx * PORTS_PER_CASE, args.rounds,
+                                args.round_timeout, args.server_args.split(), args.client_args.split())
+        results[case.name()] = result
+        print(format_result(result), flush=True)
+        if result['client_exit_code'] != 0:
+            regressions[case.name()] = [f'client exited with status {result["client_exit_code"]}']
+        elif case.name() in baseline:
+            case_regressions: list[str] = compare(result, baseline[case.name()], args.tolerance,
+                                                  args.loss_tolerance)
+            if case_regressions:
+                regressions[case.name()] = case_regressions
+
+    for path in (args.output, args.save_baseline):
+        if path is not None:
+            with open(path, 'w') as output_file:
+                json.dump(results, output_file, indent=2)
+
+    for name, case_regressions in regressions.items():
+        print(f'REGRESSION {name}: {"; ".join(case_regressions)}')
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+import argparse
+import os
+import struct
+import sys
+import timeit
+from typing import Callable
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(REPO_ROOT, 'src', 'common'))
+
+import protocol
+
+DEFAULT_NUMBER = 200_000
+DEFAULT_REPEAT = 5
+
+
+def legacy_pack_offer(udp_port: int, tcp_port: int) -> bytes:
+    """
+    The offer encoding the server used before the shared protocol module
+    """
+    message: bytes = struct.pack('I', protocol.COOKIE)
+    message += struct.pack('B', protocol.MSG_OFFER)
+    message += struct.pack('H', udp_port)
+    message += struct.pack('H', tcp_port)
+    return message
+
+
+def legacy_unpack_offer(data: bytes) -> tuple[int, int] | None:
+    """
+    The offer decoding the client used before the shared protocol module
+    """
+    if len(data) != 9:
+        return None
+    cookie: int = struct.unpack('I', data[0:4])[0]
+    message_type: int = struct.unpack('B', data[4:5])[0]
+    if cookie != protocol.COOKIE or message_type != protocol.MSG_OFFER:
+        return None
+    return struct.unpack('H', data[5:7])[0], struct.unpack('H', data[7:9])[0]
+
+
+def legacy_unpack_request(data: bytes) -> int:
+    """
+    The request decoding the server used before the shared protocol module
+    """
+    if len(data) < 13:
+        return -1
+    if struct.unpack('I', data[0:4])[0] != protocol.COOKIE:
+        return -1
+    if struct.unpack('B', data[4:5])[0] != protocol.MSG_REQUEST:
+        return -1
+    return struct.unpack('Q', data[5:13])[0]
+
+
+def legacy_unpack_payload_header(header: struct.Struct, buffer, offset: int) -> tuple[int, int] | None:
+    """
+    The payload header decoding the client used before the shared protocol module
+    """
+    cookie, message_type, segments_amount, segment = header.unpack_from(buffer, offset)
+    if cookie != protocol.COOKIE or message_type != protocol.MSG_PAYLOAD:
+        return None
+    return segments_amount, segment
+
+
+def build_cases() -> dict[str, tuple[Callable, Callable | None]]:
+    """
+    Returns every measured operation, with the operation it replaced (if any)
+    """
+    offer: bytes = protocol.pack_offer(2020, 2021)
+    legacy_offer: bytes = legacy_pack_offer(2020, 2021)
+    request: bytes = protocol.pack_request(1024 * 1024)
+    legacy_request: bytes = struct.pack('=IBQ', protocol.COOKIE, protocol.MSG_REQUEST, 1024 * 1024)
+    # a receive buffer holding a batch of datagrams, as the UDP receiver has
+    batch: memoryview = memoryview(bytearray(protocol.MAX_MESSAGE_LEN * 64))
+    for slot in range(64):
+        protocol.pack_payload_header_into(batch, slot * protocol.MAX_MESSAGE_LEN, 1000, slot)
+    legacy_header: struct.Struct = struct.Struct('=IBQQ')
+    nack_ranges: list[tuple[int, int]] = [(segment * 10, 3) for segment in range(16)]
+    nack: bytes = protocol.pack_nack(100, nack_ranges)
+    report: bytes = protocol.pack_report(1000, 1024 * 1024, 10 ** 9)
+
+    return {
+        'offer encode': (lambda: protocol.pack_offer(2020, 2021), lambda: legacy_pack_offer(2020, 2021)),
+        'offer decode': (lambda: protocol.unpack_offer(offer), lambda: legacy_unpack_offer(legacy_offer)),
+        'request encode': (lambda: protocol.pack_request(1024 * 1024),
+                           lambda: struct.pack('I', protocol.COOKIE) + struct.pack('B', protocol.MSG_REQUEST) +
+                           struct.pack('Q', 1024 * 1024)),
+        'request decode': (lambda: protocol.unpack_request(request), lambda: legacy_unpack_request(legacy_request)),
+        'payload header encode': (lambda: protocol.pack_payload_header_into(batch, 0, 1000, 7), None),
+        'segment number patch': (lambda: protocol.pack_segment_number_into(batch, 0, 7), None),
+        'payload header decode': (lambda: protocol.unpack_payload_header(batch, protocol.MAX_MESSAGE_LEN * 7),
+                                  lambda: legacy_unpack_payload_header(legacy_header, batch,
+                                                                       protocol.MAX_MESSAGE_LEN * 7)),
+        'nack encode (16 ranges)': (lambda: protocol.pack_nack(100, nack_ranges), None),
+        'nack decode (16 ranges)': (lambda: protocol.unpack_nack(nack), None),
+        'upload report encode': (lambda: protocol.pack_report(1000, 1024 * 1024, 10 ** 9), None),
+        'upload report decode': (lambda: protocol.unpack_report(report), None),
+    }
+
+
+def measure(operation: Callable, number: int, repeat: int) -> float:
+    """
+    Returns the best time of a single operation in nanoseconds
+    """
+    return min(timeit.repeat(operation, number=number, repeat=repeat)) / number * 1e9
+
+
+def main() -> None:
+    parser: argparse.ArgumentParser = argparse.ArgumentParser(
+        description='Micro-benchmarks of encoding and decoding the protocol messages')
+    parser.add_argument('--number', type=int, default=DEFAULT_NUMBER, help='operations per measurement')
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT, help='measurements, the best is kept')
+    args: argparse.Namespace = parser.parse_args()
+
+    print(f'{"operation":<24} {"ns/op":>9} {"before":>9}')
+    for name, (operation, legacy) in build_cases().items():
+        current: float = measure(operation, args.number, args.repeat)
+        before: str = '-' if legacy is None else f'{measure(legacy, args.number, args.repeat):9.1f}'
+        print(f'{name:<24} {current:9.1f} {before:>9}', flush=True)
+
+
+if __name__ == '__main__':
+    main()
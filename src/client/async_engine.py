@@ -0,0 +1,331 @@
+import asyncio
+import socket
+import time
+
+import logger
+from interval_sampler import IntervalSampler
+from protocol import MAX_PAYLOAD_SIZE, PAYLOAD_HEADER, REJECT, REQUEST_RELIABLE, ProtocolError, pack_nack, \
+    pack_request, pack_tcp_request, unpack_payload_header
+from client import Client, TransferRejected, BYTE_SIZE, FINAL_ACK_REPEATS, NACK_INTERVAL, RELIABLE_INACTIVITY_TIMEOUT, \
+    UDP_INACTIVITY_TIMEOUT
+from results import ResultsWriter, TransferRecord
+from udp_receiver import UDP_RCVBUF_SIZE, read_socket_drops, set_rcvbuf
+from udp_tracker import SegmentTracker
+
+
+class TcpTransferProtocol(asyncio.BufferedProtocol):
+    """
+    Receives a single TCP transfer straight into a caller-provided buffer.
+    A rejected request is answered with a reject message in place of the payload, so the
+    first REJECT.size bytes of the reply are kept aside until they are known to be no reject
+    message - a payload shorter than that is only complete once the connection is closed
+    """
+    __recv_buffer: memoryview
+    __done: asyncio.Future
+    __transport: asyncio.Transport | None
+    __reply_start: bytearray
+    data_left: int
+    start_time: float
+    end_time: float
+    sampler: IntervalSampler | None
+
+    def __init__(self, data_size: int, recv_buffer: memoryview, done: asyncio.Future,
+                 sampler: IntervalSampler | None = None):
+        self.__recv_buffer = recv_buffer
+        self.__done = done
+        self.__transport = None
+        self.__reply_start = bytearray()
+        self.sampler = sampler
+        self.data_left = data_size
+        self.start_time = 0.0
+        self.end_time = 0.0
+
+    def connection_made(self, transport: asyncio.Transport) -> None:
+        self.__transport = transport
+
+    def get_buffer(self, sizehint: int) -> memoryview:
+        # the payload may be shorter than a reject message in its place
+        return self.__recv_buffer[:min(len(self.__recv_buffer),
+                                       max(self.data_left, REJECT.size - len(self.__reply_start)))]
+
+    def buffer_updated(self, nbytes: int) -> None:
+        if len(self.__reply_start) < REJECT.size:
+            self.__reply_start += self.__recv_buffer[:min(nbytes, REJECT.size - len(self.__reply_start))]
+            if len(self.__reply_start) == REJECT.size:
+                try:
+                    Client.check_rejection(self.__reply_start)
+                except TransferRejected as e:
+                    self.__finish(e)
+                    return
+        payload_len: int = min(nbytes, self.data_left)
+        if nbytes > payload_len:
+            self.__finish(ProtocolError('the server sent more than the requested payload'))
+            return
+        self.data_left -= payload_len
+        if self.sampler is not None:
+            self.sampler.add(payload_len)
+        if self.data_left == 0 and payload_len > 0:
+            self.end_time = time.time()
+        if self.data_left == 0 and len(self.__reply_start) == REJECT.size:
+            self.__finish(True)
+
+    def eof_received(self) -> bool:
+        self.__finish(self.data_left == 0)
+        return False
+
+    def connection_lost(self, exc: Exception | None) -> None:
+        if self.__done.done():
+            return
+        if exc is None:
+            self.__done.set_result(self.data_left == 0)
+        else:
+            self.__done.set_exception(exc)
+
+    def __finish(self, outcome: bool | Exception) -> None:
+        """
+        Completes the transfer with whether it succeeded, or with the error it failed with
+        """
+        if self.__done.done():
+            return
+        if isinstance(outcome, Exception):
+            self.__done.set_exception(outcome)
+        else:
+            self.__done.set_result(outcome)
+        self.__transport.close()
+
+
+class UdpTransferProtocol(asyncio.DatagramProtocol):
+    """
+    Receives the segments of a single UDP transfer into a segment tracker, created once
+    the first segment tells how many segments the server sends
+    """
+    __done: asyncio.Future
+    tracker: SegmentTracker | None
+    bytes_received: int
+    unique_bytes: int
+    last_receive_time: float
+    sampler: IntervalSampler | None
+    rejection: TransferRejected | None
+
+    def __init__(self, tracker: SegmentTracker | None, done: asyncio.Future, sampler: IntervalSampler | None = None):
+        self.__done = done
+        self.tracker = tracker
+        self.sampler = sampler
+        self.bytes_received = 0
+        self.unique_bytes = 0
+        self.last_receive_time = time.time()
+        self.rejection = None
+
+    def datagram_received(self, data: bytes, addr: tuple[str, int]) -> None:
+        self.last_receive_time = time.time()
+        if len(data) < PAYLOAD_HEADER.size:
+            try:
+                Client.check_rejection(data)
+            except TransferRejected as e:
+                self.rejection = e
+                if not self.__done.done():
+                    self.__done.set_result(None)
+                return
+            logger.error("Received a truncated message from the server.")
+            return
+        try:
+            segments_amount, curr_segment_id, retransmission = unpack_payload_header(data)
+        except ProtocolError as e:
+            logger.error(f'Error: received an invalid payload: {e}')
+            return
+
+        if self.tracker is None:
+            self.tracker = SegmentTracker(segments_amount)
+        if self.tracker.record(curr_segment_id, retransmission):
+            self.unique_bytes += len(data) - PAYLOAD_HEADER.size
+        self.bytes_received += len(data) - PAYLOAD_HEADER.size
+        if self.sampler is not None:
+            self.sampler.add(len(data) - PAYLOAD_HEADER.size)
+        if self.tracker.complete() and not self.__done.done():
+            self.__done.set_result(None)
+
+    def error_received(self, exc: Exception) -> None:
+        logger.error(f'Failed to receive message from server: {exc}')
+
+
+class AsyncEngine:
+    """
+    Runs all the transfers of an offer in a single asyncio event loop, instead of an
+    OS thread per connection, so thousands of parallel connections cost neither thread
+    creation time nor thread stacks.
+    Every transfer keeps its own timing, and prints the same metrics as the threaded client.
+    """
+    __data_size: int
+    __recv_buffer_size: int
+    __socket_rcvbuf: int
+    __results: ResultsWriter | None
+    __interval: float
+    __max_payload_size: int
+    __reliable: bool
+
+    def __init__(self, data_size: int, recv_buffer_size: int, socket_rcvbuf: int = 0,
+                 results: ResultsWriter | None = None, interval: float = 0.0,
+                 max_payload_size: int = MAX_PAYLOAD_SIZE, reliable: bool = False):
+        self.__data_size = data_size
+        self.__recv_buffer_size = recv_buffer_size
+        self.__socket_rcvbuf = socket_rcvbuf
+        self.__results = results
+        self.__interval = interval
+        self.__max_payload_size = max_payload_size
+        self.__reliable = reliable
+
+    def run(self, server_addr: str, server_udp_port: int, server_tcp_port: int,
+            tcp_connections_num: int, udp_connections_num: int) -> bool:
+        """
+        Runs all the requested transfers, returning once every one of them is over.
+        Returns whether every transfer succeeded
+        """
+        return asyncio.run(self.__run_transfers(server_addr, server_udp_port, server_tcp_port,
+                                         tcp_connections_num, udp_connections_num))
+
+    async def __run_transfers(self, server_addr: str, server_udp_port: int, server_tcp_port: int,
+                              tcp_connections_num: int, udp_connections_num: int) -> bool:
+        # the payload is never read, and callbacks run one at a time, so all TCP transfers
+        # can receive into the same buffer
+        recv_buffer: memoryview = memoryview(bytearray(self.__recv_buffer_size))
+        transfers: list = [self.tcp_connect(server_addr, server_tcp_port, i + 1, recv_buffer)
+                           for i in range(tcp_connections_num)]
+        transfers += [self.udp_connect(server_addr, server_udp_port, i + 1)
+                      for i in range(udp_connections_num)]
+        return all(await asyncio.gather(*transfers))
+
+    async def tcp_connect(self, server_addr: str, server_tcp_port: int, connection_num: int,
+                          recv_buffer: memoryview) -> bool:
+        loop: asyncio.AbstractEventLoop = asyncio.get_running_loop()
+        request_msg: bytes = pack_tcp_request(self.__data_size)
+        done: asyncio.Future = loop.create_future()
+        sock: socket.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        transport: asyncio.Transport | None = None
+
+        try:
+            if self.__socket_rcvbuf > 0:
+                # must be set before connecting to affect the TCP window scale
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.__socket_rcvbuf)
+            sock.setblocking(False)
+            await loop.sock_connect(sock, (server_addr, server_tcp_port))
+            sampler: IntervalSampler | None = IntervalSampler(self.__interval) if self.__interval > 0 else None
+            protocol: TcpTransferProtocol = TcpTransferProtocol(self.__data_size, recv_buffer, done, sampler)
+            transport, _ = await loop.create_connection(lambda: protocol, sock=sock)
+            logger.info(f"Connected to server {server_addr}:{server_tcp_port} via TCP.")
+
+            protocol.start_time = time.time()
+            if sampler is not None:
+                sampler.start()
+            transport.write(request_msg)
+            logger.debugging(f"Sent request message of {self.__data_size} bytes to the connected server.")
+            if self.__data_size == 0:
+                protocol.end_time = protocol.start_time
+            if not await done:
+                logger.error("Server closed the connection.")
+                return False
+
+            transfer_time: float = protocol.end_time - protocol.start_time
+            transfer_rate: float = float('inf') if transfer_time == 0 else \
+                BYTE_SIZE * self.__data_size / transfer_time
+            Client.print_tcp_connection_metrics(connection_num, transfer_time, transfer_rate)
+            intervals: list[tuple[float, float, int]] | None = None
+            if sampler is not None:
+                intervals = sampler.samples()
+                Client.print_intervals('TCP', connection_num, intervals)
+            if self.__results is not None:
+                self.__results.add(TransferRecord('TCP', connection_num, server_addr, self.__data_size,
+                                                  transfer_time, transfer_rate, 0.0, protocol.start_time,
+                                                  protocol.end_time, intervals))
+            return True
+
+        except TransferRejected as e:
+            logger.error(f'TCP transfer #{connection_num} was rejected by the server: {e}')
+            return False
+        except (OSError, ProtocolError) as e:
+            logger.error(f"TCP connection error: {e}")
+            return False
+
+        finally:
+            if transport is not None:
+                transport.close()
+            else:
+                sock.close()
+            logger.debugging("Connection closed.")
+
+    async def udp_connect(self, server_addr: str, server_udp_port: int, connection_num: int) -> bool:
+        loop: asyncio.AbstractEventLoop = asyncio.get_running_loop()
+        request_msg: bytes = pack_request(self.__data_size, self.__max_payload_size,
+                                          REQUEST_RELIABLE if self.__reliable else 0)
+        server: tuple[str, int] = (server_addr, server_udp_port)
+        inactivity_timeout: float = RELIABLE_INACTIVITY_TIMEOUT if self.__reliable else UDP_INACTIVITY_TIMEOUT
+        tracker: SegmentTracker | None = SegmentTracker(0) if self.__data_size == 0 else None
+        done: asyncio.Future = loop.create_future()
+        sampler: IntervalSampler | None = IntervalSampler(self.__interval) if self.__interval > 0 else None
+        transport: asyncio.DatagramTransport | None = None
+
+        try:
+            # the payload arrives from a different server socket, so the endpoint is not connected
+            transport, protocol = await loop.create_datagram_endpoint(
+                lambda: UdpTransferProtocol(tracker, done, sampler), local_addr=('0.0.0.0', 0))
+            sock: socket.socket = transport.get_extra_info('socket')
+            set_rcvbuf(sock, UDP_RCVBUF_SIZE)
+
+            transport.sendto(request_msg, server)
+            logger.debugging(f'Sent request message of {self.__data_size} bytes to server '
+                             f'{server_addr}:{server_udp_port} via UDP.')
+            start_time: float = time.time()
+            protocol.last_receive_time = start_time
+            if sampler is not None:
+                sampler.start()
+
+            # wait until every segment arrived, or the server stopped sending.
+            # A reliable transfer wakes up every NACK_INTERVAL to report the missing segments
+            while (protocol.tracker is None or not protocol.tracker.complete()) and protocol.rejection is None:
+                now: float = time.time()
+                remaining: float = protocol.last_receive_time + inactivity_timeout - now
+                if remaining <= 0:
+                    break
+                if self.__reliable:
+                    if protocol.tracker is not None:
+                        # once the segments stopped arriving, the missing tail is reported too
+                        idle: bool = now - protocol.last_receive_time >= NACK_INTERVAL
+                        transport.sendto(Client.build_nack(protocol.tracker, idle), server)
+                    remaining = min(remaining, NACK_INTERVAL)
+                await asyncio.wait([done], timeout=remaining)
+
+            if protocol.rejection is not None:
+                logger.error(f'UDP transfer #{connection_num} was rejected by the server: {protocol.rejection}')
+                return False
+            tracker = protocol.tracker
+            if tracker is None:
+                logger.error(f'UDP connection to server {server_addr}:{server_udp_port} timed out.')
+                return False
+            if self.__reliable and tracker.complete():
+                final_ack: bytes = pack_nack(tracker.segments_amount, [])
+                for _ in range(FINAL_ACK_REPEATS):
+                    transport.sendto(final_ack, server)
+            # the transfer ended with its last received segment, not with the inactivity timeout
+            transfer_time: float = protocol.last_receive_time - start_time
+            transfer_rate: float = float('inf') if transfer_time == 0 else \
+                BYTE_SIZE * protocol.bytes_received / transfer_time
+            goodput: float | None = None
+            if self.__reliable:
+                goodput = float('inf') if transfer_time == 0 else BYTE_SIZE * protocol.unique_bytes / transfer_time
+            Client.print_udp_connection_metrics(connection_num, transfer_time, transfer_rate, tracker,
+                                                read_socket_drops(sock), goodput)
+            intervals: list[tuple[float, float, int]] | None = None
+            if sampler is not None:
+                intervals = sampler.samples()
+                Client.print_intervals('UDP', connection_num, intervals)
+            if self.__results is not None:
+                self.__results.add(TransferRecord('UDP', connection_num, server_addr, protocol.bytes_received,
+                                                  transfer_time, transfer_rate, 100 - tracker.success_percent(),
+                                                  start_time, protocol.last_receive_time, intervals, goodput,
+                                                  tracker.retransmission_percent() if self.__reliable else None))
+            return True
+        except Exception as e:
+            logger.error(f'Failed to receive message from server: {e}')
+            return False
+        finally:
+            if transport is not None:
+                transport.close()
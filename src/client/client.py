@@ -1,45 +1,46 @@
 from math import log
 import socket
-import struct
 import threading
 import time
 
 import teacup_gen
 import logger
+import protocol
+from discovery import ServerInfo, ServerRegistry, ServerScheduler, DEFAULT_SERVER_TTL, ORDER_ARRIVAL
+from interval_sampler import IntervalSampler
+from latency import LatencyHistogram, LatencyProber, DEFAULT_PROBE_DURATION, NANOSECONDS, NANOSECONDS_PER_MILLISECOND
+from pattern import PayloadVerifier, new_seed
+from payload import PayloadEngine, PayloadSink, RECV_BUFFER_SIZE
+from results import LatencyRecord, ResultsWriter, TransferRecord
+from striping import Stripe, StripedFile
+from udp_receiver import UdpReceiver
+from udp_tracker import SegmentTracker
+from uploader import UdpUploader
 
 BYTE_SIZE = 8
 
-# message structure constants:
-COOKIE = 0xabcddcba
-COOKIE_IDX = 0
-COOKIE_LEN = 4
-
-TYPE_OFFER = 0x2
-TYPE_REQUEST = 0x3
-TYPE_PAYLOAD = 0x4
-TYPE_IDX = 4
-TYPE_LEN = 1
-# OFFER message
-OFFER_UDP_IDX = 5
-OFFER_UDP_LEN = 2
-OFFER_TCP_IDX = 7
-OFFER_TCP_LEN = 2
-OFFER_MSG_LEN = 9
-# REQUEST message
-REQUEST_FILE_SIZE_IDX = 5
-REQUEST_FILE_LEN = 8
-REQUEST_MSG_LEN = 13
-# PAYLOAD message
-PAYLOAD_SEGMENT_COUNT_IDX = 5
-PAYLOAD_SEGMENT_COUNT_LEN = 8
-PAYLOAD_CURRENT_SEGMENT_IDX = 13
-PAYLOAD_CURRENT_SEGMENT_LEN = 8
-CURR_SEGMENT_IDX = 13
-CURR_SEGMENT_LEN = 8
-PAYLOAD_DATA_IDX = 21
-# actual payload length is unknown, will be calculated in runtime.
-MAX_PAYLOAD_MSG_SIZE = 1024
-MAX_PAYLOAD_SIZE = 1000
+# purposefully receive 1 byte more than an offer, to detect longer messages
+OFFER_RECV_LEN = protocol.OFFER.size + 1
+# a UDP transfer ends once no segment arrived for this many seconds
+UDP_INACTIVITY_TIMEOUT = 1.0
+# a reliable UDP transfer keeps asking for the missing segments for longer
+RELIABLE_INACTIVITY_TIMEOUT = 3.0
+# seconds between the NACKs of a reliable UDP transfer
+NACK_INTERVAL = 0.01
+# the final acknowledgement of a reliable transfer is sent a few times, in case it is lost
+FINAL_ACK_REPEATS = 3
+# while an upload is running, the receive loop wakes up this often to check on it
+UPLOAD_POLL_INTERVAL = 0.1
+# how the transfers of an offer are run: a thread per connection, or one asyncio event loop
+ENGINE_THREADS = 'threads'
+ENGINE_ASYNCIO = 'asyncio'
+
+
+class TransferRejected(Exception):
+    """
+    Raised when the server rejects a request instead of serving it
+    """
+
 
 class Client:
     """
@@ -50,20 +51,86 @@ class Client:
     __offer_sock: socket.socket
     __port: int
     __shutdown: bool
-    __data_size: bytes
+    __data_size: int
+    __max_payload_size: int
+    __reliable: bool
+    __direction: str
+    __verify: bool
+    __stripe: bool
+    __stripe_output: str | None
+    __udp_flags: int
+    __probe_rate: float
+    __probe_duration: float
     __tcp_connections_num: int
     __udp_connections_num: int
+    __recv_buffer_size: int
+    __socket_rcvbuf: int
+    __discard: bool
+    __payload_engine: PayloadEngine | None
+    __engine: str
+    __results: ResultsWriter | None
+    __interval: float
+    __warming_up: bool
+    __max_concurrent_servers: int
+    __server_order: str
+    __server_ttl: float
     
-    def __init__(self, port: int, data_size: int, tcp_connections_num: int, udp_connections_num: int):
+    def __init__(self, port: int, data_size: int, tcp_connections_num: int, udp_connections_num: int,
+                 recv_buffer_size: int = RECV_BUFFER_SIZE, socket_rcvbuf: int = 0, discard: bool = False,
+                 engine: str = ENGINE_THREADS, results: ResultsWriter | None = None, interval: float = 0.0,
+                 max_concurrent_servers: int = 1, server_order: str = ORDER_ARRIVAL,
+                 server_ttl: float = DEFAULT_SERVER_TTL, max_payload_size: int = protocol.MAX_PAYLOAD_SIZE,
+                 reliable: bool = False, direction: str = protocol.DIRECTION_DOWNLOAD, verify: bool = False,
+                 stripe: bool = False, stripe_output: str | None = None, probe_rate: float = 0.0,
+                 probe_duration: float = DEFAULT_PROBE_DURATION):
         self.__port = port
         self.__shutdown = False
-        self.__data_size = struct.pack("Q", data_size)
+        self.__data_size = data_size
+        # the largest UDP payload to accept; the server sends less if the path MTU is smaller
+        self.__max_payload_size = max_payload_size
+        # UDP transfers report their missing segments, which the server sends again
+        self.__reliable = reliable
+        # download from the server, upload to it, or both at once
+        self.__direction = direction
+        # downloads carry the pattern of a seed picked per transfer, and are checked against it
+        self.__verify = verify
+        # the TCP connections download a single file together, each a byte range of it, into
+        # memory or into the output file
+        self.__stripe = stripe
+        self.__stripe_output = stripe_output
+        self.__udp_flags = protocol.DIRECTION_FLAGS[direction] | (protocol.REQUEST_RELIABLE if reliable else 0) | \
+            (protocol.REQUEST_VERIFY if verify else 0)
+        # probes per second measuring the round trip to the server's UDP port, while the
+        # transfers run - or for probe_duration seconds without transfers. 0 disables probing
+        self.__probe_rate = probe_rate
+        self.__probe_duration = probe_duration
         self.__tcp_connections_num = tcp_connections_num
         self.__udp_connections_num = udp_connections_num
+        self.__recv_buffer_size = recv_buffer_size
+        # SO_RCVBUF for TCP connections, 0 keeps the system default
+        self.__socket_rcvbuf = socket_rcvbuf
+        # never look at the payload, so the measured rate is not limited by the receive loop
+        self.__discard = discard
+        # the payload of TCP uploads, shared by all of them
+        self.__payload_engine = PayloadEngine() if direction != protocol.DIRECTION_DOWNLOAD else None
+        self.__engine = engine
+        # every finished transfer is also exported here, when set
+        self.__results = results
+        # length in seconds of the throughput samples taken during every transfer, 0 disables sampling
+        self.__interval = interval
+        # warm-up rounds are run and printed, but not exported
+        self.__warming_up = False
+        # how many servers are tested at once, and which waiting server is tested first
+        self.__max_concurrent_servers = max_concurrent_servers
+        self.__server_order = server_order
+        # servers are forgotten once they did not send an offer for this many seconds
+        self.__server_ttl = server_ttl
     
     def run(self) -> None:
         """
         Runs the client until stopped, constantly looking for servers to run a speedtest on.
+        Every offering server is kept in a registry, and tested again after each of its tests
+        finishes, with up to max_concurrent_servers servers tested in parallel.
         """
         self.__offer_sock: socket.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         # Enable broadcasting on the socket
@@ -74,36 +141,52 @@ class Client:
 
         logger.info("Client started, listening for offer requests...")
         teacup_gen.init()
+        registry: ServerRegistry = ServerRegistry(self.__server_ttl)
+        scheduler: ServerScheduler = ServerScheduler(self.__test_server, self.__max_concurrent_servers,
+                                                     self.__server_order, registry)
+        scheduler.start()
         
         try:
             while not self.__shutdown:
                 data: bytes
                 addr: tuple[str, int]
-                threading.Thread(target=teacup_gen.start).start()
-                # purposefully set 1 byte more than the message length to check for errors
-                data, addr = self.__offer_sock.recvfrom(OFFER_MSG_LEN)
-                teacup_gen.stop()
-
-                # check for correct offer message structure and values.
-                if len(data) == OFFER_MSG_LEN:
-                    cookie: int = struct.unpack("I", data[COOKIE_IDX:COOKIE_IDX+COOKIE_LEN])[0]
-                    type: int = struct.unpack("B", data[TYPE_IDX:TYPE_IDX+TYPE_LEN])[0]
-                    if cookie == COOKIE and type == TYPE_OFFER:
-                        udp_port: int = struct.unpack("H", data[OFFER_UDP_IDX:OFFER_UDP_IDX+OFFER_UDP_LEN])[0]
-                        tcp_port: int = struct.unpack("H", data[OFFER_TCP_IDX:OFFER_TCP_IDX+OFFER_TCP_LEN])[0]
-                        request_thread = threading.Thread(target=self.request_file, args=(addr[0],
-                                        udp_port, tcp_port, ))
-                        request_thread.start()
-                        request_thread.join()
-                        logger.info('All transfers complete, listening to offer requests')
-                    else:
-                        logger.error("Received invalid cookie or message type")
-                else:
-                    logger.error("Received message of unexpected length")
+                waiting: bool = scheduler.idle()
+                if waiting:
+                    threading.Thread(target=teacup_gen.start).start()
+                data, addr = self.__offer_sock.recvfrom(OFFER_RECV_LEN)
+                if waiting:
+                    teacup_gen.stop()
+
+                offer: tuple[int, int] | None = Client.parse_offer(data)
+                if offer is not None:
+                    server, is_new = registry.offer(addr[0], *offer)
+                    if is_new:
+                        logger.info(f'Discovered server {server}')
+                    scheduler.submit(server)
         except:
-            logger.error('Failed to receive offer')
+            if not self.__shutdown:
+                logger.error('Failed to receive offer')
 
         self.__offer_sock.close()
+        scheduler.stop()
+        self.close_results()
+
+    def __test_server(self, server: ServerInfo) -> bool:
+        """
+        Runs a single round of transfers against a server
+        """
+        succeeded: bool = self.request_file(server.address, server.udp_port, server.tcp_port)
+        if self.__results is not None:
+            self.__results.end_round(server.address)
+        logger.info(f'All transfers to server {server} complete, listening to offer requests')
+        return succeeded
+
+    def close_results(self) -> None:
+        """
+        Writes the remaining exported results, if any, and closes the results file
+        """
+        if self.__results is not None:
+            self.__results.close()
 
     def shutdown(self) -> None:
         """
@@ -114,67 +197,451 @@ class Client:
         self.__shutdown = True
         self.__offer_sock.close()
         teacup_gen.stop()
+
+    @staticmethod
+    def parse_offer(data: bytes) -> tuple[int, int] | None:
+        """
+        Validates an offer message.
+        Returns the server's UDP and TCP ports, or None if the message is invalid
+        """
+        try:
+            return protocol.unpack_offer(data)
+        except protocol.ProtocolError as e:
+            logger.error(f'Received an invalid offer: {e}')
+            return None
+
+    def discover_servers(self, timeout: float, find_all: bool = False) -> list[ServerInfo]:
+        """
+        Listens for offers until the first valid one, or, when finding all the servers,
+        until the timeout.
+        Returns the servers which sent offers, in the order they were discovered
+        """
+        registry: ServerRegistry = ServerRegistry(max(timeout, self.__server_ttl))
+        sock: socket.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        deadline: float = time.monotonic() + timeout
+        try:
+            sock.bind(('', self.__port))
+            logger.info("Listening for offer requests...")
+            while True:
+                remaining: float = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                sock.settimeout(remaining)
+                try:
+                    data, addr = sock.recvfrom(OFFER_RECV_LEN)
+                except socket.timeout:
+                    break
+                offer: tuple[int, int] | None = Client.parse_offer(data)
+                if offer is None:
+                    continue
+                server, is_new = registry.offer(addr[0], *offer)
+                if is_new:
+                    logger.info(f'Discovered server {server}')
+                    if not find_all:
+                        break
+        finally:
+            sock.close()
+        return registry.servers()
+
+    def run_rounds(self, servers: list[ServerInfo], rounds: int, warmup_rounds: int = 0,
+                   round_timeout: float | None = None) -> bool:
+        """
+        Runs the warm-up rounds and then the measured rounds against the given servers,
+        without waiting for offers. In every round, each server is tested once, with up to
+        max_concurrent_servers servers tested in parallel. Warm-up rounds are not exported.
+        Returns whether every transfer of the measured rounds succeeded.
+        Raises TimeoutError if a round does not finish within round_timeout seconds
+        """
+        scheduler: ServerScheduler = ServerScheduler(self.__test_server, self.__max_concurrent_servers,
+                                                     self.__server_order)
+        succeeded: bool = True
+        for round_num in range(warmup_rounds + rounds):
+            self.__warming_up = round_num < warmup_rounds
+            if self.__warming_up:
+                logger.info(f'Warm-up round {round_num + 1}/{warmup_rounds}')
+            else:
+                logger.info(f'Round {round_num - warmup_rounds + 1}/{rounds}')
+
+            outcomes: list[dict] = []
+            # a daemon thread, so transfers stuck past the timeout do not keep the process alive
+            round_thread: threading.Thread = threading.Thread(
+                target=lambda: outcomes.append(scheduler.run_pass(servers)), daemon=True)
+            round_thread.start()
+            round_thread.join(round_timeout)
+            if round_thread.is_alive():
+                raise TimeoutError(f'round {round_num + 1} did not finish within {round_timeout} seconds')
+
+            if not self.__warming_up:
+                succeeded = succeeded and len(outcomes[0]) == len(servers) and all(outcomes[0].values())
+        self.__warming_up = False
+        return succeeded
+
+    def __round_results(self) -> ResultsWriter | None:
+        return None if self.__warming_up else self.__results
     
-    def request_file(self, server_addr: str, server_udp_port: int, server_tcp_port: int) -> None:
+    def request_file(self, server_addr: str, server_udp_port: int, server_tcp_port: int) -> bool:
+        """
+        Runs all the transfers of an offer, and measures the latency to the server while
+        they run if probing is enabled.
+        Returns whether every transfer succeeded, and whether any probe was echoed
+        """
+        if self.__probe_rate <= 0:
+            return self.__run_transfers(server_addr, server_udp_port, server_tcp_port)
+        try:
+            prober: LatencyProber = LatencyProber((server_addr, server_udp_port), self.__probe_rate)
+        except OSError as e:
+            logger.error(f'Failed to start measuring the latency to {server_addr}: {e}')
+            return False
+
+        succeeded: bool = True
+        if self.__tcp_connections_num + self.__udp_connections_num == 0:
+            prober.run(self.__probe_duration)
+        else:
+            probe_thread: threading.Thread = threading.Thread(target=prober.run)
+            probe_thread.start()
+            try:
+                succeeded = self.__run_transfers(server_addr, server_udp_port, server_tcp_port)
+            finally:
+                prober.stop()
+                probe_thread.join()
+        self.__report_latency(server_addr, prober)
+        return succeeded and prober.received > 0
+
+    def __run_transfers(self, server_addr: str, server_udp_port: int, server_tcp_port: int) -> bool:
+        """
+        Runs the transfers of an offer. A striped download splits the file between the
+        TCP connections, and is reported as a whole once all of them finished.
+        Returns whether every transfer succeeded
+        """
+        if self.__engine == ENGINE_ASYNCIO:
+            # imported here, since the engine itself builds on this module
+            from async_engine import AsyncEngine
+            engine: AsyncEngine = AsyncEngine(self.__data_size, self.__recv_buffer_size,
+                                              self.__socket_rcvbuf, self.__round_results(), self.__interval,
+                                              self.__max_payload_size, self.__reliable)
+            return engine.run(server_addr, server_udp_port, server_tcp_port, self.__tcp_connections_num,
+                              self.__udp_connections_num)
+
+        outcomes: list[bool] = []
+        striped_file: StripedFile | None = None
+        if self.__stripe and self.__tcp_connections_num > 0:
+            try:
+                striped_file = StripedFile(self.__data_size, self.__tcp_connections_num, self.__stripe_output,
+                                           new_seed() if self.__verify else None, self.__recv_buffer_size)
+            except OSError as e:
+                logger.error(f'Failed to prepare the striped download: {e}')
+                return False
         tcp_threads: list[threading.Thread] = []
         for i in range(self.__tcp_connections_num):
-            t = threading.Thread(target=self.tcp_connect,
-                                args=(server_addr, server_tcp_port, i + 1, ))
+            stripe: Stripe | None = striped_file.stripes[i] if striped_file is not None else None
+            t = threading.Thread(target=lambda *args: outcomes.append(self.tcp_connect(*args)),
+                                args=(server_addr, server_tcp_port, i + 1, stripe))
             t.start()
             tcp_threads.append(t)
         udp_threads: list[threading.Thread] = []
         for i in range(self.__udp_connections_num):
-            t = threading.Thread(target=self.udp_connect, 
+            t = threading.Thread(target=lambda *args: outcomes.append(self.udp_connect(*args)),
                                  args=(server_addr, server_udp_port, i + 1, ))
             t.start()
             udp_threads.append(t)
 
         for t in tcp_threads:
             t.join()
+        if striped_file is not None:
+            Client.print_striped_metrics(striped_file)
+            striped_file.close()
         for t in udp_threads:
             t.join()
+        return all(outcomes) and len(outcomes) == len(tcp_threads) + len(udp_threads)
             
-    def tcp_connect(self, server_addr: str, server_tcp_port: int, connection_num: int) -> None:
+    def tcp_connect(self, server_addr: str, server_tcp_port: int, connection_num: int,
+                    stripe: Stripe | None = None) -> bool:
+        """
+        Runs a single TCP transfer. An upload is sent alongside the download, if any, and
+        is measured by the server, which reports it once the download was sent.
+        A verified download is checked against the pattern chunk by chunk, as it arrives.
+        The download of a stripe requests just its byte range, and receives it into its
+        place in the striped file.
+        Returns whether it succeeded
+        """
+        results: ResultsWriter | None = self.__round_results()
         sock: socket.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         addr: tuple[str, int] = (server_addr, server_tcp_port)
         
-        req_data_size: int = struct.unpack("Q", self.__data_size)[0]
-        request_msg: bytes = (str(req_data_size) + '\n').encode()
-        data_left: int = req_data_size
+        req_data_size: int = self.__data_size if stripe is None else stripe.length
+        offset: int | None = None if stripe is None else stripe.offset
+        downloading: bool = self.__direction != protocol.DIRECTION_UPLOAD
+        uploading: bool = self.__direction != protocol.DIRECTION_DOWNLOAD
+        data_left: int = req_data_size if downloading else 0
+        seed: int | None = new_seed() if self.__verify and downloading else None
+        if stripe is not None:
+            seed = stripe.seed
+        verifier: PayloadVerifier | None = PayloadVerifier(seed) if seed is not None else None
+        request_msg: bytes = protocol.pack_tcp_request(req_data_size, self.__direction, seed, offset)
+        # a single buffer is reused for the whole transfer, so receiving allocates nothing
+        sink: PayloadSink | Stripe = PayloadSink(self.__recv_buffer_size, self.__discard) if stripe is None \
+            else stripe
+        sampler: IntervalSampler | None = IntervalSampler(self.__interval) if self.__interval > 0 else None
+        upload_thread: threading.Thread | None = None
+        upload_errors: list[OSError] = []
 
         try:
+            if self.__socket_rcvbuf > 0:
+                # must be set before connecting to affect the TCP window scale
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.__socket_rcvbuf)
+
             # Connect to the server
             sock.connect(addr)
             logger.info(f"Connected to server {server_addr}:{server_tcp_port} via TCP.")
 
             # Send the request message
             sock.sendall(request_msg)
-            logger.debugging(f"Sent request message of {req_data_size} bytes to the connected server.")
+            if logger.enabled(logger.DEBUG):
+                logger.debugging(f"Sent {self.__direction} request message of {req_data_size} bytes "
+                                 f"to the connected server.")
 
-            # Receive data
             start_time: float = time.time()
+            if uploading:
+                # the upload is sent from a thread of its own, so the download is received meanwhile
+                upload_thread = threading.Thread(target=self.__send_tcp_upload,
+                                                 args=(sock, req_data_size, upload_errors))
+                upload_thread.start()
+
+            # Receive data
+            if sampler is not None:
+                sampler.start()
+            report_start: bytearray = bytearray()
+            payload_end: float | None = None
+            if downloading:
+                # a rejected request is answered with a reject message in place of the payload
+                reply_start, payload_end = Client.receive_reply_start(sock, data_left)
+                first_bytes: bytearray = reply_start[:data_left]
+                report_start = reply_start[len(first_bytes):]
+                if report_start and not uploading:
+                    raise protocol.ProtocolError('the server sent more than the requested payload')
+                if stripe is not None:
+                    stripe.fill(first_bytes)
+                if verifier is not None:
+                    verifier.check(memoryview(first_bytes), offset or 0)
+                data_left -= len(first_bytes)
+                if sampler is not None:
+                    sampler.add(len(first_bytes))
             while data_left > 0:
-                data: bytes = sock.recv(MAX_PAYLOAD_MSG_SIZE)
-                if not data:
-                    logger.error("Server closed the connection.")
-                    return
-                
-                # Calculate the actual payload length
-                payload_len: int = len(data)
+                payload_len: int = sink.receive_chunk(sock, data_left)
+                if verifier is not None:
+                    verifier.check(sink.received(payload_len), (offset or 0) + req_data_size - data_left)
                 data_left -= payload_len
+                if sampler is not None:
+                    sampler.add(payload_len)
+            end_time: float = time.time() if payload_end is None else payload_end
+            if stripe is not None:
+                stripe.start_time = start_time
+                stripe.end_time = end_time
+
+            if downloading:
+                intervals: list[tuple[float, float, int]] | None = None
+                if sampler is not None:
+                    intervals = sampler.samples()
+                transfer_time: float = end_time - start_time
+                transfer_rate: float = float('inf') if transfer_time == 0 else \
+                    BYTE_SIZE * req_data_size / transfer_time
+                Client.print_tcp_connection_metrics(connection_num, transfer_time, transfer_rate)
+                if intervals is not None:
+                    Client.print_intervals('TCP', connection_num, intervals)
+                if verifier is not None:
+                    Client.print_verification('TCP', connection_num, verifier)
+                if results is not None:
+                    results.add(Client.add_verification(
+                        TransferRecord('TCP', connection_num, server_addr, req_data_size, transfer_time,
+                                       transfer_rate, 0.0, start_time, end_time, intervals), verifier))
 
-            end_time: float = time.time()
-            transfer_time: float = end_time - start_time
-            transfer_rate: float = float('inf') if transfer_time == 0 else BYTE_SIZE * req_data_size / transfer_time
-            Client.print_tcp_connection_metrics(connection_num, transfer_time, transfer_rate)
+            if uploading:
+                _, bytes_received, duration_ns = Client.receive_report(sock, report_start)
+                upload_thread.join()
+                if upload_errors:
+                    raise upload_errors[0]
+                duration: float = duration_ns / 1e9
+                upload_rate: float = float('inf') if duration == 0 else BYTE_SIZE * bytes_received / duration
+                Client.print_upload_metrics('TCP', connection_num, req_data_size, bytes_received, duration,
+                                            upload_rate)
+                if results is not None:
+                    results.add(TransferRecord('TCP', connection_num, server_addr, bytes_received, duration,
+                                               upload_rate, 0.0, start_time, start_time + duration,
+                                               direction=protocol.DIRECTION_UPLOAD))
+            return verifier is None or verifier.verified()
 
-        except socket.error as e:
+        except TransferRejected as e:
+            logger.error(f'TCP transfer #{connection_num} was rejected by the server: {e}')
+            return False
+        except (OSError, protocol.ProtocolError) as e:
             logger.error(f"TCP connection error: {e}")
+            return False
 
         finally:
+            if upload_thread is not None and upload_thread.is_alive():
+                # unblocks the upload, if the connection failed in the middle of it
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+                upload_thread.join()
             sock.close()
             logger.debugging("Connection closed.")
 
+    def __send_tcp_upload(self, sock: socket.socket, bytes_amount: int, errors: list[OSError]) -> None:
+        try:
+            self.__payload_engine.send_tcp(sock, bytes_amount)
+        except OSError as e:
+            errors.append(e)
+
+    @staticmethod
+    def receive_reply_start(sock: socket.socket, payload_size: int) -> tuple[bytearray, float | None]:
+        """
+        Receives the start of the reply to a download: REJECT.size bytes, or fewer if the
+        connection is closed first. A reject message arrives in place of the payload, so it is
+        only recognized when the whole of it arrives - a payload shorter than it is complete
+        once the connection is closed, or the report of an upload follows it.
+        Raises TransferRejected if the reply is a reject message, and ConnectionError if the
+        connection is closed before the payload arrived.
+        Returns the bytes received, and the time the payload was complete if it was by then
+        """
+        buffer: bytearray = bytearray(protocol.REJECT.size)
+        view: memoryview = memoryview(buffer)
+        received: int = 0
+        payload_end: float | None = time.time() if payload_size == 0 else None
+        while received < protocol.REJECT.size:
+            chunk: int = sock.recv_into(view[received:])
+            if chunk == 0:
+                break
+            received += chunk
+            if payload_end is None and received >= payload_size:
+                payload_end = time.time()
+        if received == protocol.REJECT.size:
+            Client.check_rejection(buffer)
+        elif received < payload_size:
+            raise ConnectionError('connection closed by the server')
+        return buffer[:received], payload_end
+
+    @staticmethod
+    def receive_report(sock: socket.socket, received: bytes | bytearray = b'') -> tuple[int, int, int]:
+        """
+        Receives the server's report of a TCP upload, which follows the downloaded payload,
+        of which the given bytes were already received.
+        Raises TransferRejected if the server rejected the upload instead.
+        Returns the datagrams (always 0 over TCP), bytes and nanoseconds the server received
+        """
+        message: bytearray = bytearray(received)
+        if len(message) < protocol.REJECT.size:
+            message += Client.receive_exactly(sock, protocol.REJECT.size - len(message))
+        Client.check_rejection(message)
+        message += Client.receive_exactly(sock, protocol.REPORT.size - len(message))
+        return protocol.unpack_report(message)
+
+    @staticmethod
+    def receive_exactly(sock: socket.socket, size: int) -> bytearray:
+        """
+        Receives exactly size bytes from a TCP connection.
+        Raises ConnectionError if the connection is closed first
+        """
+        buffer: bytearray = bytearray(size)
+        view: memoryview = memoryview(buffer)
+        received: int = 0
+        while received < size:
+            chunk: int = sock.recv_into(view[received:])
+            if chunk == 0:
+                raise ConnectionError('connection closed by the server')
+            received += chunk
+        return buffer
+
+    @staticmethod
+    def check_rejection(message) -> None:
+        """
+        Raises TransferRejected if a message is the server's reject message
+        """
+        if protocol.message_type_of(message) != protocol.MSG_REJECT:
+            return
+        try:
+            reason: int = protocol.unpack_reject(message)
+        except protocol.ProtocolError:
+            return
+        raise TransferRejected(protocol.reject_reason(reason))
+
+    @staticmethod
+    def print_striped_metrics(striped_file: StripedFile) -> None:
+        """
+        Prints the metrics of a striped download as a whole: the time from the first range
+        starting to the last one finishing, the aggregate rate, and how far apart the
+        ranges finished
+        """
+        stripes: list[Stripe] = striped_file.stripes
+        if not striped_file.complete():
+            missing: int = sum(1 for stripe in stripes if not stripe.complete())
+            logger.error(f'Striped download incomplete: {missing} of {len(stripes)} byte ranges did not arrive')
+            return
+        transfer_time: float = striped_file.completion_time()
+        transfer_rate: float = float('inf') if transfer_time == 0 else BYTE_SIZE * striped_file.size / transfer_time
+        durations: list[float] = [stripe.end_time - stripe.start_time for stripe in stripes]
+        logger.info(f'Striped download of {striped_file.size} bytes over {len(stripes)} TCP connections finished\n'
+                f'\t- total time for the striped download: {transfer_time:.4f} seconds \n'
+                f'\t- aggregate speed: {transfer_rate:.4f} bits/second '
+                f'{(f'={(transfer_rate / (1 << 10)):.4f} kilobits/seconds, ' if transfer_rate >= (1 << 10) else '')}'
+                f'{(f'={(transfer_rate / (1 << 20)):.4f} megabits/seconds, ' if transfer_rate >= (1 << 20) else '')}'
+                f'\n\t- skew between streams: the last range finished {striped_file.skew():.4f} seconds after '
+                f'the first, ranges took {min(durations):.4f}-{max(durations):.4f} seconds')
+
+    def __report_latency(self, server_addr: str, prober: LatencyProber) -> None:
+        """
+        Prints the round trips and the jitter measured by a prober, and exports them
+        """
+        if prober.received == 0:
+            logger.error(f'Latency to {server_addr}: none of the {prober.sent} probes was echoed')
+            return
+        histogram: LatencyHistogram = prober.histogram
+        loss_percent: float = 100 * prober.lost() / prober.sent
+        round_trips: str = ', '.join(
+            f'{name} {nanoseconds / NANOSECONDS_PER_MILLISECOND:.3f}'
+            for name, nanoseconds in (('min', histogram.min), ('p50', histogram.value_at_percentile(50)),
+                                      ('p99', histogram.value_at_percentile(99)),
+                                      ('p99.9', histogram.value_at_percentile(99.9)), ('max', histogram.max),
+                                      ('mean', histogram.mean())))
+        logger.info(f'Latency to {server_addr}: {prober.sent} probes sent, {prober.received} echoed, '
+                    f'{loss_percent:.2f}% lost, {prober.reordered} reordered\n'
+                    f'\t- round trip (ms): {round_trips}\n'
+                    f'\t- jitter (RFC 3550): {prober.jitter / NANOSECONDS_PER_MILLISECOND:.3f} ms')
+        results: ResultsWriter | None = self.__round_results()
+        if results is not None:
+            results.add(LatencyRecord(server_addr, prober.sent, prober.received, prober.reordered,
+                                      prober.start_time, prober.end_time, histogram.min / NANOSECONDS,
+                                      histogram.mean() / NANOSECONDS,
+                                      histogram.value_at_percentile(50) / NANOSECONDS,
+                                      histogram.value_at_percentile(99) / NANOSECONDS,
+                                      histogram.value_at_percentile(99.9) / NANOSECONDS,
+                                      histogram.max / NANOSECONDS, prober.jitter / NANOSECONDS))
+
+    @staticmethod
+    def print_verification(protocol_name: str, connection_num: int, verifier: PayloadVerifier) -> None:
+        """
+        Prints whether the payload of a verified download matched the pattern, and the
+        offsets of the first wrong bytes if it did not
+        """
+        if verifier.verified():
+            logger.info(f'{protocol_name} transfer #{connection_num} payload: {verifier}')
+        else:
+            logger.error(f'Error: {protocol_name} transfer #{connection_num} payload does not match the '
+                         f'pattern: {verifier}')
+
+    @staticmethod
+    def add_verification(record: TransferRecord, verifier: PayloadVerifier | None) -> TransferRecord:
+        """
+        Adds the outcome of a verified download, if any, to its exported record
+        """
+        if verifier is not None:
+            record.verified_bytes = verifier.bytes_checked
+            record.mismatched_pieces = verifier.mismatched_pieces
+            record.mismatch_offsets = verifier.mismatches
+        return record
+
     @staticmethod
     def print_tcp_connection_metrics(connection_num: int, transfer_time: float,
                                      transfer_rate: float) -> None:
@@ -189,68 +656,270 @@ class Client:
                 f'{(f'={(transfer_rate / (1 << 20)):.4f} megabits/seconds ' if transfer_rate >= (1 << 20) else '')}')
         
     
-    def udp_connect(self, server_addr: str, server_udp_port: int, connection_num: int) -> None:
+    @staticmethod
+    def print_upload_metrics(protocol_name: str, connection_num: int, bytes_sent: int, bytes_received: int,
+                             transfer_time: float, transfer_rate: float,
+                             packets: tuple[int, int] | None = None) -> None:
+        """
+        Prints the metrics of an upload, as measured by the server: total transfer time,
+        transfer rate and how much of the payload arrived - and, over UDP, how many of the
+        packets sent arrived
+        """
+        packet_metrics: str = ''
+        if packets is not None:
+            packets_received, packets_sent = packets
+            percent: float = 100.0 if packets_sent == 0 else 100 * packets_received / packets_sent
+            packet_metrics = (f'\n\t- packets received by the server: {packets_received} of {packets_sent} '
+                              f'({percent:.4f}%)')
+        logger.info(f'{protocol_name} upload #{connection_num} finished\n'
+                f'\t- total time for {protocol_name} upload #{connection_num}: {transfer_time:.4f} seconds \n'
+                f'\t- total speed for {protocol_name} upload #{connection_num}: {transfer_rate:.4f} bits/second '
+                f'{(f'={(transfer_rate / (1 << 10)):.4f} kilobits/seconds, ' if transfer_rate >= (1 << 10) else '')}'
+                f'{(f'={(transfer_rate / (1 << 20)):.4f} megabits/seconds, ' if transfer_rate >= (1 << 20) else '')}'
+                f'\n\t- bytes received by the server: {bytes_received} of {bytes_sent}'
+                f'{packet_metrics}')
+
+    def udp_connect(self, server_addr: str, server_udp_port: int, connection_num: int) -> bool:
+        """
+        Runs a single UDP transfer. A reliable transfer sends a NACK every NACK_INTERVAL,
+        until every segment arrived. An upload is sent to the port the server's ready message
+        names, alongside the download, if any, and the server reports it once it stopped
+        arriving. Every segment of a verified download is checked against the pattern at the
+        offset of its segment.
+        Returns whether any of the payload arrived, and matched the pattern when verified
+        """
+        results: ResultsWriter | None = self.__round_results()
         sock: socket.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         addr: tuple[str, int] = (server_addr, server_udp_port)
-        cookie: bytes = struct.pack('I', COOKIE)
-        type_offer: bytes = struct.pack('B', TYPE_REQUEST)
-        request_msg: bytes = cookie + type_offer + self.__data_size
-        req_data_size: int = struct.unpack("Q", self.__data_size)[0]
-        data_left: int = req_data_size
+        req_data_size: int = self.__data_size
+        downloading: bool = self.__direction != protocol.DIRECTION_UPLOAD
+        data_left: int = req_data_size if downloading else 0
+        unique_bytes: int = 0
+        reliable: bool = self.__reliable and downloading
+        seed: int = new_seed() if self.__verify else 0
+        verifier: PayloadVerifier | None = PayloadVerifier(seed) if self.__verify and downloading else None
+        uploader: UdpUploader | None = None
+        succeeded: bool = True
 
         try:
-            sock.sendto(request_msg, addr)
-            logger.debugging(f'Sent request message of {req_data_size} bytes to server '
-                  f'{server_addr}:{server_udp_port} via UDP.')
-            segments_amount: int = (req_data_size // MAX_PAYLOAD_SIZE) + 1
-            received_segments_count: int = 0
-            curr_segment_id: int = 0
+            # the receive buffer is enlarged before the first datagram can arrive
+            receiver: UdpReceiver = UdpReceiver(sock, protocol.PAYLOAD_HEADER.size + self.__max_payload_size)
+            if self.__direction != protocol.DIRECTION_DOWNLOAD:
+                uploader = UdpUploader(sock, server_addr, req_data_size, self.__max_payload_size)
+            sock.sendto(protocol.pack_request(req_data_size, self.__max_payload_size, self.__udp_flags, seed), addr)
+            if logger.enabled(logger.DEBUG):
+                logger.debugging(f'Sent {self.__direction} request message of {req_data_size} bytes to server '
+                                 f'{server_addr}:{server_udp_port} via UDP.')
+            # the server picks the payload size, so the segments amount is known from the first segment
+            tracker: SegmentTracker | None = SegmentTracker(0) if req_data_size == 0 else None
+            sampler: IntervalSampler | None = IntervalSampler(self.__interval) if self.__interval > 0 else None
+            download_over: bool = not downloading or tracker is not None
+            timeout: float = NACK_INTERVAL if reliable else UDP_INACTIVITY_TIMEOUT
+            inactivity_timeout: float = RELIABLE_INACTIVITY_TIMEOUT if reliable else UDP_INACTIVITY_TIMEOUT
+            if uploader is not None:
+                timeout = min(timeout, UPLOAD_POLL_INTERVAL)
 
             start_time: float = time.time()
+            end_time: float = start_time
+            next_nack: float = start_time + NACK_INTERVAL
 
-            while curr_segment_id < segments_amount - 1:
-                data, _ = sock.recvfrom(MAX_PAYLOAD_MSG_SIZE)
-                if not data:
-                    logger.error("Did not receive data from the server.")
-                    continue
-                cookie: int = struct.unpack('I', data[COOKIE_IDX:COOKIE_IDX+COOKIE_LEN])[0]
-                if cookie != COOKIE:
-                    logger.error(f'Error: received invalid cookie: {hex(cookie)}')
+            # receive until every segment arrived, or the server stopped sending, and until
+            # the upload was reported
+            while not download_over or (uploader is not None and uploader.pending()):
+                received: int = receiver.receive(timeout)
+                now: float = time.time()
+                if not download_over and received == 0 and now - end_time >= inactivity_timeout:
+                    download_over = True
                     continue
-                
-                message_type: int = struct.unpack('B', data[TYPE_IDX:TYPE_IDX+TYPE_LEN])[0]
-                if message_type != TYPE_PAYLOAD:
-                    logger.error(f'Error: received invalid message type: {message_type}. Expected: {TYPE_REQUEST}')
-                    continue
-                
-                curr_segment_id = struct.unpack('Q', data[CURR_SEGMENT_IDX:CURR_SEGMENT_IDX + CURR_SEGMENT_LEN])[0]
+                if reliable and not download_over and tracker is not None and now >= next_nack:
+                    # once the segments stopped arriving, the missing tail is reported too
+                    sock.sendto(Client.build_nack(tracker, received == 0), addr)
+                    next_nack = now + NACK_INTERVAL
+                batch_data_left: int = data_left
+                for slot in range(received):
+                    # parse the header in place, without copying the datagram
+                    offset: int = slot * receiver.slot_size
+                    message_len: int = receiver.lengths[slot]
+                    if uploader is not None and \
+                            uploader.handle_message(receiver.view[offset:offset + message_len]):
+                        continue
+                    if message_len < protocol.PAYLOAD_HEADER.size:
+                        Client.check_rejection(receiver.view[offset:offset + message_len])
+                        logger.error("Received a truncated message from the server.")
+                        continue
+                    try:
+                        segments_amount, curr_segment_id, retransmission = protocol.unpack_payload_header(
+                            receiver.view, offset)
+                    except protocol.ProtocolError as e:
+                        logger.error(f'Error: received an invalid payload: {e}')
+                        continue
 
-                # calculate the actual payload length
-                payload_len: int = len(data[PAYLOAD_DATA_IDX:])
-                data_left -= payload_len
-                received_segments_count += 1
-            
-            end_time: float = time.time()
-            transfer_time: float = end_time - start_time
-
-            transfer_rate: float = float('inf') if transfer_time == 0 else BYTE_SIZE * req_data_size / transfer_time
-            Client.print_udp_connection_metrics(connection_num, transfer_time,
-                        transfer_rate, (received_segments_count / segments_amount) * 100)
-        except socket.timeout:
-            logger.error(f'UDP connection to server {server_addr}:{server_udp_port} timed out.')
+                    if tracker is None:
+                        tracker = SegmentTracker(segments_amount)
+                    payload_len: int = message_len - protocol.PAYLOAD_HEADER.size
+                    if tracker.record(curr_segment_id, retransmission):
+                        unique_bytes += payload_len
+                    if verifier is not None:
+                        # every segment but the last is as long as the payload size the server picked
+                        segment_offset: int = req_data_size - payload_len if curr_segment_id == segments_amount - 1 \
+                            else curr_segment_id * payload_len
+                        verifier.check(receiver.view[offset + protocol.PAYLOAD_HEADER.size:offset + message_len],
+                                       segment_offset)
+                    data_left -= payload_len
+                if batch_data_left != data_left:
+                    end_time = now
+                    if sampler is not None:
+                        sampler.add(batch_data_left - data_left)
+                    download_over = tracker.complete()
+
+            if downloading:
+                succeeded = self.__report_udp_download(sock, addr, receiver, tracker, connection_num,
+                                                       req_data_size - data_left, unique_bytes, start_time,
+                                                       end_time, sampler, results, verifier)
+            if uploader is not None:
+                uploader.join()
+                succeeded = self.__report_udp_upload(uploader, connection_num, server_addr, req_data_size,
+                                                     results) and succeeded
+            return succeeded
+        except TransferRejected as e:
+            logger.error(f'UDP transfer #{connection_num} was rejected by the server: {e}')
+            return False
         except Exception as e:
             logger.error(f'Failed to receive message from server: {e}')
+            return False
+        finally:
+            if uploader is not None:
+                uploader.join()
+            sock.close()
+
+    def __report_udp_download(self, sock: socket.socket, addr: tuple[str, int], receiver: UdpReceiver,
+                              tracker: SegmentTracker | None, connection_num: int, bytes_received: int,
+                              unique_bytes: int, start_time: float, end_time: float,
+                              sampler: IntervalSampler | None, results: ResultsWriter | None,
+                              verifier: PayloadVerifier | None = None) -> bool:
+        """
+        Prints and exports the metrics of a finished UDP download.
+        Returns whether any of the payload arrived, and matched the pattern when verified
+        """
+        reliable: bool = self.__reliable
+        if tracker is None:
+            logger.error(f'UDP connection to server {addr[0]}:{addr[1]} timed out.')
+            return False
+        if reliable and tracker.complete():
+            final_ack: bytes = protocol.pack_nack(tracker.segments_amount, [])
+            for _ in range(FINAL_ACK_REPEATS):
+                sock.sendto(final_ack, addr)
+        # the transfer ended with its last received segment, not with the inactivity timeout
+        transfer_time: float = end_time - start_time
+        intervals: list[tuple[float, float, int]] | None = None
+        if sampler is not None:
+            intervals = sampler.samples()
+
+        transfer_rate: float = float('inf') if transfer_time == 0 else BYTE_SIZE * bytes_received / transfer_time
+        goodput: float | None = None
+        if reliable:
+            goodput = float('inf') if transfer_time == 0 else BYTE_SIZE * unique_bytes / transfer_time
+        receiver.update_drops()
+        Client.print_udp_connection_metrics(connection_num, transfer_time, transfer_rate, tracker,
+                                            receiver.kernel_drops, goodput)
+        if intervals is not None:
+            Client.print_intervals('UDP', connection_num, intervals)
+        if verifier is not None:
+            Client.print_verification('UDP', connection_num, verifier)
+        if results is not None:
+            results.add(Client.add_verification(
+                TransferRecord('UDP', connection_num, addr[0], bytes_received, transfer_time, transfer_rate,
+                               100 - tracker.success_percent(), start_time, end_time, intervals, goodput,
+                               tracker.retransmission_percent() if reliable else None), verifier))
+        return verifier is None or verifier.verified()
+
+    @staticmethod
+    def __report_udp_upload(uploader: UdpUploader, connection_num: int, server_addr: str, bytes_sent: int,
+                            results: ResultsWriter | None) -> bool:
+        """
+        Prints and exports the metrics of a UDP upload, as the server reported them.
+        Returns whether the server reported the upload
+        """
+        if uploader.report is None:
+            logger.error(f'UDP upload #{connection_num} to server {server_addr} was never reported.')
+            return False
+        datagrams, bytes_received, duration_ns = uploader.report
+        duration: float = duration_ns / 1e9
+        upload_rate: float = float('inf') if duration == 0 else BYTE_SIZE * bytes_received / duration
+        segments_sent: int = uploader.send_report.segments_sent
+        Client.print_upload_metrics('UDP', connection_num, bytes_sent, bytes_received, duration, upload_rate,
+                                    (datagrams, segments_sent))
+        if results is not None:
+            loss_percent: float = 0.0 if segments_sent == 0 else max(0.0, 100 - 100 * datagrams / segments_sent)
+            results.add(TransferRecord('UDP', connection_num, server_addr, bytes_received, duration, upload_rate,
+                                       loss_percent, uploader.start_time, uploader.start_time + duration,
+                                       direction=protocol.DIRECTION_UPLOAD))
+        return True
         
+    @staticmethod
+    def build_nack(tracker: SegmentTracker, idle: bool) -> bytes:
+        """
+        Builds a NACK of a reliable UDP transfer, reporting the segments missing below the
+        highest segment received - or, once the segments stopped arriving, up to the last one
+        """
+        end: int = tracker.segments_amount if idle else tracker.highest_segment + 1
+        return protocol.pack_nack(tracker.first_missing, tracker.missing_ranges(end, protocol.MAX_NACK_RANGES))
+
     @staticmethod
     def print_udp_connection_metrics(connection_num: int, transfer_time: float,
-                                     transfer_rate: float, success_percent: float) -> None:
+                                     transfer_rate: float, tracker: SegmentTracker,
+                                     kernel_drops: int | None, goodput: float | None = None) -> None:
         """
         Prints UDP connection metrics: connection number, total transfer time,
-        transfer rate and what percent of packets received
+        transfer rate, what percent of packets received, and how packets were
+        lost, reordered or duplicated.
+        Packets the client's own socket dropped are reported apart from network loss.
+        A reliable transfer also reports its goodput - the rate of the unique payload - and
+        how many packets were retransmitted
         """
+        reliable_metrics: str = ''
+        if goodput is not None:
+            completion: str = f'completed in {transfer_time:.4f} seconds' if tracker.complete() else 'incomplete'
+            reliable_metrics = (f'\n\t- goodput for UDP #{connection_num}: {goodput:.4f} bits/second, {completion}'
+                                f'\n\t- packets retransmitted: {tracker.retransmissions} '
+                                f'({tracker.retransmission_percent():.4f}% of the packets)')
+        client_drops: str = 'unknown' if kernel_drops is None else str(kernel_drops)
+        network_loss: str = 'unknown' if kernel_drops is None else str(max(0, tracker.lost() - kernel_drops))
         logger.info(f'UDP transfer #{connection_num} finished\n'
                 f'\t- total time for UDP #{connection_num}: {transfer_time:.4f} seconds \n'
                 f'\t- total speed for UDP #{connection_num}: {transfer_rate:.4f} bits/second '
-                f'\n\t- percentage of packets received successfully: {success_percent:.4f}%'
                 f'{(f'={(transfer_rate / (1 << 10)):.4f} kilobits/seconds, ' if transfer_rate >= (1 << 10) else '')}'
-                f'{(f'={(transfer_rate / (1 << 20)):.4f} megabits/seconds, ' if transfer_rate >= (1 << 20) else '')}')
+                f'{(f'={(transfer_rate / (1 << 20)):.4f} megabits/seconds, ' if transfer_rate >= (1 << 20) else '')}'
+                f'\n\t- percentage of packets received successfully: {tracker.success_percent():.4f}%'
+                f'\n\t- packets lost: {tracker.lost()}, largest gap: {tracker.largest_gap()} packets'
+                f'\n\t- packets lost in the network: {network_loss}, '
+                f'dropped by the client socket: {client_drops}'
+                f'\n\t- packets reordered: {tracker.reordered}, largest reordering distance: '
+                f'{tracker.max_reorder_distance} packets'
+                f'\n\t- duplicate packets: {tracker.duplicates}'
+                f'{reliable_metrics}')
+
+    @staticmethod
+    def print_intervals(protocol: str, connection_num: int, intervals: list[tuple[float, float, int]]) -> None:
+        """
+        Prints the throughput of every sampled interval of a transfer, as a table
+        """
+        lines: list[str] = [f'{protocol} transfer #{connection_num} intervals:',
+                            f'\t{"Interval":>17}{"Transfer":>16}{"Bitrate":>20}']
+        for start, end, bytes_received in intervals:
+            duration: float = end - start
+            bitrate: float = 0.0 if duration <= 0 else BYTE_SIZE * bytes_received / duration
+            lines.append(f'\t{start:8.2f}-{end:<8.2f} sec{Client.__format_units(bytes_received, 1024, "Bytes"):>16}'
+                         f'{Client.__format_units(bitrate, 1000, "bits/sec"):>20}')
+        logger.info('\n'.join(lines))
+
+    @staticmethod
+    def __format_units(value: float, base: int, unit: str) -> str:
+        """
+        Formats a value with the largest fitting K/M/G prefix
+        """
+        for prefix in ('G', 'M', 'K'):
+            scale: int = base ** ('KMG'.index(prefix) + 1)
+            if value >= scale:
+                return f'{value / scale:.2f} {prefix}{unit}'
+        return f'{value:.0f} {unit}'
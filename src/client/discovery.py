@@ -0,0 +1,233 @@
+import ipaddress
+import threading
+import time
+from typing import Callable
+
+import logger
+
+# seconds a server stays known without sending another offer (servers offer every second)
+DEFAULT_SERVER_TTL = 5.0
+ORDER_ARRIVAL = 'arrival'
+ORDER_ADDRESS = 'address'
+ORDER_LEAST_RECENT = 'least-recent'
+SERVER_ORDERS = [ORDER_ARRIVAL, ORDER_ADDRESS, ORDER_LEAST_RECENT]
+
+
+class ServerInfo:
+    """
+    A server known from its offers
+    """
+    address: str
+    udp_port: int
+    tcp_port: int
+    first_seen: float
+    last_seen: float
+    last_tested: float
+
+    def __init__(self, address: str, udp_port: int, tcp_port: int, now: float):
+        self.address = address
+        self.udp_port = udp_port
+        self.tcp_port = tcp_port
+        self.first_seen = now
+        self.last_seen = now
+        # 0 until the server is tested for the first time
+        self.last_tested = 0.0
+
+    def key(self) -> tuple[str, int, int]:
+        return self.address, self.udp_port, self.tcp_port
+
+    def __str__(self) -> str:
+        return f'{self.address} (UDP {self.udp_port}, TCP {self.tcp_port})'
+
+
+class ServerRegistry:
+    """
+    Keeps the servers which sent offers recently.
+    Repeated offers of a known server only refresh it, and servers which stop offering
+    for longer than the TTL are forgotten
+    """
+    __lock: threading.Lock
+    __servers: dict[tuple[str, int, int], ServerInfo]
+    __ttl: float
+
+    def __init__(self, ttl: float = DEFAULT_SERVER_TTL):
+        self.__lock = threading.Lock()
+        self.__servers = {}
+        self.__ttl = ttl
+
+    def offer(self, address: str, udp_port: int, tcp_port: int) -> tuple[ServerInfo, bool]:
+        """
+        Records an offer.
+        Returns the offering server, and whether it was not known before
+        """
+        now: float = time.monotonic()
+        key: tuple[str, int, int] = (address, udp_port, tcp_port)
+        with self.__lock:
+            self.__expire(now)
+            server: ServerInfo | None = self.__servers.get(key)
+            if server is not None:
+                server.last_seen = now
+                return server, False
+            server = ServerInfo(address, udp_port, tcp_port, now)
+            self.__servers[key] = server
+            return server, True
+
+    def is_alive(self, server: ServerInfo) -> bool:
+        """
+        Returns whether the server sent an offer within the TTL
+        """
+        return time.monotonic() - server.last_seen <= self.__ttl
+
+    def servers(self) -> list[ServerInfo]:
+        """
+        Returns the servers which sent an offer within the TTL, in the order they were discovered
+        """
+        with self.__lock:
+            self.__expire(time.monotonic())
+            return sorted(self.__servers.values(), key=lambda server: server.first_seen)
+
+    def __expire(self, now: float) -> None:
+        for key in [key for key, server in self.__servers.items() if now - server.last_seen > self.__ttl]:
+            logger.debugging(f'Server {self.__servers[key]} stopped sending offers')
+            del self.__servers[key]
+
+
+def order_key(order: str) -> Callable[[ServerInfo], tuple]:
+    """
+    Returns the sort key putting servers in the given test order
+    """
+    if order == ORDER_ADDRESS:
+        return lambda server: (ipaddress.ip_address(server.address), server.tcp_port, server.udp_port)
+    if order == ORDER_LEAST_RECENT:
+        return lambda server: (server.last_tested, server.first_seen)
+    return lambda server: (server.first_seen,)
+
+
+class ServerScheduler:
+    """
+    Tests servers in parallel, running at most max_concurrent tests at a time, and
+    never testing two servers of the same address at once - they would share the link
+    being measured, and their results could not be told apart.
+    Servers waiting for a free slot are started in the chosen order: by arrival, by
+    address, or least recently tested first.
+    Can either test a fixed list of servers once, or keep testing servers as they are
+    submitted until stopped
+    """
+    __test: Callable[[ServerInfo], bool]
+    __max_concurrent: int
+    __order_key: Callable[[ServerInfo], tuple]
+    __registry: ServerRegistry | None
+    __condition: threading.Condition
+    __pending: dict[tuple[str, int, int], ServerInfo]
+    __running: set[tuple[str, int, int]]
+    __outcomes: dict[tuple[str, int, int], bool]
+    __stopped: bool
+    __dispatcher: threading.Thread | None
+
+    def __init__(self, test: Callable[[ServerInfo], bool], max_concurrent: int = 1, order: str = ORDER_ARRIVAL,
+                 registry: ServerRegistry | None = None):
+        self.__test = test
+        self.__max_concurrent = max(1, max_concurrent)
+        self.__order_key = order_key(order)
+        # when set, servers which stopped offering are dropped instead of tested
+        self.__registry = registry
+        self.__condition = threading.Condition()
+        self.__pending = {}
+        self.__running = set()
+        self.__outcomes = {}
+        self.__stopped = False
+        self.__dispatcher = None
+
+    def start(self) -> None:
+        """
+        Starts testing submitted servers in the background
+        """
+        self.__dispatcher = threading.Thread(target=self.__dispatch)
+        self.__dispatcher.start()
+
+    def stop(self) -> None:
+        """
+        Stops starting new tests, and waits for the running ones to finish
+        """
+        with self.__condition:
+            self.__stopped = True
+            self.__pending.clear()
+            self.__condition.notify_all()
+        if self.__dispatcher is not None:
+            self.__dispatcher.join()
+        with self.__condition:
+            self.__condition.wait_for(lambda: not self.__running)
+
+    def submit(self, server: ServerInfo) -> None:
+        """
+        Queues a server for testing, unless it is already queued or being tested
+        """
+        with self.__condition:
+            key: tuple[str, int, int] = server.key()
+            if self.__stopped or key in self.__pending or key in self.__running:
+                return
+            self.__pending[key] = server
+            self.__condition.notify_all()
+
+    def idle(self) -> bool:
+        with self.__condition:
+            return not self.__pending and not self.__running
+
+    def run_pass(self, servers: list[ServerInfo]) -> dict[tuple[str, int, int], bool]:
+        """
+        Tests every one of the servers once, and waits for all the tests to finish.
+        Returns whether each server's test succeeded
+        """
+        with self.__condition:
+            self.__outcomes = {}
+        for server in servers:
+            self.submit(server)
+        while True:
+            with self.__condition:
+                self.__condition.wait_for(lambda: self.__pending or not self.__running)
+                if not self.__pending:
+                    return dict(self.__outcomes)
+                self.__start_next()
+
+    def __dispatch(self) -> None:
+        while True:
+            with self.__condition:
+                self.__condition.wait_for(lambda: self.__stopped or self.__pending)
+                if self.__stopped:
+                    return
+                self.__start_next()
+
+    def __start_next(self) -> None:
+        """
+        Starts the first pending server in the test order, once a slot is free and a server
+        whose address is not being tested is pending.
+        Must be called with the condition held
+        """
+        self.__condition.wait_for(lambda: self.__stopped or not self.__pending or
+                                  (len(self.__running) < self.__max_concurrent and self.__startable()))
+        if self.__stopped or not self.__pending:
+            return
+        server: ServerInfo = min(self.__startable(), key=self.__order_key)
+        del self.__pending[server.key()]
+        if self.__registry is not None and not self.__registry.is_alive(server):
+            logger.debugging(f'Skipping server {server}, which stopped sending offers')
+            return
+        self.__running.add(server.key())
+        threading.Thread(target=self.__run_test, args=(server, )).start()
+
+    def __startable(self) -> list[ServerInfo]:
+        busy_addresses: set[str] = {key[0] for key in self.__running}
+        return [server for server in self.__pending.values() if server.address not in busy_addresses]
+
+    def __run_test(self, server: ServerInfo) -> None:
+        succeeded: bool = False
+        try:
+            succeeded = self.__test(server)
+        except Exception as e:
+            logger.error(f'Testing server {server} failed: {e}')
+        finally:
+            with self.__condition:
+                server.last_tested = time.monotonic()
+                self.__outcomes[server.key()] = succeeded
+                self.__running.discard(server.key())
+                self.__condition.notify_all()
@@ -0,0 +1,81 @@
+from array import array
+import time
+
+NS_IN_SECOND = 1_000_000_000
+# intervals kept per transfer, older intervals are overwritten
+DEFAULT_CAPACITY = 3000
+
+
+class IntervalSampler:
+    """
+    Records the bytes a transfer received in every interval of a fixed length, to show
+    slow-start, stalls and throughput collapse that a single average rate hides.
+    Intervals are kept in a fixed-size ring, so memory does not grow with the transfer,
+    and adding bytes costs a clock read and an addition until an interval ends.
+    """
+    __interval_ns: int
+    __capacity: int
+    __ring: array
+    __start_ns: int
+    __end_ns: int
+    __boundary_ns: int
+    __completed: int
+    __current_bytes: int
+
+    def __init__(self, interval: float, capacity: int = DEFAULT_CAPACITY):
+        self.__interval_ns = max(1, int(interval * NS_IN_SECOND))
+        self.__capacity = capacity
+        self.__ring = array('Q', bytes(8 * capacity))
+        self.start()
+
+    def start(self) -> None:
+        """
+        Starts the first interval
+        """
+        self.__start_ns = time.perf_counter_ns()
+        self.__end_ns = self.__start_ns
+        self.__boundary_ns = self.__start_ns + self.__interval_ns
+        self.__completed = 0
+        self.__current_bytes = 0
+
+    def add(self, nbytes: int) -> None:
+        """
+        Adds received bytes to the current interval.
+        The transfer is considered to end with the last added bytes
+        """
+        now_ns: int = time.perf_counter_ns()
+        if now_ns >= self.__boundary_ns:
+            self.__roll(now_ns)
+        self.__current_bytes += nbytes
+        self.__end_ns = now_ns
+
+    def __roll(self, now_ns: int) -> None:
+        """
+        Ends the current interval, and every empty interval a stall skipped
+        """
+        elapsed: int = (now_ns - self.__boundary_ns) // self.__interval_ns + 1
+        if elapsed > self.__capacity:
+            # the whole ring is now taken by the stall
+            self.__ring = array('Q', bytes(8 * self.__capacity))
+        else:
+            self.__ring[self.__completed % self.__capacity] = self.__current_bytes
+            for idx in range(self.__completed + 1, self.__completed + elapsed):
+                self.__ring[idx % self.__capacity] = 0
+        self.__completed += elapsed
+        self.__boundary_ns += elapsed * self.__interval_ns
+        self.__current_bytes = 0
+
+    def samples(self) -> list[tuple[float, float, int]]:
+        """
+        Returns the kept intervals as (start, end, bytes), in seconds since the transfer started.
+        The last interval ends with the transfer, so may be shorter than the others
+        """
+        interval: float = self.__interval_ns / NS_IN_SECOND
+        samples: list[tuple[float, float, int]] = []
+        for idx in range(max(0, self.__completed - self.__capacity), self.__completed):
+            samples.append((idx * interval, (idx + 1) * interval, self.__ring[idx % self.__capacity]))
+        last_start_ns: int = self.__start_ns + self.__completed * self.__interval_ns
+        if self.__current_bytes or self.__end_ns > last_start_ns:
+            samples.append((self.__completed * interval, (self.__end_ns - self.__start_ns) / NS_IN_SECOND,
+                            self.__current_bytes))
+        return samples
@@ -0,0 +1,217 @@
+from array import array
+import math
+import select
+import socket
+import threading
+import time
+
+import logger
+import protocol
+
+# every power of two of a value is split into this many linear sub-buckets (as bits), which
+# bounds the error of a recorded value to 1 / 2^(SUB_BUCKET_BITS - 1), under 1.6%
+SUB_BUCKET_BITS = 7
+SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+HALF_SUB_BUCKETS = SUB_BUCKETS >> 1
+# largest value recorded in its own bucket, in nanoseconds (about 36 minutes); larger values
+# count in the last bucket
+HIGHEST_TRACKABLE_VALUE = (1 << 41) - 1
+# seconds a latency measurement runs when no transfers run alongside it
+DEFAULT_PROBE_DURATION = 5.0
+# seconds to wait for the echoes of the last probes once probing stops
+PROBE_GRACE_PERIOD = 1.0
+# while waiting for the next probe, the prober wakes up this often to check whether to stop
+POLL_INTERVAL = 0.1
+NANOSECONDS = 1_000_000_000
+NANOSECONDS_PER_MILLISECOND = 1_000_000
+
+
+def bucket_index(value: int) -> int:
+    """
+    Returns the bucket a value counts in: values below SUB_BUCKETS have a bucket each, and
+    every following power of two is split into HALF_SUB_BUCKETS buckets
+    """
+    magnitude: int = value.bit_length() - SUB_BUCKET_BITS
+    if magnitude <= 0:
+        return value
+    return magnitude * HALF_SUB_BUCKETS + (value >> magnitude)
+
+
+def bucket_range(index: int) -> tuple[int, int]:
+    """
+    Returns the lowest and the highest value counted in a bucket
+    """
+    if index < SUB_BUCKETS:
+        return index, index
+    magnitude: int = index // HALF_SUB_BUCKETS - 1
+    lowest: int = (index - magnitude * HALF_SUB_BUCKETS) << magnitude
+    return lowest, lowest + (1 << magnitude) - 1
+
+
+BUCKETS = bucket_index(HIGHEST_TRACKABLE_VALUE) + 1
+
+
+class LatencyHistogram:
+    """
+    An HDR-style histogram of latencies in nanoseconds: a fixed array of log-bucketed
+    counters with linear sub-buckets, so its memory is constant however many values are
+    recorded, while every percentile stays within the precision of SUB_BUCKET_BITS
+    """
+    __counts: array
+    count: int
+    total: int
+    min: int
+    max: int
+
+    def __init__(self):
+        self.__counts = array('Q', bytes(8 * BUCKETS))
+        self.count = 0
+        self.total = 0
+        self.min = 0
+        self.max = 0
+
+    def record(self, value: int) -> None:
+        value = max(0, value)
+        self.__counts[bucket_index(min(value, HIGHEST_TRACKABLE_VALUE))] += 1
+        if self.count == 0 or value < self.min:
+            self.min = value
+        self.max = max(self.max, value)
+        self.count += 1
+        self.total += value
+
+    def mean(self) -> float:
+        return 0.0 if self.count == 0 else self.total / self.count
+
+    def value_at_percentile(self, percent: float) -> int:
+        """
+        Returns the nearest-rank percentile: the highest value of the bucket it is counted
+        in, but no more than the largest value recorded
+        """
+        if self.count == 0:
+            return 0
+        rank: int = max(1, math.ceil(percent / 100 * self.count))
+        seen: int = 0
+        for index, count in enumerate(self.__counts):
+            seen += count
+            if seen >= rank:
+                return max(self.min, min(bucket_range(index)[1], self.max))
+        return self.max
+
+
+class LatencyProber:
+    """
+    Measures the round trip to a server: sends timestamped probes to its UDP port at a
+    fixed rate, which the server echoes right away. The echo carries the send time back,
+    so no state is kept per probe - every round trip goes into the histogram, and the
+    jitter is estimated like RFC 3550 does (J += (|D| - J) / 16), with D the difference
+    between the round trips of consecutive echoes
+    """
+    __sock: socket.socket
+    __interval: float
+    __stop: threading.Event
+    __buffer: bytearray
+    __last_rtt: int | None
+    __highest_sequence: int
+    histogram: LatencyHistogram
+    jitter: float
+    sent: int
+    received: int
+    reordered: int
+    start_time: float
+    end_time: float
+
+    def __init__(self, server_addr: tuple[str, int], rate: float):
+        self.__sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        # only the server's echoes arrive on a connected socket
+        self.__sock.connect(server_addr)
+        self.__sock.setblocking(False)
+        self.__interval = 1 / rate
+        self.__stop = threading.Event()
+        self.__buffer = bytearray(protocol.PROBE.size)
+        self.__last_rtt = None
+        self.__highest_sequence = -1
+        self.histogram = LatencyHistogram()
+        # in nanoseconds
+        self.jitter = 0.0
+        self.sent = 0
+        self.received = 0
+        # echoes which arrived after the echo of a later probe
+        self.reordered = 0
+        self.start_time = 0.0
+        self.end_time = 0.0
+
+    def run(self, duration: float | None = None) -> None:
+        """
+        Sends probes until stopped or for the given seconds, and then waits up to
+        PROBE_GRACE_PERIOD for the remaining echoes
+        """
+        self.start_time = time.time()
+        now: float = time.monotonic()
+        deadline: float = math.inf if duration is None else now + duration
+        next_probe: float = now
+        try:
+            while not self.__stop.is_set() and now < deadline:
+                if now >= next_probe:
+                    self.__send_probe()
+                    next_probe += self.__interval
+                    # a late probe is caught up with right away, but a prober which fell
+                    # further behind skips the probes it missed instead of bursting them
+                    if next_probe < now - POLL_INTERVAL:
+                        next_probe = now
+                self.__wait_for_replies(min(next_probe, deadline) - now)
+                now = time.monotonic()
+
+            grace_end: float = time.monotonic() + PROBE_GRACE_PERIOD
+            while self.received < self.sent and (remaining := grace_end - time.monotonic()) > 0:
+                self.__wait_for_replies(remaining)
+        finally:
+            self.end_time = time.time()
+            self.__sock.close()
+
+    def stop(self) -> None:
+        self.__stop.set()
+
+    def lost(self) -> int:
+        return max(0, self.sent - self.received)
+
+    def __send_probe(self) -> None:
+        try:
+            self.__sock.send(protocol.pack_probe(self.sent, time.monotonic_ns()))
+        except (BlockingIOError, ConnectionRefusedError):
+            # counted as lost: the socket buffer is full, or the server is not listening
+            pass
+        self.sent += 1
+
+    def __wait_for_replies(self, timeout: float) -> None:
+        """
+        Waits up to the timeout, but no more than POLL_INTERVAL, for echoes, and records
+        all the echoes which arrived
+        """
+        readable, _, _ = select.select([self.__sock], [], [], max(0.0, min(timeout, POLL_INTERVAL)))
+        if not readable:
+            return
+        while True:
+            try:
+                length: int = self.__sock.recv_into(self.__buffer)
+            except (BlockingIOError, ConnectionRefusedError):
+                return
+            now: int = time.monotonic_ns()
+            try:
+                sequence, timestamp = protocol.unpack_probe_reply(memoryview(self.__buffer)[:length])
+            except protocol.ProtocolError as e:
+                logger.error(f'Error: received invalid probe reply: {e}')
+                continue
+            if sequence >= self.sent:
+                logger.error(f'Error: received a reply to probe {sequence}, which was never sent')
+                continue
+            self.__record(sequence, now - timestamp)
+
+    def __record(self, sequence: int, rtt: int) -> None:
+        if sequence < self.__highest_sequence:
+            self.reordered += 1
+        self.__highest_sequence = max(self.__highest_sequence, sequence)
+        self.received += 1
+        self.histogram.record(rtt)
+        if self.__last_rtt is not None:
+            self.jitter += (abs(rtt - self.__last_rtt) - self.jitter) / 16
+        self.__last_rtt = rtt
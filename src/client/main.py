@@ -1,21 +1,42 @@
+import argparse
+import os
+import re
 import sys
 import threading
 
+# the wire format and the transfer engines are shared by the server and the client
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common'))
+
 import logger
-from client import Client
+import protocol
+import teacup_gen
+from client import Client, RECV_BUFFER_SIZE, ENGINE_THREADS, ENGINE_ASYNCIO
+from discovery import ServerInfo, SERVER_ORDERS, ORDER_ARRIVAL, DEFAULT_SERVER_TTL
+from latency import DEFAULT_PROBE_DURATION
+from results import ResultsWriter, FORMAT_JSONL, FORMAT_CSV
 
-PORT_IDX = 1
+# exit codes of the non-interactive mode
+EXIT_SUCCESS = 0
+EXIT_TRANSFER_FAILED = 1
+# argparse exits with 2 on invalid arguments
+EXIT_NO_SERVER = 3
+EXIT_TIMEOUT = 4
+# seconds to wait for an offer in the non-interactive mode, when no server is given
+DEFAULT_DISCOVERY_TIMEOUT = 10.0
+SIZE_UNITS = {'': 1, 'K': 1024, 'M': 1024 * 1024, 'G': 1024 * 1024 * 1024}
+SIZE_PATTERN = re.compile(r'^(\d+)\s*([KMG]?)(?:I?B)?$')
 
 def main() -> None:
-    port: int
+    args: argparse.Namespace = parse_args()
+    logger.configure(args.log_level, args.log_format, args.log_file)
+    if args.no_animation or args.size is not None:
+        teacup_gen.disable()
+    if args.size is not None:
+        sys.exit(run_batch(args))
+
     data_size: int
     tcp_connections_num: int
     udp_connections_num: int
-    try:
-        port = int(sys.argv[PORT_IDX])
-    except Exception:
-        logger.error("Invalid command line argument, missing port number.")
-        return
 
     # Gets the data size, TCP connections number and UDP connections number from the user
     data_size = get_data_size()
@@ -23,12 +44,191 @@ def main() -> None:
     udp_connections_num = get_connections_num("UDP")
 
     # Initializes the client
-    client = Client(port, data_size, tcp_connections_num, udp_connections_num)
+    client = build_client(args, data_size, tcp_connections_num, udp_connections_num)
     # Runs the client
     logger.info('Starting client. Press any key to terminate')
     threading.Thread(target=client.run, args=()).start()
     threading.Thread(target=shutdown, args=(client, )).start()
 
+def run_batch(args: argparse.Namespace) -> int:
+    """
+    Runs the requested rounds against the given servers, the first server to offer, or
+    every server offering during the discovery timeout, without any user input.
+    Returns the exit code
+    """
+    client: Client = build_client(args, args.size, args.tcp, args.udp)
+    try:
+        servers: list[ServerInfo] = [ServerInfo(*server, now=0.0) for server in args.server]
+        if not servers:
+            servers = client.discover_servers(args.discovery_timeout, args.fleet)
+            if not servers:
+                logger.error(f'No offer received within {args.discovery_timeout} seconds')
+                return EXIT_NO_SERVER
+        try:
+            succeeded: bool = client.run_rounds(servers, args.rounds, args.warmup, args.timeout)
+        except TimeoutError as e:
+            logger.error(f'Error: {e}')
+            return EXIT_TIMEOUT
+        if not succeeded:
+            logger.error('Some of the transfers failed')
+            return EXIT_TRANSFER_FAILED
+        logger.info('All rounds complete')
+        return EXIT_SUCCESS
+    finally:
+        client.close_results()
+
+def build_client(args: argparse.Namespace, data_size: int, tcp_connections_num: int,
+                 udp_connections_num: int) -> Client:
+    results: ResultsWriter | None = None
+    if args.output is not None:
+        results = ResultsWriter(args.output, args.format)
+    return Client(args.port, data_size, tcp_connections_num, udp_connections_num,
+                  recv_buffer_size=args.recv_buffer, socket_rcvbuf=args.rcvbuf, discard=args.discard,
+                  engine=args.engine, results=results, interval=args.interval,
+                  max_concurrent_servers=args.parallel_servers, server_order=args.server_order,
+                  server_ttl=args.server_ttl, max_payload_size=args.max_payload, reliable=args.reliable,
+                  direction=args.direction, verify=args.verify, stripe=args.stripe,
+                  stripe_output=args.stripe_output, probe_rate=args.probe_rate,
+                  probe_duration=args.probe_duration)
+
+def parse_args() -> argparse.Namespace:
+    """
+    Parses the client's command line arguments
+    """
+    parser: argparse.ArgumentParser = argparse.ArgumentParser(
+        description='Speed test client. Runs interactively, unless --size is given')
+    parser.add_argument('port', type=int, help='port to listen for offers on')
+    parser.add_argument('--recv-buffer', type=positive_int, default=RECV_BUFFER_SIZE,
+                        help='size in bytes of the buffer each TCP connection receives into')
+    parser.add_argument('--rcvbuf', type=non_negative_int, default=0,
+                        help='SO_RCVBUF in bytes for TCP connections (default: system default)')
+    parser.add_argument('--discard', action='store_true',
+                        help='discard TCP payloads without copying them, to measure only the network')
+    parser.add_argument('--engine', choices=[ENGINE_THREADS, ENGINE_ASYNCIO], default=ENGINE_THREADS,
+                        help='run the transfers in a thread per connection, or all in one asyncio event loop')
+    parser.add_argument('--interval', type=float, default=0.0,
+                        help='report the throughput of every interval of this many seconds (e.g. 0.1)')
+    parser.add_argument('--max-payload', type=payload_size, default=protocol.MAX_PAYLOAD_SIZE,
+                        help='largest UDP payload to accept per datagram, the server sends less when the path MTU '
+                             f'is smaller (default and maximum: {protocol.MAX_PAYLOAD_SIZE})')
+    parser.add_argument('--reliable', action='store_true',
+                        help='make UDP transfers reliable: the missing segments are reported and sent again, '
+                             'and the goodput and retransmissions are reported')
+    parser.add_argument('--direction', choices=[protocol.DIRECTION_DOWNLOAD, protocol.DIRECTION_UPLOAD,
+                                                protocol.DIRECTION_BOTH], default=protocol.DIRECTION_DOWNLOAD,
+                        help='download from the server, upload to it, or both at once over every connection '
+                             f'(default: {protocol.DIRECTION_DOWNLOAD})')
+    parser.add_argument('--verify', action='store_true',
+                        help='have the server send a pseudo-random pattern, seeded per transfer, and check every '
+                             'downloaded byte against it, reporting the offsets of mismatched data')
+    parser.add_argument('--stripe', action='store_true',
+                        help='download a single file of the requested size over all the TCP connections together, '
+                             'each requesting a byte range of it, and report the aggregate time and the skew '
+                             'between the streams. The file is reassembled in memory')
+    parser.add_argument('--stripe-output',
+                        help='reassemble the striped file into this memory-mapped file instead of memory')
+    parser.add_argument('--probe-rate', type=non_negative_float, default=0.0,
+                        help='measure the round trip to the server with this many UDP probes per second, while '
+                             'the transfers run, and report its percentiles and jitter (default: 0, disabled)')
+    parser.add_argument('--probe-duration', type=non_negative_float, default=DEFAULT_PROBE_DURATION,
+                        help='seconds to probe for when no transfers run, i.e. with --tcp 0 --udp 0 '
+                             f'(default: {DEFAULT_PROBE_DURATION:g})')
+    parser.add_argument('--output', help='file to export the results of every transfer to')
+    parser.add_argument('--format', choices=[FORMAT_JSONL, FORMAT_CSV], default=FORMAT_JSONL,
+                        help='format of the exported results (default: JSON Lines)')
+    parser.add_argument('--log-level', choices=list(logger.LEVELS), default='debug',
+                        help='lowest level of the messages written (default: debug)')
+    parser.add_argument('--log-file', help='append the log to this file instead of the standard output')
+    parser.add_argument('--log-format', choices=[logger.FORMAT_PLAIN, logger.FORMAT_JSON], default=logger.FORMAT_PLAIN,
+                        help='format of the log file (default: plain)')
+    parser.add_argument('--no-animation', action='store_true',
+                        help='never show the idle animation (it is only shown on a terminal anyway)')
+    parser.add_argument('--parallel-servers', type=positive_int, default=1,
+                        help='amount of servers to test at the same time (default: 1)')
+    parser.add_argument('--server-order', choices=SERVER_ORDERS, default=ORDER_ARRIVAL,
+                        help='which waiting server is tested first: the first to offer, the lowest address, '
+                             f'or the least recently tested (default: {ORDER_ARRIVAL})')
+    parser.add_argument('--server-ttl', type=float, default=DEFAULT_SERVER_TTL,
+                        help='seconds a server is kept without sending offers (default: '
+                             f'{DEFAULT_SERVER_TTL:g})')
+
+    batch = parser.add_argument_group('non-interactive mode')
+    batch.add_argument('--size', type=parse_size,
+                       help='bytes to request per connection, with an optional K/M/G suffix (e.g. 10M), '
+                            'runs the client without user input')
+    batch.add_argument('--tcp', type=non_negative_int, default=1, help='amount of TCP connections (default: 1)')
+    batch.add_argument('--udp', type=non_negative_int, default=1, help='amount of UDP connections (default: 1)')
+    batch.add_argument('--rounds', type=non_negative_int, default=1, help='measured rounds to run (default: 1)')
+    batch.add_argument('--warmup', type=non_negative_int, default=0,
+                       help='rounds to run before the measured rounds, which are not exported (default: 0)')
+    batch.add_argument('--timeout', type=float, default=None,
+                       help='seconds a single round may take before the client gives up')
+    batch.add_argument('--server', type=parse_server, action='append', default=[],
+                       help='HOST:UDP_PORT:TCP_PORT of a server, instead of waiting for an offer; '
+                            'may be given more than once')
+    batch.add_argument('--discovery-timeout', type=float, default=DEFAULT_DISCOVERY_TIMEOUT,
+                       help=f'seconds to wait for an offer (default: {DEFAULT_DISCOVERY_TIMEOUT:g})')
+    batch.add_argument('--fleet', action='store_true',
+                       help='collect offers for the whole discovery timeout and test every server found')
+    args: argparse.Namespace = parser.parse_args()
+    if args.engine == ENGINE_ASYNCIO and args.direction != protocol.DIRECTION_DOWNLOAD:
+        parser.error(f'the {ENGINE_ASYNCIO} engine only supports downloads')
+    if args.verify and args.engine == ENGINE_ASYNCIO:
+        parser.error(f'--verify is not supported by the {ENGINE_ASYNCIO} engine')
+    if args.verify and args.discard:
+        parser.error('--verify needs the payload that --discard drops')
+    if args.verify and args.direction == protocol.DIRECTION_UPLOAD:
+        parser.error('--verify checks downloaded payload, and an upload downloads none')
+    if args.stripe and (args.direction != protocol.DIRECTION_DOWNLOAD or args.engine == ENGINE_ASYNCIO):
+        parser.error(f'--stripe only supports downloads with the {ENGINE_THREADS} engine')
+    if args.stripe and args.discard:
+        parser.error('--stripe reassembles the payload that --discard drops')
+    if args.stripe_output is not None and not args.stripe:
+        parser.error('--stripe-output needs --stripe')
+    return args
+
+def parse_size(value: str) -> int:
+    """
+    Parses a size such as 1000, 64K, 10M, 2GB or 1GiB - units are powers of 1024
+    """
+    match: re.Match | None = SIZE_PATTERN.match(value.strip().upper())
+    if match is None:
+        raise argparse.ArgumentTypeError(f'invalid size: {value}')
+    return int(match.group(1)) * SIZE_UNITS[match.group(2)]
+
+def parse_server(value: str) -> tuple[str, int, int]:
+    """
+    Parses a HOST:UDP_PORT:TCP_PORT server address
+    """
+    parts: list[str] = value.rsplit(':', 2)
+    if len(parts) != 3 or not parts[0] or not parts[1].isdigit() or not parts[2].isdigit():
+        raise argparse.ArgumentTypeError(f'expected HOST:UDP_PORT:TCP_PORT, got: {value}')
+    return parts[0], int(parts[1]), int(parts[2])
+
+def payload_size(value: str) -> int:
+    if not value.isdigit() or not 0 < int(value) <= protocol.MAX_PAYLOAD_SIZE:
+        raise argparse.ArgumentTypeError(f'expected a payload size of 1-{protocol.MAX_PAYLOAD_SIZE} bytes, got: {value}')
+    return int(value)
+
+def positive_int(value: str) -> int:
+    if not value.isdigit() or int(value) == 0:
+        raise argparse.ArgumentTypeError(f'expected a positive number, got: {value}')
+    return int(value)
+
+def non_negative_int(value: str) -> int:
+    if not value.isdigit():
+        raise argparse.ArgumentTypeError(f'expected a non-negative number, got: {value}')
+    return int(value)
+
+def non_negative_float(value: str) -> float:
+    try:
+        number: float = float(value)
+    except ValueError:
+        number = -1.0
+    if not 0 <= number < float('inf'):
+        raise argparse.ArgumentTypeError(f'expected a non-negative number, got: {value}')
+    return number
+
 def shutdown(client: Client) -> None:
     """
     Listens for user input and then shuts down the client
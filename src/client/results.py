@@ -0,0 +1,272 @@
+import csv
+import json
+import math
+import queue
+import statistics
+import threading
+from typing import TextIO
+
+import logger
+
+FORMAT_JSONL = 'jsonl'
+FORMAT_CSV = 'csv'
+RECORD_TRANSFER = 'transfer'
+RECORD_SUMMARY = 'summary'
+RECORD_LATENCY = 'latency'
+# every column a CSV row may have, transfers and round summaries alike
+CSV_FIELDS = ['record_type', 'round', 'protocol', 'direction', 'connection_num', 'server_addr', 'bytes',
+              'duration', 'bits_per_second', 'loss_percent', 'start_time', 'end_time', 'intervals', 'connections',
+              'total_bytes', 'wall_time', 'aggregate_bits_per_second', 'min_bits_per_second',
+              'median_bits_per_second', 'p95_bits_per_second', 'p99_bits_per_second', 'completion_skew',
+              'goodput_bits_per_second', 'retransmission_percent', 'verified_bytes', 'mismatched_pieces',
+              'mismatch_offsets', 'probes_sent', 'probes_received', 'probes_reordered', 'rtt_min', 'rtt_mean',
+              'rtt_p50', 'rtt_p99', 'rtt_p999', 'rtt_max', 'jitter']
+
+
+class _EndRound:
+    """
+    Marks the end of an offer round with a server in the writer queue
+    """
+    server_addr: str | None
+
+    def __init__(self, server_addr: str | None):
+        self.server_addr = server_addr
+
+
+class TransferRecord:
+    """
+    The results of a single TCP or UDP transfer, in one direction.
+    Timestamps are seconds since the epoch
+    """
+    protocol: str
+    connection_num: int
+    server_addr: str
+    bytes: int
+    duration: float
+    bits_per_second: float
+    loss_percent: float
+    start_time: float
+    end_time: float
+    intervals: list[tuple[float, float, int]] | None
+    goodput_bits_per_second: float | None
+    retransmission_percent: float | None
+    direction: str
+    verified_bytes: int | None
+    mismatched_pieces: int | None
+    mismatch_offsets: list[int] | None
+
+    def __init__(self, protocol: str, connection_num: int, server_addr: str, bytes: int, duration: float,
+                 bits_per_second: float, loss_percent: float, start_time: float, end_time: float,
+                 intervals: list[tuple[float, float, int]] | None = None,
+                 goodput_bits_per_second: float | None = None, retransmission_percent: float | None = None,
+                 direction: str = 'download', verified_bytes: int | None = None, mismatched_pieces: int | None = None,
+                 mismatch_offsets: list[int] | None = None):
+        self.protocol = protocol
+        self.connection_num = connection_num
+        self.server_addr = server_addr
+        self.bytes = bytes
+        self.duration = duration
+        self.bits_per_second = bits_per_second
+        self.loss_percent = loss_percent
+        self.start_time = start_time
+        self.end_time = end_time
+        # (start, end, bytes) of every sampled interval, in seconds since the transfer started
+        self.intervals = intervals
+        # reliable UDP transfers only: the rate of the unique payload, and the retransmitted segments
+        self.goodput_bits_per_second = goodput_bits_per_second
+        self.retransmission_percent = retransmission_percent
+        # uploads are measured by the server, which reports its receive rate back
+        self.direction = direction
+        # verified downloads only: how much payload was checked against the pattern, and where it was wrong
+        self.verified_bytes = verified_bytes
+        self.mismatched_pieces = mismatched_pieces
+        self.mismatch_offsets = mismatch_offsets
+
+    def to_dict(self, round_num: int) -> dict:
+        row: dict = {'record_type': RECORD_TRANSFER, 'round': round_num, 'protocol': self.protocol,
+                     'direction': self.direction, 'connection_num': self.connection_num,
+                     'server_addr': self.server_addr, 'bytes': self.bytes,
+                     'duration': self.duration, 'bits_per_second': self.bits_per_second,
+                     'loss_percent': self.loss_percent, 'start_time': self.start_time, 'end_time': self.end_time}
+        if self.intervals is not None:
+            row['intervals'] = [list(sample) for sample in self.intervals]
+        if self.goodput_bits_per_second is not None:
+            row['goodput_bits_per_second'] = self.goodput_bits_per_second
+            row['retransmission_percent'] = self.retransmission_percent
+        if self.verified_bytes is not None:
+            row['verified_bytes'] = self.verified_bytes
+            row['mismatched_pieces'] = self.mismatched_pieces
+            row['mismatch_offsets'] = self.mismatch_offsets
+        return row
+
+
+class LatencyRecord:
+    """
+    The round trips measured by the probes sent to a server during an offer round.
+    Latencies are in seconds, timestamps are seconds since the epoch
+    """
+    server_addr: str
+    probes_sent: int
+    probes_received: int
+    probes_reordered: int
+    start_time: float
+    end_time: float
+    rtt_min: float
+    rtt_mean: float
+    rtt_p50: float
+    rtt_p99: float
+    rtt_p999: float
+    rtt_max: float
+    jitter: float
+
+    def __init__(self, server_addr: str, probes_sent: int, probes_received: int, probes_reordered: int,
+                 start_time: float, end_time: float, rtt_min: float, rtt_mean: float, rtt_p50: float,
+                 rtt_p99: float, rtt_p999: float, rtt_max: float, jitter: float):
+        self.server_addr = server_addr
+        self.probes_sent = probes_sent
+        self.probes_received = probes_received
+        self.probes_reordered = probes_reordered
+        self.start_time = start_time
+        self.end_time = end_time
+        self.rtt_min = rtt_min
+        self.rtt_mean = rtt_mean
+        self.rtt_p50 = rtt_p50
+        self.rtt_p99 = rtt_p99
+        self.rtt_p999 = rtt_p999
+        self.rtt_max = rtt_max
+        self.jitter = jitter
+
+    def to_dict(self, round_num: int) -> dict:
+        loss_percent: float = 0.0 if self.probes_sent == 0 else \
+            max(0.0, 100 - 100 * self.probes_received / self.probes_sent)
+        return {'record_type': RECORD_LATENCY, 'round': round_num, 'protocol': 'UDP',
+                'server_addr': self.server_addr, 'probes_sent': self.probes_sent,
+                'probes_received': self.probes_received, 'probes_reordered': self.probes_reordered,
+                'loss_percent': loss_percent, 'start_time': self.start_time, 'end_time': self.end_time,
+                'duration': self.end_time - self.start_time, 'rtt_min': self.rtt_min, 'rtt_mean': self.rtt_mean,
+                'rtt_p50': self.rtt_p50, 'rtt_p99': self.rtt_p99, 'rtt_p999': self.rtt_p999,
+                'rtt_max': self.rtt_max, 'jitter': self.jitter}
+
+
+def percentile(sorted_values: list[float], percent: float) -> float:
+    """
+    Returns the nearest-rank percentile of an ascending, non-empty list
+    """
+    rank: int = max(1, math.ceil(percent / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+def summarize_round(round_num: int, records: list[TransferRecord]) -> dict:
+    """
+    Summarizes the transfers of one offer round: the aggregate rate over the wall-clock
+    span of the round, the distribution of the per-connection rates, and the seconds
+    between the first and the last transfer to finish
+    """
+    start_time: float = min(record.start_time for record in records)
+    end_time: float = max(record.end_time for record in records)
+    wall_time: float = end_time - start_time
+    total_bytes: int = sum(record.bytes for record in records)
+    rates: list[float] = sorted(record.bits_per_second for record in records)
+    return {'record_type': RECORD_SUMMARY, 'round': round_num, 'server_addr': records[0].server_addr,
+            'connections': len(records), 'total_bytes': total_bytes, 'start_time': start_time,
+            'end_time': end_time, 'wall_time': wall_time,
+            'aggregate_bits_per_second': float('inf') if wall_time == 0 else 8 * total_bytes / wall_time,
+            'min_bits_per_second': rates[0], 'median_bits_per_second': statistics.median(rates),
+            'p95_bits_per_second': percentile(rates, 95), 'p99_bits_per_second': percentile(rates, 99),
+            'completion_skew': end_time - min(record.end_time for record in records)}
+
+
+class ResultsWriter:
+    """
+    Writes transfer and latency records, and a summary of the transfers at the end of
+    every offer round, to a JSON Lines or CSV file.
+    Records are handed to a background thread through a queue, so the receiving threads
+    never wait for the file
+    """
+    __file: TextIO
+    __format: str
+    __csv_writer: csv.DictWriter | None
+    __queue: queue.SimpleQueue
+    __thread: threading.Thread
+    __round_num: int
+    __round_records: dict[str, list[TransferRecord]]
+    __open_rounds: dict[str, int]
+
+    def __init__(self, path: str, format: str = FORMAT_JSONL):
+        self.__file = open(path, 'w', newline='')
+        self.__format = format
+        self.__csv_writer = None
+        if format == FORMAT_CSV:
+            self.__csv_writer = csv.DictWriter(self.__file, fieldnames=CSV_FIELDS, restval='')
+            self.__csv_writer.writeheader()
+        self.__queue = queue.SimpleQueue()
+        self.__round_num = 1
+        self.__round_records = {}
+        # rounds of different servers may overlap, so each server's round gets its number
+        # when its first record arrives
+        self.__open_rounds = {}
+        self.__thread = threading.Thread(target=self.__write_loop, daemon=True)
+        self.__thread.start()
+
+    def add(self, record: TransferRecord | LatencyRecord) -> None:
+        """
+        Queues a transfer or latency record to be written
+        """
+        self.__queue.put(record)
+
+    def end_round(self, server_addr: str | None = None) -> None:
+        """
+        Marks the end of an offer round with a server: the summary of the transfers from the
+        server's address added since its previous round is written after them.
+        Without a server address, the round of every server ends
+        """
+        self.__queue.put(_EndRound(server_addr))
+
+    def close(self) -> None:
+        """
+        Writes all the queued records and closes the file
+        """
+        self.__queue.put(None)
+        self.__thread.join()
+        self.__file.close()
+
+    def __write_loop(self) -> None:
+        while True:
+            item: TransferRecord | LatencyRecord | _EndRound | None = self.__queue.get()
+            if item is None:
+                return
+            try:
+                if isinstance(item, _EndRound):
+                    servers: list[str] = list(self.__round_records) if item.server_addr is None \
+                        else [item.server_addr]
+                    for server_addr in servers:
+                        records: list[TransferRecord] = self.__round_records.pop(server_addr, [])
+                        if records:
+                            self.__write_row(summarize_round(self.__open_rounds.pop(server_addr), records))
+                    self.__file.flush()
+                elif isinstance(item, LatencyRecord):
+                    # part of the server's round when it has transfers, but never of its summary
+                    round_num: int | None = self.__open_rounds.get(item.server_addr)
+                    if round_num is None:
+                        round_num = self.__round_num
+                        self.__round_num += 1
+                    self.__write_row(item.to_dict(round_num))
+                else:
+                    if item.server_addr not in self.__open_rounds:
+                        self.__open_rounds[item.server_addr] = self.__round_num
+                        self.__round_num += 1
+                    self.__round_records.setdefault(item.server_addr, []).append(item)
+                    self.__write_row(item.to_dict(self.__open_rounds[item.server_addr]))
+            except (OSError, ValueError) as e:
+                logger.error(f'Failed to write results: {e}')
+
+    def __write_row(self, row: dict) -> None:
+        if self.__csv_writer is not None:
+            if 'intervals' in row:
+                # a single cell holds the whole time series
+                row['intervals'] = json.dumps(row['intervals'])
+            if 'mismatch_offsets' in row:
+                row['mismatch_offsets'] = json.dumps(row['mismatch_offsets'])
+            self.__csv_writer.writerow(row)
+        else:
+            self.__file.write(json.dumps(row) + '\n')
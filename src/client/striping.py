@@ -0,0 +1,132 @@
+import mmap
+import socket
+from typing import BinaryIO
+
+from payload import RECV_BUFFER_SIZE
+
+
+class Stripe:
+    """
+    The byte range of a striped file which a single TCP connection downloads. Like
+    PayloadSink, receives one chunk at a time - but straight into the range's place in
+    the file, so the file is reassembled without copying
+    """
+    __view: memoryview
+    __chunk_size: int
+    __received: int
+    __last_chunk: int
+    offset: int
+    length: int
+    seed: int | None
+    start_time: float
+    end_time: float
+
+    def __init__(self, view: memoryview, offset: int, seed: int | None, chunk_size: int):
+        self.__view = view
+        self.__chunk_size = chunk_size
+        self.__received = 0
+        self.__last_chunk = 0
+        self.offset = offset
+        self.length = len(view)
+        self.seed = seed
+        self.start_time = 0.0
+        self.end_time = 0.0
+
+    def receive_chunk(self, sock: socket.socket, bytes_left: int) -> int:
+        """
+        Receives up to one chunk of the range, but no more than bytes_left, in a single call.
+        Raises ConnectionError if the connection is closed first.
+        Returns the amount of bytes received
+        """
+        self.__last_chunk = self.__received
+        received: int = sock.recv_into(self.__view[self.__received:], min(self.__chunk_size, bytes_left))
+        if received == 0:
+            raise ConnectionError('connection closed before the whole range arrived')
+        self.__received += received
+        return received
+
+    def received(self, length: int) -> memoryview:
+        """
+        Returns the bytes of the last chunk received
+        """
+        return self.__view[self.__last_chunk:self.__last_chunk + length]
+
+    def fill(self, data: bytes | bytearray) -> None:
+        """
+        Stores bytes of the range which were received apart from its chunks
+        """
+        self.__view[self.__received:self.__received + len(data)] = data
+        self.__received += len(data)
+
+    def complete(self) -> bool:
+        return self.__received == self.length
+
+    def release(self) -> None:
+        self.__view.release()
+
+
+class StripedFile:
+    """
+    A single file downloaded as byte ranges over several TCP connections at once.
+    The ranges are received into one preallocated buffer: an anonymous memory map or,
+    when an output path is given, a memory-mapped file. A verified file uses one seed
+    for all of its ranges, so each range is checked at its offset of the same pattern
+    """
+    __map: mmap.mmap | None
+    __file: BinaryIO | None
+    __view: memoryview
+    size: int
+    seed: int | None
+    stripes: list[Stripe]
+
+    def __init__(self, size: int, stripes_amount: int, path: str | None = None, seed: int | None = None,
+                 chunk_size: int = RECV_BUFFER_SIZE):
+        self.size = size
+        self.seed = seed
+        self.__file = None
+        self.__map = None
+        if path is not None:
+            self.__file = open(path, 'w+b')
+            self.__file.truncate(size)
+        # an empty file cannot be mapped
+        if size > 0:
+            self.__map = mmap.mmap(-1 if self.__file is None else self.__file.fileno(), size)
+        self.__view = memoryview(self.__map if self.__map is not None else bytearray())
+
+        # the first size % stripes_amount ranges are a byte longer than the rest
+        stripe_len, longer_stripes = divmod(size, stripes_amount)
+        self.stripes = []
+        offset: int = 0
+        for idx in range(stripes_amount):
+            length: int = stripe_len + (1 if idx < longer_stripes else 0)
+            self.stripes.append(Stripe(self.__view[offset:offset + length], offset, seed, chunk_size))
+            offset += length
+
+    def complete(self) -> bool:
+        return all(stripe.complete() for stripe in self.stripes)
+
+    def completion_time(self) -> float:
+        """
+        Returns the seconds from the first range starting until the last range finished
+        """
+        return max(stripe.end_time for stripe in self.stripes) - min(stripe.start_time for stripe in self.stripes)
+
+    def skew(self) -> float:
+        """
+        Returns the seconds between the first and the last range to finish
+        """
+        return max(stripe.end_time for stripe in self.stripes) - min(stripe.end_time for stripe in self.stripes)
+
+    def close(self) -> None:
+        """
+        Unmaps the buffer, writing it to the output file if there is one
+        """
+        for stripe in self.stripes:
+            stripe.release()
+        self.__view.release()
+        if self.__map is not None:
+            if self.__file is not None:
+                self.__map.flush()
+            self.__map.close()
+        if self.__file is not None:
+            self.__file.close()
@@ -0,0 +1,101 @@
+import socket
+import threading
+import time
+
+import logger
+from protocol import MSG_READY, MSG_REPORT, ProtocolError, message_type_of, unpack_ready, unpack_report
+from udp_sender import UdpSegmentSender, UdpSendReport, send_buffer_size
+
+# seconds the server has to answer an upload request with its ready message
+READY_TIMEOUT = 3.0
+# seconds the server has to report an upload once it was sent; the server itself waits
+# a second for late segments before reporting
+REPORT_TIMEOUT = 3.0
+UDP_SNDBUF_SIZE = 4 * 1024 * 1024
+
+
+class UdpUploader:
+    """
+    The upload side of a UDP transfer. Once the server's ready message tells which port
+    to upload to, and in segments of which payload size, sends the payload segments from a thread of its own, over the socket
+    the server's messages arrive on, and then waits for the server's report of the upload.
+    The receiving thread hands the server's messages over with handle_message
+    """
+    __sock: socket.socket
+    __server_addr: str
+    __file_size: int
+    __max_payload_size: int
+    __thread: threading.Thread | None
+    __deadline: float
+    segments_amount: int
+    send_report: UdpSendReport
+    start_time: float
+    report: tuple[int, int, int] | None
+
+    def __init__(self, sock: socket.socket, server_addr: str, file_size: int, max_payload_size: int):
+        self.__sock = sock
+        self.__server_addr = server_addr
+        self.__file_size = file_size
+        self.__max_payload_size = max_payload_size
+        self.__thread = None
+        self.__deadline = time.monotonic() + READY_TIMEOUT
+        self.segments_amount = 0
+        self.send_report = UdpSendReport()
+        self.start_time = 0.0
+        self.report = None
+
+    def handle_message(self, message: memoryview) -> bool:
+        """
+        Handles a ready or report message of the server.
+        Returns whether the message was one of them
+        """
+        message_type: int | None = message_type_of(message)
+        try:
+            if message_type == MSG_READY:
+                port, payload_size = unpack_ready(message)
+                if payload_size > self.__max_payload_size:
+                    raise ProtocolError(f'upload payload size {payload_size} is larger than the '
+                                        f'{self.__max_payload_size} bytes requested')
+                # the server repeats its ready message, in case some are lost
+                if self.__thread is None:
+                    self.__deadline = float('inf')
+                    self.__thread = threading.Thread(target=self.__send,
+                                                     args=((self.__server_addr, port), payload_size))
+                    self.__thread.start()
+                return True
+            if message_type == MSG_REPORT:
+                if self.report is None:
+                    self.report = unpack_report(message)
+                return True
+        except ProtocolError as e:
+            logger.error(f'Error: received an invalid message from the server: {e}')
+            return True
+        return False
+
+    def pending(self) -> bool:
+        """
+        Returns whether the server's report is still awaited, until the server is too late
+        """
+        return self.report is None and time.monotonic() < self.__deadline
+
+    def join(self) -> None:
+        if self.__thread is not None:
+            self.__thread.join()
+
+    def __send(self, address: tuple[str, int], payload_size: int) -> None:
+        """
+        Sends the upload in segments of the payload size the server announced - the server
+        drops segments of any other size
+        """
+        try:
+            self.__sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, send_buffer_size(payload_size,
+                                                                                         UDP_SNDBUF_SIZE))
+            sender: UdpSegmentSender = UdpSegmentSender(self.__sock, address, self.__file_size, payload_size)
+            self.segments_amount = sender.segments_amount
+            logger.debugging(f'Uploading {self.__file_size} bytes to server {address[0]}:{address[1]} in '
+                             f'{sender.segments_amount} segments of {payload_size} bytes via UDP.')
+            self.start_time = time.time()
+            self.send_report = sender.send_all()
+        except OSError as e:
+            logger.error(f'Failed to upload to server: {e}')
+        self.__deadline = time.monotonic() + REPORT_TIMEOUT
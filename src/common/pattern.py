@@ -0,0 +1,105 @@
+import random
+
+# period of the verifiable payload: the byte at offset o of a transfer seeded with s is
+# PATTERN[(s + o) % PATTERN_SIZE]
+PATTERN_SIZE = 1 << 18
+# the pattern itself never changes, so both sides build the same one
+PATTERN_SOURCE_SEED = 0x5eed
+# most offsets of mismatched data a verifier keeps
+MAX_MISMATCHES = 16
+
+
+def build_pattern() -> bytes:
+    """
+    Builds the pseudo-random pattern, stored twice in a row so every window of up to
+    PATTERN_SIZE bytes, starting anywhere in the period, is a contiguous slice
+    """
+    period: bytes = random.Random(PATTERN_SOURCE_SEED).randbytes(PATTERN_SIZE)
+    return period + period
+
+
+PATTERN: bytes = build_pattern()
+
+
+def new_seed() -> int:
+    """
+    Returns a random seed for a transfer: where in the pattern its payload starts
+    """
+    return random.randrange(PATTERN_SIZE)
+
+
+def pattern_position(seed: int, offset: int) -> int:
+    """
+    Returns where the byte at the offset of a transfer is in the pattern
+    """
+    return (seed + offset) % PATTERN_SIZE
+
+
+class PayloadVerifier:
+    """
+    Checks received payload against the pattern of its transfer, piece by piece as it
+    arrives, at any offset. Every piece is compared in place with bytes.startswith, which
+    runs at memcmp speed without copying; only a mismatching piece is searched for the
+    offset of its first wrong byte
+    """
+    __seed: int
+    bytes_checked: int
+    mismatched_pieces: int
+    # offsets of the first wrong byte of the first MAX_MISMATCHES mismatching pieces
+    mismatches: list[int]
+
+    def __init__(self, seed: int):
+        self.__seed = seed
+        self.bytes_checked = 0
+        self.mismatched_pieces = 0
+        self.mismatches = []
+
+    def check(self, data: memoryview, offset: int) -> bool:
+        """
+        Checks payload received at the offset of the transfer.
+        Returns whether it matches the pattern
+        """
+        matched: bool = True
+        start: int = 0
+        while start < len(data):
+            piece: memoryview = data[start:start + PATTERN_SIZE]
+            position: int = pattern_position(self.__seed, offset + start)
+            if not PATTERN.startswith(piece, position):
+                matched = False
+                self.__record_mismatch(offset + start + PayloadVerifier.__first_difference(piece, position))
+            start += len(piece)
+        self.bytes_checked += len(data)
+        return matched
+
+    def verified(self) -> bool:
+        return self.mismatched_pieces == 0
+
+    def __record_mismatch(self, offset: int) -> None:
+        self.mismatched_pieces += 1
+        if len(self.mismatches) < MAX_MISMATCHES:
+            self.mismatches.append(offset)
+
+    @staticmethod
+    def __first_difference(piece: memoryview, position: int) -> int:
+        """
+        Binary searches the longest matching prefix of a mismatching piece.
+        Returns the index of its first wrong byte
+        """
+        low: int = 0
+        high: int = len(piece)
+        # the first low bytes match, and the first high bytes do not
+        while high - low > 1:
+            middle: int = (low + high) // 2
+            if PATTERN.startswith(piece[:middle], position):
+                low = middle
+            else:
+                high = middle
+        return low
+
+    def __str__(self) -> str:
+        if self.verified():
+            return f'{self.bytes_checked} bytes verified'
+        offsets: str = ', '.join(str(offset) for offset in self.mismatches)
+        more: str = '' if self.mismatched_pieces <= len(self.mismatches) else ', ...'
+        return (f'{self.mismatched_pieces} mismatched pieces in {self.bytes_checked} bytes, '
+                f'first wrong bytes at offsets {offsets}{more}')
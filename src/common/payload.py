@@ -0,0 +1,172 @@
+import os
+import socket
+
+from pattern import PATTERN, PATTERN_SIZE, pattern_position
+
+PAYLOAD_BYTE = b'a'
+# Size of the reusable payload buffer, which is also the most data handed to a single send call
+PAYLOAD_BUFFER_SIZE = 1 << 20
+# size of the buffer payload is received into, and the most data taken by a single receive call
+RECV_BUFFER_SIZE = 256 * 1024
+# received data is dropped by the kernel without being copied (Linux)
+DISCARD_FLAGS = getattr(socket, 'MSG_TRUNC', 0)
+
+
+class SendReport:
+    """
+    Progress of a single payload transfer: how many bytes were sent, in how many
+    send system calls, and whether sendfile can be used for it.
+    A transfer with a seed sends the verifiable pattern instead of the constant payload
+    """
+    bytes_sent: int
+    calls: int
+    use_sendfile: bool
+    seed: int | None
+
+    def __init__(self, seed: int | None = None):
+        self.bytes_sent = 0
+        self.calls = 0
+        self.use_sendfile = True
+        self.seed = seed
+
+    def bytes_per_call(self) -> float:
+        return 0.0 if self.calls == 0 else self.bytes_sent / self.calls
+
+    def __str__(self) -> str:
+        return f'{self.bytes_sent} bytes in {self.calls} send calls ({self.bytes_per_call():.0f} bytes/call)'
+
+
+class PayloadEngine:
+    """
+    Sends payload data to TCP clients out of a single preallocated buffer, shared by
+    all transfers.
+    When the platform supports it, the buffer is mirrored into an in-memory file and
+    sent with sendfile, so the payload bytes never pass through the interpreter.
+    Otherwise, memoryview slices of the buffer are sent with sendall (or send, on
+    non-blocking sockets).
+    With the pattern enabled, transfers with a seed are sent the same way out of the
+    shared, doubled pattern, starting wherever their offset falls in it.
+    """
+    __buffer: bytes
+    __view: memoryview
+    __payload_fd: int
+    __pattern_view: memoryview | None
+    __pattern_fd: int
+
+    def __init__(self, buffer_size: int = PAYLOAD_BUFFER_SIZE, pattern: bool = False):
+        self.__buffer = PAYLOAD_BYTE * buffer_size
+        self.__view = memoryview(self.__buffer)
+        self.__payload_fd = PayloadEngine.__open_payload_file(self.__buffer)
+        self.__pattern_view = None
+        self.__pattern_fd = -1
+        if pattern:
+            self.__pattern_view = memoryview(PATTERN)
+            self.__pattern_fd = PayloadEngine.__open_payload_file(PATTERN)
+
+    @staticmethod
+    def __open_payload_file(buffer: bytes) -> int:
+        """
+        Copies the buffer into an anonymous in-memory file, to be used as a sendfile source.
+        Returns -1 if sendfile or in-memory files are not available
+        """
+        if not hasattr(os, 'sendfile') or not hasattr(os, 'memfd_create'):
+            return -1
+        try:
+            fd: int = os.memfd_create('payload', os.MFD_CLOEXEC)
+        except OSError:
+            return -1
+        try:
+            written: int = 0
+            while written < len(buffer):
+                written += os.write(fd, buffer[written:])
+        except OSError:
+            os.close(fd)
+            return -1
+        return fd
+
+    def uses_sendfile(self) -> bool:
+        return self.__payload_fd != -1
+
+    def send_tcp(self, sock: socket.socket, bytes_amount: int) -> SendReport:
+        """
+        Sends the given amount of payload bytes over a connected, blocking TCP socket.
+        Raises OSError if the connection fails
+        """
+        report: SendReport = SendReport()
+        while report.bytes_sent < bytes_amount:
+            self.send_chunk(sock, bytes_amount - report.bytes_sent, report)
+        return report
+
+    def send_chunk(self, sock: socket.socket, bytes_left: int, report: SendReport) -> int:
+        """
+        Sends up to one buffer of payload bytes in a single send call, and records it in the report.
+        On a non-blocking socket, raises BlockingIOError if the socket is not writable.
+        Returns the amount of bytes sent
+        """
+        sent: int
+        source_fd: int = self.__payload_fd
+        source: memoryview = self.__view
+        start: int = 0
+        curr_chunk: int = min(len(self.__buffer), bytes_left)
+        if report.seed is not None:
+            source_fd = self.__pattern_fd
+            source = self.__pattern_view
+            start = pattern_position(report.seed, report.bytes_sent)
+            curr_chunk = min(PATTERN_SIZE, bytes_left)
+        if source_fd != -1 and report.use_sendfile:
+            try:
+                # an explicit offset is used, so the shared file position is never moved
+                sent = os.sendfile(sock.fileno(), source_fd, start, curr_chunk)
+            except BlockingIOError:
+                raise
+            except OSError:
+                # sendfile is unsupported for this socket - fall back to sending from memory,
+                # unless data was already sent and the connection itself is broken
+                if report.bytes_sent != 0:
+                    raise
+                report.use_sendfile = False
+                return self.send_chunk(sock, bytes_left, report)
+            if sent == 0:
+                raise ConnectionError('connection closed during sendfile')
+        elif sock.gettimeout() == 0.0:
+            sent = sock.send(source[start:start + curr_chunk])
+        else:
+            sock.sendall(source[start:start + curr_chunk])
+            sent = curr_chunk
+        report.bytes_sent += sent
+        report.calls += 1
+        return sent
+
+
+class PayloadSink:
+    """
+    Receives payload data from TCP connections into a single preallocated buffer, which
+    can be shared by all transfers as long as nothing reads it.
+    When discarding, the kernel drops the received data without copying it (Linux)
+    """
+    __buffer: bytearray
+    __view: memoryview
+    __flags: int
+
+    def __init__(self, buffer_size: int = RECV_BUFFER_SIZE, discard: bool = False):
+        self.__buffer = bytearray(buffer_size)
+        self.__view = memoryview(self.__buffer)
+        self.__flags = DISCARD_FLAGS if discard else 0
+
+    def receive_chunk(self, sock: socket.socket, bytes_left: int) -> int:
+        """
+        Receives up to one buffer of payload bytes, but no more than bytes_left, in a single call.
+        On a non-blocking socket, raises BlockingIOError if no data is available.
+        Raises ConnectionError if the connection is closed first.
+        Returns the amount of bytes received
+        """
+        received: int = sock.recv_into(self.__view, min(len(self.__buffer), bytes_left), self.__flags)
+        if received == 0:
+            raise ConnectionError('connection closed before the whole payload arrived')
+        return received
+
+    def received(self, length: int) -> memoryview:
+        """
+        Returns the bytes of the last chunk received, which stay valid until the next one
+        """
+        return self.__view[:length]
@@ -0,0 +1,311 @@
+import struct
+
+# Wire format of the UDP messages shared by the server and the client.
+# Every message starts with the magic cookie, the message type and the protocol version,
+# and all the fields are in network byte order.
+COOKIE = 0xabcddcba
+# bumped whenever the layout of a message changes; messages of other versions are rejected
+PROTOCOL_VERSION = 8
+MSG_OFFER = 0x2
+MSG_REQUEST = 0x3
+MSG_PAYLOAD = 0x4
+# sent by the client during a reliable transfer: which segments are still missing
+MSG_NACK = 0x5
+# a payload segment sent again, after the client reported it missing
+MSG_RETRANSMISSION = 0x6
+# sent by the server of an upload: which of its ports the client sends the payload to
+MSG_READY = 0x7
+# sent by the server once an upload is over: how much payload it received, and how fast
+MSG_REPORT = 0x8
+# sent by the server instead of serving a request, when it is overloaded or the client
+# is over its limits. Over TCP, it is sent in place of the payload
+MSG_REJECT = 0x9
+# sent by the client to the server's UDP port to measure the round trip, and echoed back by
+# the server right away as a probe reply
+MSG_PROBE = 0xa
+MSG_PROBE_REPLY = 0xb
+
+# request flags
+REQUEST_RELIABLE = 0x1
+# the client sends the payload instead of receiving it
+REQUEST_UPLOAD = 0x2
+# the client sends the payload while receiving it
+REQUEST_BIDIRECTIONAL = 0x4
+# the server sends the verifiable pattern, starting where the request's seed points,
+# instead of a constant byte
+REQUEST_VERIFY = 0x8
+
+# why a request was rejected
+REJECT_BUSY = 1
+REJECT_CLIENT_LIMIT = 2
+REJECT_TOO_LARGE = 3
+REJECT_REASONS = {REJECT_BUSY: 'the server is busy', REJECT_CLIENT_LIMIT: 'too many transfers from this client',
+                  REJECT_TOO_LARGE: 'the requested size is over the limit'}
+
+# which way the payload of a transfer flows
+DIRECTION_DOWNLOAD = 'download'
+DIRECTION_UPLOAD = 'upload'
+DIRECTION_BOTH = 'both'
+DIRECTION_FLAGS = {DIRECTION_DOWNLOAD: 0, DIRECTION_UPLOAD: REQUEST_UPLOAD, DIRECTION_BOTH: REQUEST_BIDIRECTIONAL}
+# TCP requests are a line holding the file size, prefixed by the direction unless downloading.
+# A download of a byte range is followed by the offset of the range, and a verified transfer by
+# the seed of the verifiable pattern: [prefix]size[@offset][:seed]
+TCP_DIRECTION_PREFIXES = {DIRECTION_DOWNLOAD: b'', DIRECTION_UPLOAD: b'U', DIRECTION_BOTH: b'B'}
+TCP_OFFSET_SEPARATOR = b'@'
+TCP_SEED_SEPARATOR = b':'
+
+HEADER = struct.Struct('!IBB')
+# header, server UDP port, server TCP port
+OFFER = struct.Struct('!IBBHH')
+# header, requested file size, largest payload the client accepts in a datagram, flags,
+# seed of the verifiable pattern
+REQUEST = struct.Struct('!IBBQHBI')
+# header, segments amount, current segment - followed by the payload itself
+PAYLOAD_HEADER = struct.Struct('!IBBQQ')
+SEGMENT_NUMBER = struct.Struct('!Q')
+SEGMENT_NUMBER_OFFSET = PAYLOAD_HEADER.size - SEGMENT_NUMBER.size
+# header, the segment every earlier segment arrived before, amount of ranges - followed by
+# ranges of missing segments
+NACK = struct.Struct('!IBBQH')
+# first missing segment, amount of consecutive missing segments
+NACK_RANGE = struct.Struct('!QI')
+# header, port of the server socket receiving the upload, payload size of the upload segments
+READY = struct.Struct('!IBBHH')
+# header, datagrams received, payload bytes received, nanoseconds from the first to the last
+# payload byte received. Over TCP, the same message follows the payload, with 0 datagrams
+REPORT = struct.Struct('!IBBQQQ')
+# header, reject reason
+REJECT = struct.Struct('!IBBB')
+# header, probe sequence number, client timestamp in nanoseconds - the reply carries them back
+PROBE = struct.Struct('!IBBQQ')
+
+# largest UDP datagram over IPv4 (65535 minus the IP and UDP headers)
+MAX_DATAGRAM_SIZE = 65507
+MAX_PAYLOAD_SIZE = MAX_DATAGRAM_SIZE - PAYLOAD_HEADER.size
+# payload size used when the path MTU is unknown
+DEFAULT_PAYLOAD_SIZE = 1000
+# longest offer or request message
+MAX_MESSAGE_LEN = 1024
+MAX_NACK_RANGES = (MAX_MESSAGE_LEN - NACK.size) // NACK_RANGE.size
+
+
+class ProtocolError(ValueError):
+    """
+    A message which is not a valid message of the expected type
+    """
+
+
+def check_header(cookie: int, message_type: int, version: int, expected_type: int) -> None:
+    """
+    Raises ProtocolError unless the header fields belong to a message of the expected type
+    """
+    if cookie != COOKIE:
+        raise ProtocolError(f'invalid cookie: {hex(cookie)}')
+    if message_type != expected_type:
+        raise ProtocolError(f'invalid message type: {message_type}. Expected: {expected_type}')
+    if version != PROTOCOL_VERSION:
+        raise ProtocolError(f'unsupported protocol version: {version}. Expected: {PROTOCOL_VERSION}')
+
+
+def pack_offer(udp_port: int, tcp_port: int) -> bytes:
+    return OFFER.pack(COOKIE, MSG_OFFER, PROTOCOL_VERSION, udp_port, tcp_port)
+
+
+def unpack_offer(buffer, offset: int = 0) -> tuple[int, int]:
+    """
+    Parses an offer message in place.
+    Returns the server's UDP and TCP ports
+    """
+    if len(buffer) - offset != OFFER.size:
+        raise ProtocolError(f'invalid offer length: {len(buffer) - offset}. Expected: {OFFER.size}')
+    cookie, message_type, version, udp_port, tcp_port = OFFER.unpack_from(buffer, offset)
+    if cookie != COOKIE or message_type != MSG_OFFER or version != PROTOCOL_VERSION:
+        check_header(cookie, message_type, version, MSG_OFFER)
+    return udp_port, tcp_port
+
+
+def pack_request(file_size: int, max_payload_size: int = MAX_PAYLOAD_SIZE, flags: int = 0, seed: int = 0) -> bytes:
+    return REQUEST.pack(COOKIE, MSG_REQUEST, PROTOCOL_VERSION, file_size, max_payload_size, flags, seed)
+
+
+def unpack_request(buffer, offset: int = 0) -> tuple[int, int, int, int]:
+    """
+    Parses a request message in place.
+    Returns the requested file size, the largest payload the client accepts, the flags
+    and the seed of the verifiable pattern
+    """
+    if len(buffer) - offset < REQUEST.size:
+        raise ProtocolError(f'invalid request length: {len(buffer) - offset}. Expected: {REQUEST.size}')
+    cookie, message_type, version, file_size, max_payload_size, flags, seed = REQUEST.unpack_from(buffer, offset)
+    if cookie != COOKIE or message_type != MSG_REQUEST or version != PROTOCOL_VERSION:
+        check_header(cookie, message_type, version, MSG_REQUEST)
+    if max_payload_size == 0:
+        raise ProtocolError('invalid maximum payload size: 0')
+    return file_size, max_payload_size, flags, seed
+
+
+def pack_payload_header_into(buffer, offset: int, segments_amount: int, segment: int,
+                             message_type: int = MSG_PAYLOAD) -> None:
+    PAYLOAD_HEADER.pack_into(buffer, offset, COOKIE, message_type, PROTOCOL_VERSION, segments_amount, segment)
+
+
+def pack_segment_number_into(buffer, offset: int, segment: int) -> None:
+    """
+    Patches the current segment of a payload message packed at the offset
+    """
+    SEGMENT_NUMBER.pack_into(buffer, offset + SEGMENT_NUMBER_OFFSET, segment)
+
+
+def unpack_payload_header(buffer, offset: int = 0) -> tuple[int, int, bool]:
+    """
+    Parses the header of a payload message in place. The caller checks that the
+    message is at least PAYLOAD_HEADER.size bytes long.
+    Returns the segments amount, the current segment and whether it is a retransmission
+    """
+    cookie, message_type, version, segments_amount, segment = PAYLOAD_HEADER.unpack_from(buffer, offset)
+    # the checks are inlined, as this runs for every received datagram
+    if cookie != COOKIE or (message_type != MSG_PAYLOAD and message_type != MSG_RETRANSMISSION) or \
+            version != PROTOCOL_VERSION:
+        check_header(cookie, message_type, version, MSG_PAYLOAD)
+    return segments_amount, segment, message_type == MSG_RETRANSMISSION
+
+
+def pack_nack(received_before: int, ranges: list[tuple[int, int]]) -> bytes:
+    """
+    Builds a NACK: every segment before received_before arrived, and the segments of the
+    ranges (first segment, amount) are missing. At most MAX_NACK_RANGES ranges fit
+    """
+    message: bytearray = bytearray(NACK.size + NACK_RANGE.size * len(ranges))
+    NACK.pack_into(message, 0, COOKIE, MSG_NACK, PROTOCOL_VERSION, received_before, len(ranges))
+    for idx, (first, count) in enumerate(ranges):
+        NACK_RANGE.pack_into(message, NACK.size + idx * NACK_RANGE.size, first, count)
+    return bytes(message)
+
+
+def unpack_nack(buffer, offset: int = 0) -> tuple[int, list[tuple[int, int]]]:
+    """
+    Parses a NACK message in place.
+    Returns the segment every earlier segment arrived before, and the missing ranges
+    """
+    if len(buffer) - offset < NACK.size:
+        raise ProtocolError(f'invalid NACK length: {len(buffer) - offset}. Expected: {NACK.size}')
+    cookie, message_type, version, received_before, ranges_amount = NACK.unpack_from(buffer, offset)
+    check_header(cookie, message_type, version, MSG_NACK)
+    if len(buffer) - offset < NACK.size + ranges_amount * NACK_RANGE.size:
+        raise ProtocolError(f'NACK truncated: {ranges_amount} ranges in {len(buffer) - offset} bytes')
+    return received_before, [NACK_RANGE.unpack_from(buffer, offset + NACK.size + idx * NACK_RANGE.size)
+                             for idx in range(ranges_amount)]
+
+
+def request_direction(flags: int) -> str:
+    """
+    Returns the direction of a UDP request out of its flags
+    """
+    if flags & REQUEST_UPLOAD and flags & REQUEST_BIDIRECTIONAL:
+        raise ProtocolError('a request cannot be both an upload and bidirectional')
+    if flags & REQUEST_UPLOAD:
+        return DIRECTION_UPLOAD
+    if flags & REQUEST_BIDIRECTIONAL:
+        return DIRECTION_BOTH
+    return DIRECTION_DOWNLOAD
+
+
+def pack_tcp_request(file_size: int, direction: str = DIRECTION_DOWNLOAD, seed: int | None = None,
+                     offset: int | None = None) -> bytes:
+    line: bytes = TCP_DIRECTION_PREFIXES[direction] + str(file_size).encode()
+    if offset is not None:
+        line += TCP_OFFSET_SEPARATOR + str(offset).encode()
+    if seed is not None:
+        line += TCP_SEED_SEPARATOR + str(seed).encode()
+    return line + b'\n'
+
+
+def pack_ready(port: int, payload_size: int) -> bytes:
+    return READY.pack(COOKIE, MSG_READY, PROTOCOL_VERSION, port, payload_size)
+
+
+def unpack_ready(buffer, offset: int = 0) -> tuple[int, int]:
+    """
+    Parses a ready message in place.
+    Returns the port the upload is sent to, and the payload size of its segments
+    """
+    if len(buffer) - offset < READY.size:
+        raise ProtocolError(f'invalid ready length: {len(buffer) - offset}. Expected: {READY.size}')
+    cookie, message_type, version, port, payload_size = READY.unpack_from(buffer, offset)
+    check_header(cookie, message_type, version, MSG_READY)
+    if not 0 < payload_size <= MAX_PAYLOAD_SIZE:
+        raise ProtocolError(f'invalid upload payload size: {payload_size}')
+    return port, payload_size
+
+
+def pack_report(datagrams: int, bytes_received: int, duration_ns: int) -> bytes:
+    return REPORT.pack(COOKIE, MSG_REPORT, PROTOCOL_VERSION, datagrams, bytes_received, duration_ns)
+
+
+def unpack_report(buffer, offset: int = 0) -> tuple[int, int, int]:
+    """
+    Parses a report message in place.
+    Returns the datagrams and payload bytes the server received, and the nanoseconds it took
+    """
+    if len(buffer) - offset < REPORT.size:
+        raise ProtocolError(f'invalid report length: {len(buffer) - offset}. Expected: {REPORT.size}')
+    cookie, message_type, version, datagrams, bytes_received, duration_ns = REPORT.unpack_from(buffer, offset)
+    check_header(cookie, message_type, version, MSG_REPORT)
+    return datagrams, bytes_received, duration_ns
+
+
+def pack_reject(reason: int) -> bytes:
+    return REJECT.pack(COOKIE, MSG_REJECT, PROTOCOL_VERSION, reason)
+
+
+def unpack_reject(buffer, offset: int = 0) -> int:
+    """
+    Parses a reject message in place.
+    Returns the reason of the rejection
+    """
+    if len(buffer) - offset < REJECT.size:
+        raise ProtocolError(f'invalid reject length: {len(buffer) - offset}. Expected: {REJECT.size}')
+    cookie, message_type, version, reason = REJECT.unpack_from(buffer, offset)
+    check_header(cookie, message_type, version, MSG_REJECT)
+    return reason
+
+
+def reject_reason(reason: int) -> str:
+    return REJECT_REASONS.get(reason, f'unknown reason {reason}')
+
+
+def pack_probe(sequence: int, timestamp_ns: int) -> bytes:
+    return PROBE.pack(COOKIE, MSG_PROBE, PROTOCOL_VERSION, sequence, timestamp_ns)
+
+
+def probe_reply(buffer, offset: int = 0) -> bytes:
+    """
+    Parses a probe message in place.
+    Returns the reply echoing it
+    """
+    if len(buffer) - offset < PROBE.size:
+        raise ProtocolError(f'invalid probe length: {len(buffer) - offset}. Expected: {PROBE.size}')
+    cookie, message_type, version, sequence, timestamp_ns = PROBE.unpack_from(buffer, offset)
+    check_header(cookie, message_type, version, MSG_PROBE)
+    return PROBE.pack(COOKIE, MSG_PROBE_REPLY, PROTOCOL_VERSION, sequence, timestamp_ns)
+
+
+def unpack_probe_reply(buffer, offset: int = 0) -> tuple[int, int]:
+    """
+    Parses a probe reply in place.
+    Returns the sequence number and the timestamp of the probe it echoes
+    """
+    if len(buffer) - offset < PROBE.size:
+        raise ProtocolError(f'invalid probe reply length: {len(buffer) - offset}. Expected: {PROBE.size}')
+    cookie, message_type, version, sequence, timestamp_ns = PROBE.unpack_from(buffer, offset)
+    check_header(cookie, message_type, version, MSG_PROBE_REPLY)
+    return sequence, timestamp_ns
+
+
+def message_type_of(buffer, offset: int = 0) -> int | None:
+    """
+    Returns the message type of a message, or None if it is too short to have one
+    """
+    if len(buffer) - offset < HEADER.size:
+        return None
+    return HEADER.unpack_from(buffer, offset)[1]
@@ -0,0 +1,222 @@
+import ctypes
+import errno
+import select
+import socket
+import struct
+import sys
+
+# counter of datagrams the kernel dropped because the socket receive buffer was full (Linux)
+SO_RXQ_OVFL = getattr(socket, 'SO_RXQ_OVFL', 40)
+SO_RCVBUFFORCE = getattr(socket, 'SO_RCVBUFFORCE', 33)
+MSG_DONTWAIT = getattr(socket, 'MSG_DONTWAIT', 0x40)
+DROP_COUNTER = struct.Struct('=I')
+# socket memory counters (Linux), the last of which is the drop counter
+SO_MEMINFO = getattr(socket, 'SO_MEMINFO', 55)
+SK_MEMINFO = struct.Struct('=9I')
+SK_MEMINFO_DROPS = 8
+# requested receive buffer for UDP sockets - large enough to absorb bursts while parsing
+UDP_RCVBUF_SIZE = 32 * 1024 * 1024
+# most datagrams returned by a single receive call
+RECV_BATCH_SIZE = 64
+# most bytes of slots in a receiver, so batches of large datagrams have fewer slots
+RECV_BATCH_BYTES = 1024 * 1024
+
+
+class _IoVec(ctypes.Structure):
+    _fields_ = [('iov_base', ctypes.c_void_p), ('iov_len', ctypes.c_size_t)]
+
+
+class _MsgHdr(ctypes.Structure):
+    _fields_ = [('msg_name', ctypes.c_void_p), ('msg_namelen', ctypes.c_uint32),
+                ('msg_iov', ctypes.POINTER(_IoVec)), ('msg_iovlen', ctypes.c_size_t),
+                ('msg_control', ctypes.c_void_p), ('msg_controllen', ctypes.c_size_t),
+                ('msg_flags', ctypes.c_int)]
+
+
+class _MMsgHdr(ctypes.Structure):
+    _fields_ = [('msg_hdr', _MsgHdr), ('msg_len', ctypes.c_uint)]
+
+
+def set_rcvbuf(sock: socket.socket, rcvbuf: int) -> None:
+    """
+    Sets the socket receive buffer, above the system maximum when permitted
+    """
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, SO_RCVBUFFORCE, rcvbuf)
+    except OSError:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+
+
+def read_socket_drops(sock: socket.socket) -> int | None:
+    """
+    Returns the amount of datagrams the socket dropped because its receive buffer was
+    full, or None if the platform does not report it
+    """
+    try:
+        meminfo: bytes = sock.getsockopt(socket.SOL_SOCKET, SO_MEMINFO, SK_MEMINFO.size)
+    except OSError:
+        return None
+    if len(meminfo) != SK_MEMINFO.size:
+        return None
+    return SK_MEMINFO.unpack(meminfo)[SK_MEMINFO_DROPS]
+
+
+def _load_recvmmsg():
+    """
+    Returns the libc recvmmsg function, or None if the platform does not have it
+    """
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        recvmmsg = ctypes.CDLL(None, use_errno=True).recvmmsg
+    except (OSError, AttributeError):
+        return None
+    recvmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(_MMsgHdr), ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+    recvmmsg.restype = ctypes.c_int
+    return recvmmsg
+
+
+_recvmmsg = _load_recvmmsg()
+
+
+class UdpReceiver:
+    """
+    Receives batches of datagrams from a UDP socket into a ring of preallocated slots.
+    On Linux, a whole batch is received with a single recvmmsg system call; elsewhere
+    the slots are filled one recvmsg_into call at a time.
+    Also enlarges the socket receive buffer, and keeps the kernel's count of datagrams
+    dropped because the client did not read them fast enough.
+    """
+    __sock: socket.socket
+    __batch_size: int
+    __buffer: bytearray
+    __control_size: int
+    __controls: bytearray
+    __iovecs: ctypes.Array
+    __messages: ctypes.Array
+    __use_recvmmsg: bool
+    __poller: 'select.poll | None'
+    slot_size: int
+    view: memoryview
+    lengths: list[int]
+    kernel_drops: int | None
+
+    def __init__(self, sock: socket.socket, slot_size: int, batch_size: int = RECV_BATCH_SIZE,
+                 rcvbuf: int = UDP_RCVBUF_SIZE):
+        self.__sock = sock
+        self.slot_size = slot_size
+        batch_size = max(1, min(batch_size, RECV_BATCH_BYTES // slot_size))
+        self.__batch_size = batch_size
+        self.__buffer = bytearray(slot_size * batch_size)
+        self.view = memoryview(self.__buffer)
+        self.lengths = [0] * batch_size
+        # timeouts are handled by the receiver, and non-blocking reads are explicit
+        sock.setblocking(True)
+        set_rcvbuf(sock, rcvbuf)
+        self.__poller = None
+        if hasattr(select, 'poll'):
+            self.__poller = select.poll()
+            self.__poller.register(sock, select.POLLIN)
+
+        # ask for the drop counter with every datagram
+        self.kernel_drops = None
+        self.__control_size = 0
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, SO_RXQ_OVFL, 1)
+            self.__control_size = socket.CMSG_SPACE(DROP_COUNTER.size)
+            self.kernel_drops = 0
+        except (OSError, AttributeError):
+            pass
+        self.__controls = bytearray(max(1, self.__control_size) * batch_size)
+
+        self.__use_recvmmsg = _recvmmsg is not None
+        if self.__use_recvmmsg:
+            self.__messages = self.__build_messages()
+
+    def __build_messages(self) -> ctypes.Array:
+        """
+        Builds the recvmmsg message headers, each pointing at its own slot of the buffer
+        """
+        buffer_addr: int = ctypes.addressof(ctypes.c_char.from_buffer(self.__buffer))
+        controls_addr: int = ctypes.addressof(ctypes.c_char.from_buffer(self.__controls))
+        self.__iovecs = (_IoVec * self.__batch_size)()
+        messages = (_MMsgHdr * self.__batch_size)()
+        for slot in range(self.__batch_size):
+            self.__iovecs[slot].iov_base = buffer_addr + slot * self.slot_size
+            self.__iovecs[slot].iov_len = self.slot_size
+            header: _MsgHdr = messages[slot].msg_hdr
+            header.msg_iov = ctypes.pointer(self.__iovecs[slot])
+            header.msg_iovlen = 1
+            if self.__control_size:
+                header.msg_control = controls_addr + slot * self.__control_size
+        return messages
+
+    def receive(self, timeout: float) -> int:
+        """
+        Waits up to timeout seconds for datagrams, then receives as many as are ready,
+        up to a full batch. The i-th datagram is at view[i * slot_size:] and is lengths[i] long.
+        Returns the amount of datagrams received, 0 if none arrived in time
+        """
+        if self.__poller is not None:
+            if not self.__poller.poll(timeout * 1000):
+                return 0
+        elif not select.select([self.__sock], [], [], timeout)[0]:
+            return 0
+        if self.__use_recvmmsg:
+            return self.__receive_recvmmsg()
+        return self.__receive_one_by_one()
+
+    def __receive_recvmmsg(self) -> int:
+        for slot in range(self.__batch_size):
+            # the kernel shrinks the control length to what it wrote
+            self.__messages[slot].msg_hdr.msg_controllen = self.__control_size
+        count: int = _recvmmsg(self.__sock.fileno(), self.__messages, self.__batch_size, MSG_DONTWAIT, None)
+        if count < 0:
+            error: int = ctypes.get_errno()
+            if error in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return 0
+            raise OSError(error, f'recvmmsg failed: {errno.errorcode.get(error, error)}')
+        for slot in range(count):
+            self.lengths[slot] = self.__messages[slot].msg_len
+        if count and self.__control_size and self.__messages[count - 1].msg_hdr.msg_controllen:
+            self.__read_drop_counter(self.__controls, (count - 1) * self.__control_size)
+        return count
+
+    def __receive_one_by_one(self) -> int:
+        count: int = 0
+        flags: int = 0
+        while count < self.__batch_size:
+            slot_view: memoryview = self.view[count * self.slot_size:(count + 1) * self.slot_size]
+            try:
+                length, ancdata, _, _ = self.__sock.recvmsg_into([slot_view], self.__control_size, flags)
+            except (BlockingIOError, InterruptedError):
+                break
+            for level, type, data in ancdata:
+                if level == socket.SOL_SOCKET and type == SO_RXQ_OVFL:
+                    self.kernel_drops = DROP_COUNTER.unpack_from(data)[0]
+            self.lengths[count] = length
+            count += 1
+            # only wait for the first datagram, then take whatever is already queued
+            flags = MSG_DONTWAIT
+        return count
+
+    def update_drops(self) -> None:
+        """
+        Reads the current drop counter straight from the socket, to include drops that
+        happened after the last received datagram
+        """
+        if self.kernel_drops is None:
+            return
+        drops: int | None = read_socket_drops(self.__sock)
+        if drops is not None:
+            self.kernel_drops = max(self.kernel_drops, drops)
+
+    def __read_drop_counter(self, controls: bytearray, offset: int) -> None:
+        """
+        Reads the drop counter out of a raw control message
+        """
+        header_len: int = socket.CMSG_LEN(0)
+        # struct cmsghdr: length (size_t), level (int), type (int), then the data
+        _, level, type = struct.unpack_from('Nii', controls, offset)
+        if level == socket.SOL_SOCKET and type == SO_RXQ_OVFL:
+            self.kernel_drops = DROP_COUNTER.unpack_from(controls, offset + header_len)[0]
@@ -0,0 +1,225 @@
+import errno
+import ipaddress
+import socket
+import struct
+
+import logger
+from pattern import PATTERN, pattern_position
+from protocol import PAYLOAD_HEADER, DEFAULT_PAYLOAD_SIZE, MAX_PAYLOAD_SIZE, pack_payload_header_into, \
+    pack_segment_number_into
+
+PAYLOAD_BYTE = b'a'
+
+# UDP generic segmentation offload (Linux): one sendmsg call carries a whole batch of
+# equally sized datagrams, which the kernel splits into separate datagrams
+UDP_SEGMENT = getattr(socket, 'UDP_SEGMENT', 103)
+SOL_UDP = getattr(socket, 'SOL_UDP', 17)
+GSO_MAX_SEGMENTS = 64
+GSO_MAX_BYTES = 65507
+# errors meaning segmentation offload is not supported for this socket or route
+GSO_UNSUPPORTED_ERRORS = (errno.EIO, errno.EINVAL, errno.ENOPROTOOPT, errno.EOPNOTSUPP)
+_PATTERN_VIEW = memoryview(PATTERN)
+
+# path MTU discovery (Linux): with fragmentation forbidden, a connected socket reports
+# the MTU of the route to its peer
+IP_MTU_DISCOVER = getattr(socket, 'IP_MTU_DISCOVER', 10)
+IP_PMTUDISC_DO = getattr(socket, 'IP_PMTUDISC_DO', 2)
+IP_MTU = getattr(socket, 'IP_MTU', 14)
+IP_UDP_HEADERS_SIZE = 28
+# the send buffer of a transfer holds at least this many datagrams
+SEND_BUFFER_DATAGRAMS = 128
+
+
+def path_payload_size(address: tuple[str, int]) -> int:
+    """
+    Returns the largest payload a single unfragmented datagram to the address can carry:
+    up to the 64 KB datagram limit on loopback, as much as the path MTU allows elsewhere,
+    or the default payload size when the path MTU is unknown
+    """
+    if ipaddress.ip_address(address[0]).is_loopback:
+        return MAX_PAYLOAD_SIZE
+    probe: socket.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        probe.setsockopt(socket.IPPROTO_IP, IP_MTU_DISCOVER, IP_PMTUDISC_DO)
+        # connecting a UDP socket sends nothing, it only resolves the route
+        probe.connect(address)
+        mtu: int = probe.getsockopt(socket.IPPROTO_IP, IP_MTU)
+    except OSError as e:
+        logger.debugging(f'Path MTU to {address[0]} unknown ({e}), using {DEFAULT_PAYLOAD_SIZE} byte payloads')
+        return DEFAULT_PAYLOAD_SIZE
+    finally:
+        probe.close()
+    return max(1, min(MAX_PAYLOAD_SIZE, mtu - IP_UDP_HEADERS_SIZE - PAYLOAD_HEADER.size))
+
+
+def negotiate_payload_size(address: tuple[str, int], client_max_payload_size: int) -> int:
+    """
+    Returns the payload size of a transfer: as large as both the client and the path allow
+    """
+    return min(client_max_payload_size, path_payload_size(address))
+
+
+def send_buffer_size(payload_size: int, minimum: int) -> int:
+    """
+    Returns the send buffer size for a transfer of the given payload size
+    """
+    return max(minimum, SEND_BUFFER_DATAGRAMS * (PAYLOAD_HEADER.size + payload_size))
+
+
+def fill_pattern(buffer: bytearray, start: int, seed: int, offset: int, length: int) -> None:
+    """
+    Copies the pattern bytes at the offset of a seeded transfer into the buffer
+    """
+    position: int = pattern_position(seed, offset)
+    buffer[start:start + length] = _PATTERN_VIEW[position:position + length]
+
+
+class UdpSendReport:
+    """
+    Summary of a single UDP transfer: how many segments and payload bytes were sent,
+    how many of them were retransmissions, how many segments failed and how many send
+    system calls were used
+    """
+    segments_sent: int
+    bytes_sent: int
+    retransmitted: int
+    send_errors: int
+    calls: int
+
+    def __init__(self):
+        self.segments_sent = 0
+        self.bytes_sent = 0
+        self.retransmitted = 0
+        self.send_errors = 0
+        self.calls = 0
+
+    def __str__(self) -> str:
+        segments_per_call: float = 0.0 if self.calls == 0 else self.segments_sent / self.calls
+        return (f'{self.segments_sent} segments in {self.calls} send calls '
+                f'({segments_per_call:.1f} segments/call), {self.retransmitted} retransmitted, '
+                f'{self.send_errors} failed')
+
+
+class UdpSegmentSender:
+    """
+    Sends a file to a UDP client as a series of payload segments.
+    All the datagrams of a batch live in one preallocated buffer, whose headers are
+    packed once - only the segment numbers are patched in place before each batch.
+    Where the platform supports it, a whole batch is sent in a single system call
+    using UDP segmentation offload.
+    A transfer with a seed sends the verifiable pattern: the payload of every slot is
+    copied out of the pattern, at the offset of its segment, before each batch.
+    """
+    __sock: socket.socket
+    __address: tuple[str, int]
+    __file_size: int
+    __payload_size: int
+    __datagram_size: int
+    __batch_size: int
+    __buffer: bytearray
+    __view: memoryview
+    __use_gso: bool
+    __next_segment: int
+    __seed: int | None
+    segments_amount: int
+
+    def __init__(self, sock: socket.socket, address: tuple[str, int], file_size: int, payload_size: int,
+                 use_gso: bool = True, seed: int | None = None):
+        self.__sock = sock
+        self.__seed = seed
+        self.__address = address
+        self.__file_size = file_size
+        self.__payload_size = payload_size
+        self.__datagram_size = PAYLOAD_HEADER.size + payload_size
+        self.segments_amount = -(-file_size // payload_size)
+        self.__next_segment = 0
+        self.__use_gso = use_gso and hasattr(socket.socket, 'sendmsg')
+        self.__batch_size = max(1, min(GSO_MAX_SEGMENTS, GSO_MAX_BYTES // self.__datagram_size))
+        if not self.__use_gso:
+            self.__batch_size = 1
+
+        # build the batch buffer once: every slot holds a complete datagram
+        self.__buffer = bytearray(PAYLOAD_BYTE * (self.__datagram_size * self.__batch_size))
+        for slot in range(self.__batch_size):
+            pack_payload_header_into(self.__buffer, slot * self.__datagram_size, self.segments_amount, 0)
+        self.__view = memoryview(self.__buffer)
+        self.__gso_ancdata = [(SOL_UDP, UDP_SEGMENT, struct.pack('=H', self.__datagram_size))]
+
+    def send_all(self) -> UdpSendReport:
+        """
+        Sends all the segments of the file to the client over a blocking socket
+        """
+        report: UdpSendReport = UdpSendReport()
+        while not self.send_next_batch(report):
+            pass
+        return report
+
+    def finished(self) -> bool:
+        return self.__next_segment >= self.segments_amount
+
+    def next_segment(self) -> int:
+        return self.__next_segment
+
+    def send_next_batch(self, report: UdpSendReport, limit: int | None = None) -> bool:
+        """
+        Sends the next batch of segments, never reaching the limit segment when one is given.
+        On a non-blocking socket, stops early when the socket is not writable, and resumes
+        from the same segment on the next call.
+        Returns whether all the segments were sent
+        """
+        end: int = self.segments_amount if limit is None else min(limit, self.segments_amount)
+        if self.__next_segment < end:
+            batch: int = min(self.__batch_size, end - self.__next_segment)
+            self.__next_segment += self.__send_batch(self.__next_segment, batch, report)
+        return self.finished()
+
+    def __send_batch(self, first_segment: int, batch: int, report: UdpSendReport) -> int:
+        """
+        Patches the segment numbers of the batch and sends it.
+        Returns the amount of segments handled (either sent or failed)
+        """
+        for slot in range(batch):
+            pack_segment_number_into(self.__buffer, slot * self.__datagram_size, first_segment + slot)
+        # the last segment of the file may carry a shorter payload
+        last_segment: int = first_segment + batch - 1
+        last_payload: int = min(self.__payload_size, self.__file_size - last_segment * self.__payload_size)
+        if self.__seed is not None:
+            for slot in range(batch):
+                fill_pattern(self.__buffer, slot * self.__datagram_size + PAYLOAD_HEADER.size, self.__seed,
+                             (first_segment + slot) * self.__payload_size,
+                             last_payload if slot == batch - 1 else self.__payload_size)
+        batch_len: int = (batch - 1) * self.__datagram_size + PAYLOAD_HEADER.size + last_payload
+
+        if self.__use_gso and batch > 1:
+            try:
+                self.__sock.sendmsg([self.__view[:batch_len]], self.__gso_ancdata, 0, self.__address)
+                report.segments_sent += batch
+                report.bytes_sent += batch_len - batch * PAYLOAD_HEADER.size
+                report.calls += 1
+                return batch
+            except BlockingIOError:
+                return 0
+            except OSError as e:
+                if e.errno not in GSO_UNSUPPORTED_ERRORS:
+                    logger.error(f'Error: failed to send segments {first_segment}-{last_segment} '
+                                 f'to udp client: {e}')
+                    report.send_errors += batch
+                    report.calls += 1
+                    return batch
+                logger.debugging(f'UDP segmentation offload unavailable ({e}), sending segments one by one')
+                self.__use_gso = False
+
+        for slot in range(batch):
+            start: int = slot * self.__datagram_size
+            end: int = min(start + self.__datagram_size, batch_len)
+            try:
+                self.__sock.sendto(self.__view[start:end], self.__address)
+                report.segments_sent += 1
+                report.bytes_sent += end - start - PAYLOAD_HEADER.size
+            except BlockingIOError:
+                return slot
+            except Exception as e:
+                logger.error(f'Error: failed to send segment number {first_segment + slot} to udp client: {e}')
+                report.send_errors += 1
+            report.calls += 1
+        return batch
@@ -0,0 +1,143 @@
+BITS_IN_BYTE = 8
+FULL_BYTE = 0xff
+
+
+class SegmentTracker:
+    """
+    Keeps track of the segments received in a UDP transfer, in a bitmap of one bit
+    per segment, so memory stays at segments_amount / 8 bytes.
+    Counts duplicates, retransmissions and reordered segments while receiving, and computes
+    loss and the largest run of missing segments once the transfer is over.
+    """
+    __bitmap: bytearray
+    segments_amount: int
+    received: int
+    duplicates: int
+    retransmissions: int
+    out_of_range: int
+    reordered: int
+    max_reorder_distance: int
+    highest_segment: int
+    # every segment before this one was received
+    first_missing: int
+
+    def __init__(self, segments_amount: int):
+        self.segments_amount = segments_amount
+        self.__bitmap = bytearray((segments_amount + BITS_IN_BYTE - 1) // BITS_IN_BYTE)
+        self.received = 0
+        self.duplicates = 0
+        self.retransmissions = 0
+        self.out_of_range = 0
+        self.reordered = 0
+        self.max_reorder_distance = 0
+        self.highest_segment = -1
+        self.first_missing = 0
+
+    def record(self, segment_id: int, retransmission: bool = False) -> bool:
+        """
+        Records the arrival of a segment, which the server may have sent again after it
+        was reported missing.
+        Returns whether the segment was new
+        """
+        if segment_id >= self.segments_amount:
+            self.out_of_range += 1
+            return False
+        if retransmission:
+            self.retransmissions += 1
+        byte_idx: int = segment_id >> 3
+        bit: int = 1 << (segment_id & 7)
+        if self.__bitmap[byte_idx] & bit:
+            self.duplicates += 1
+            return False
+        self.__bitmap[byte_idx] |= bit
+        self.received += 1
+
+        if segment_id == self.first_missing:
+            self.__advance_first_missing()
+        if segment_id > self.highest_segment:
+            self.highest_segment = segment_id
+        elif not retransmission:
+            # arrived after a segment that was sent later
+            self.reordered += 1
+            self.max_reorder_distance = max(self.max_reorder_distance, self.highest_segment - segment_id)
+        return True
+
+    def __advance_first_missing(self) -> None:
+        segment: int = self.first_missing
+        while segment < self.segments_amount:
+            byte: int = self.__bitmap[segment >> 3]
+            if byte == FULL_BYTE:
+                segment = (segment | 7) + 1
+            elif byte & (1 << (segment & 7)):
+                segment += 1
+            else:
+                break
+        self.first_missing = min(segment, self.segments_amount)
+
+    def missing_ranges(self, end: int, limit: int) -> list[tuple[int, int]]:
+        """
+        Returns up to limit runs of missing segments before the end segment, as
+        (first segment, amount) pairs
+        """
+        ranges: list[tuple[int, int]] = []
+        end = min(end, self.segments_amount)
+        segment: int = self.first_missing
+        while segment < end and len(ranges) < limit:
+            byte: int = self.__bitmap[segment >> 3]
+            if byte == FULL_BYTE:
+                segment = (segment | 7) + 1
+                continue
+            if byte & (1 << (segment & 7)):
+                segment += 1
+                continue
+            first: int = segment
+            while segment < end:
+                byte = self.__bitmap[segment >> 3]
+                if byte == 0 and segment & 7 == 0:
+                    segment += BITS_IN_BYTE
+                elif byte & (1 << (segment & 7)):
+                    break
+                else:
+                    segment += 1
+            segment = min(segment, end)
+            ranges.append((first, segment - first))
+        return ranges
+
+    def complete(self) -> bool:
+        return self.received == self.segments_amount
+
+    def lost(self) -> int:
+        return self.segments_amount - self.received
+
+    def success_percent(self) -> float:
+        return 100.0 if self.segments_amount == 0 else 100 * self.received / self.segments_amount
+
+    def retransmission_percent(self) -> float:
+        """
+        Returns the retransmitted segments received, as a percentage of the segments amount
+        """
+        return 0.0 if self.segments_amount == 0 else 100 * self.retransmissions / self.segments_amount
+
+    def largest_gap(self) -> int:
+        """
+        Returns the longest run of consecutive missing segments
+        """
+        largest: int = 0
+        current: int = 0
+        for byte in self.__bitmap:
+            if byte == 0:
+                current += BITS_IN_BYTE
+                continue
+            if byte == FULL_BYTE:
+                largest = max(largest, current)
+                current = 0
+                continue
+            for bit_idx in range(BITS_IN_BYTE):
+                if byte & (1 << bit_idx):
+                    largest = max(largest, current)
+                    current = 0
+                else:
+                    current += 1
+        # the bits past the last segment are never set, and are not segments
+        padding: int = len(self.__bitmap) * BITS_IN_BYTE - self.segments_amount
+        return max(largest, current - padding)
@@ -0,0 +1,82 @@
+import threading
+
+from protocol import REJECT_BUSY, REJECT_CLIENT_LIMIT, REJECT_TOO_LARGE
+from worker_pool import DEFAULT_POOL_SIZE, DEFAULT_QUEUE_SIZE
+
+DEFAULT_MAX_CLIENT_TRANSFERS = 16
+DEFAULT_MAX_CLIENT_BYTES = 64 * 1024 * 1024 * 1024
+
+
+class AdmissionLimits:
+    """
+    How much work a server takes on: the worker pool and its pending queue bound all the
+    transfers at once, and every client is limited in its concurrent transfers and in the
+    bytes its active transfers requested
+    """
+    pool_size: int
+    queue_size: int
+    max_client_transfers: int
+    max_client_bytes: int
+
+    def __init__(self, pool_size: int = DEFAULT_POOL_SIZE, queue_size: int = DEFAULT_QUEUE_SIZE,
+                 max_client_transfers: int = DEFAULT_MAX_CLIENT_TRANSFERS,
+                 max_client_bytes: int = DEFAULT_MAX_CLIENT_BYTES):
+        self.pool_size = pool_size
+        self.queue_size = queue_size
+        self.max_client_transfers = max_client_transfers
+        self.max_client_bytes = max_client_bytes
+
+
+class AdmissionControl:
+    """
+    Tracks the active transfers of every client, by IP address, and decides whether a
+    new request is served or rejected. A bidirectional request counts as two transfers.
+    When max_transfers is given, the total of active transfers is bounded too
+    """
+    __lock: threading.Lock
+    __limits: AdmissionLimits
+    __max_transfers: int
+    __active: int
+    # active transfers and the bytes they requested, by client address
+    __clients: dict[str, list[int]]
+
+    def __init__(self, limits: AdmissionLimits, max_transfers: int = 0):
+        self.__lock = threading.Lock()
+        self.__limits = limits
+        self.__max_transfers = max_transfers
+        self.__active = 0
+        self.__clients = {}
+
+    def admit(self, client: str, file_size: int, transfers: int = 1) -> int | None:
+        """
+        Admits the transfers of a request, which must be released once they finish.
+        Returns the reason the request is rejected, or None if it was admitted
+        """
+        requested: int = file_size * transfers
+        if requested > self.__limits.max_client_bytes:
+            return REJECT_TOO_LARGE
+        with self.__lock:
+            if self.__max_transfers > 0 and self.__active + transfers > self.__max_transfers:
+                return REJECT_BUSY
+            usage: list[int] = self.__clients.setdefault(client, [0, 0])
+            if usage[0] + transfers > self.__limits.max_client_transfers or \
+                    usage[1] + requested > self.__limits.max_client_bytes:
+                if usage[0] == 0:
+                    del self.__clients[client]
+                return REJECT_CLIENT_LIMIT
+            usage[0] += transfers
+            usage[1] += requested
+            self.__active += transfers
+        return None
+
+    def release(self, client: str, file_size: int, transfers: int = 1) -> None:
+        with self.__lock:
+            self.__active -= transfers
+            usage: list[int] = self.__clients[client]
+            usage[0] -= transfers
+            usage[1] -= file_size * transfers
+            if usage[0] == 0:
+                del self.__clients[client]
+
+    def active(self) -> int:
+        return self.__active
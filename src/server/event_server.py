@@ -0,0 +1,688 @@
+import collections
+import selectors
+import socket
+import threading
+import time
+from typing import Callable
+
+import teapot_gen
+import logger
+from admission import AdmissionControl, AdmissionLimits
+from payload import PayloadEngine, PayloadSink, SendReport
+from request_reader import RequestReader, RequestError, REQUEST_READ_TIMEOUT, TcpRequest, parse_request
+from protocol import DIRECTION_BOTH, DIRECTION_DOWNLOAD, DIRECTION_UPLOAD, MAX_MESSAGE_LEN, MSG_NACK, MSG_PROBE, \
+    REJECT_BUSY, REQUEST_RELIABLE, REQUEST_VERIFY, ProtocolError, message_type_of, pack_report, request_direction
+from reliable_udp import ReliableSegmentSender
+from server import Server, TransferCallback, UDP_SEND_BUFFER_SIZE
+from stats import ProtocolCounters, ServerStats, StatsShard, send_counted_batch
+from udp_sender import UdpSegmentSender, UdpSendReport, negotiate_payload_size, send_buffer_size
+from udp_upload import UdpUpload
+
+OFFER_INTERVAL = 1
+# most UDP requests read from the request socket before returning to the event loop
+MAX_UDP_REQUESTS_PER_EVENT = 64
+
+
+class TcpTransfer:
+    """
+    A TCP client connection handled by the event loop.
+    First reads the client's request line, then sends one chunk of the requested
+    payload every time the socket becomes writable, receives one chunk of the client's
+    upload every time it becomes readable, or both. An upload is followed by the report
+    of how fast it arrived, sent after the whole payload.
+    Requests over the admission limits are rejected with a reject message
+    """
+    __sock: socket.socket
+    __address: tuple[str, int]
+    __selector: selectors.BaseSelector
+    __payload_engine: PayloadEngine
+    __payload_sink: PayloadSink
+    __request_reader: RequestReader
+    __request_deadline: float
+    __admission: AdmissionControl
+    __direction: str
+    __transfers: int
+    __bytes_amount: int
+    __download_amount: int
+    __upload_left: int
+    __upload_start_ns: int
+    __upload_report: memoryview | None
+    __events: int
+    __report: SendReport
+    __start_time: float
+    __on_transfer: TransferCallback | None
+    __counters: ProtocolCounters
+
+    def __init__(self, sock: socket.socket, address: tuple[str, int], selector: selectors.BaseSelector,
+                 payload_engine: PayloadEngine, payload_sink: PayloadSink, admission: AdmissionControl,
+                 on_transfer: TransferCallback | None, counters: ProtocolCounters):
+        self.__sock = sock
+        self.__address = address
+        self.__selector = selector
+        self.__payload_engine = payload_engine
+        self.__payload_sink = payload_sink
+        self.__request_reader = RequestReader()
+        self.__request_deadline = time.monotonic() + REQUEST_READ_TIMEOUT
+        self.__admission = admission
+        self.__direction = DIRECTION_DOWNLOAD
+        self.__transfers = 1
+        self.__bytes_amount = -1
+        self.__download_amount = 0
+        self.__upload_left = 0
+        self.__upload_start_ns = 0
+        self.__upload_report = None
+        self.__events = selectors.EVENT_READ
+        self.__report = SendReport()
+        self.__start_time = 0.0
+        self.__on_transfer = on_transfer
+        self.__counters = counters
+        self.__sock.setblocking(False)
+        self.__selector.register(self.__sock, selectors.EVENT_READ, self.handle_event)
+
+    def handle_event(self, mask: int) -> None:
+        try:
+            if self.__bytes_amount == -1:
+                self.__read_request()
+                return
+            if mask & selectors.EVENT_READ and self.__upload_left > 0:
+                self.__receive()
+            if mask & selectors.EVENT_WRITE:
+                self.__send()
+            self.__update_events()
+        except BlockingIOError:
+            pass
+        except Exception as e:
+            logger.error(f'Error: failed to handle tcp client: {e}')
+            if self.__bytes_amount != -1:
+                self.__counters.send_errors += 1
+                self.__counters.finish_transfer(time.perf_counter() - self.__start_time)
+            self.__close()
+
+    def waiting_for_request(self, now: float) -> bool:
+        """
+        Closes the connection if the client did not send its request in time.
+        Returns whether the transfer is still waiting for the request
+        """
+        if self.__bytes_amount != -1 or self.__sock.fileno() == -1:
+            return False
+        if now < self.__request_deadline:
+            return True
+        logger.error('Error: invalid request from TCP client: timed out waiting for the request')
+        self.__counters.invalid_requests += 1
+        self.__close()
+        return False
+
+    def __read_request(self) -> None:
+        """
+        Reads the available part of the request line, and starts the transfer once it is complete
+        """
+        line: bytes | None
+        request: TcpRequest
+        try:
+            line = self.__request_reader.receive(self.__sock)
+            if line is None:
+                return
+            request = parse_request(line)
+        except RequestError as e:
+            logger.error(f'Error: invalid request from TCP client: {e}')
+            self.__counters.invalid_requests += 1
+            self.__close()
+            return
+
+        self.__direction = request.direction
+        bytes_amount: int = request.size
+        self.__transfers = 2 if self.__direction == DIRECTION_BOTH else 1
+        reason: int | None = self.__admission.admit(self.__address[0], bytes_amount, self.__transfers)
+        if reason is not None:
+            self.__selector.unregister(self.__sock)
+            Server.reject_tcp_client(self.__sock, self.__address, reason, self.__counters)
+            return
+
+        if logger.enabled(logger.DEBUG):
+            logger.debugging(f'Starting a TCP {self.__direction} of {bytes_amount} bytes'
+                             f'{f" from offset {request.offset}" if request.offset else ""}...')
+        self.__counters.transfers_started += 1
+        self.__start_time = time.perf_counter()
+        self.__bytes_amount = bytes_amount
+        self.__report.seed = request.pattern_seed()
+        if self.__direction != DIRECTION_UPLOAD:
+            self.__download_amount = bytes_amount
+        if self.__direction != DIRECTION_DOWNLOAD:
+            already_received: int = min(len(self.__request_reader.extra_bytes()), bytes_amount)
+            self.__counters.bytes_received += already_received
+            self.__upload_left = bytes_amount - already_received
+            self.__upload_start_ns = time.perf_counter_ns()
+            if self.__upload_left == 0:
+                self.__finish_upload()
+        self.__update_events()
+
+    def __receive(self) -> None:
+        received: int = self.__payload_sink.receive_chunk(self.__sock, self.__upload_left)
+        self.__counters.bytes_received += received
+        self.__upload_left -= received
+        if self.__upload_left == 0:
+            self.__finish_upload()
+
+    def __finish_upload(self) -> None:
+        self.__upload_report = memoryview(pack_report(0, self.__bytes_amount,
+                                                      time.perf_counter_ns() - self.__upload_start_ns))
+
+    def __send(self) -> None:
+        bytes_left: int = self.__download_amount - self.__report.bytes_sent
+        if bytes_left > 0:
+            self.__counters.bytes_sent += self.__payload_engine.send_chunk(self.__sock, bytes_left, self.__report)
+        elif self.__upload_report is not None:
+            # the report follows the whole payload sent to the client
+            sent: int = self.__sock.send(self.__upload_report)
+            self.__upload_report = self.__upload_report[sent:] if sent < len(self.__upload_report) else None
+
+    def __update_events(self) -> None:
+        """
+        Waits for whatever the transfer still needs, finishing it once it needs nothing
+        """
+        events: int = 0
+        if self.__upload_left > 0:
+            events |= selectors.EVENT_READ
+        if self.__report.bytes_sent < self.__download_amount or self.__upload_report is not None:
+            events |= selectors.EVENT_WRITE
+        if events == 0:
+            self.__close()
+            duration: float = time.perf_counter() - self.__start_time
+            self.__counters.finish_transfer(duration)
+            if logger.enabled(logger.DEBUG):
+                logger.debugging(f'Finished TCP {self.__direction}: {self.__report}')
+            if self.__on_transfer is not None:
+                self.__on_transfer('TCP', self.__download_amount,
+                                   0 if self.__direction == DIRECTION_DOWNLOAD else self.__bytes_amount, duration)
+        elif events != self.__events:
+            self.__events = events
+            self.__selector.modify(self.__sock, events, self.handle_event)
+
+    def __close(self) -> None:
+        self.__selector.unregister(self.__sock)
+        self.__sock.close()
+        if self.__bytes_amount != -1:
+            self.__admission.release(self.__address[0], self.__bytes_amount, self.__transfers)
+
+
+class UdpTransfer:
+    """
+    A UDP client request handled by the event loop.
+    Sends one batch of segments every time its socket becomes writable.
+    A reliable transfer also waits for the client's NACKs, fed to it by the event loop
+    """
+    __sock: socket.socket
+    __address: tuple[str, int]
+    __sender: UdpSegmentSender | ReliableSegmentSender
+    __reliable: ReliableSegmentSender | None
+    __report: UdpSendReport
+    __file_size: int
+    __start_time: float
+    __admission: AdmissionControl
+    __on_transfer: TransferCallback | None
+    __counters: ProtocolCounters
+
+    def __init__(self, sock: socket.socket, address: tuple[str, int], file_size: int, payload_size: int,
+                 admission: AdmissionControl, on_transfer: TransferCallback | None, counters: ProtocolCounters,
+                 reliable: bool = False, seed: int | None = None):
+        self.__sock = sock
+        self.__address = address
+        self.__admission = admission
+        self.__file_size = file_size
+        self.__start_time = time.perf_counter()
+        self.__on_transfer = on_transfer
+        self.__counters = counters
+        self.__counters.transfers_started += 1
+        self.__reliable = None
+        if reliable:
+            self.__sender = self.__reliable = ReliableSegmentSender(sock, address, file_size, payload_size,
+                                                                    seed=seed)
+        else:
+            self.__sender = UdpSegmentSender(sock, address, file_size, payload_size, seed=seed)
+        self.__report = UdpSendReport()
+        if logger.enabled(logger.DEBUG):
+            logger.debugging(f'Sending {file_size} bytes to client in {self.__sender.segments_amount} '
+                             f'segments of {payload_size} bytes over {"reliable " if reliable else ""}UDP...')
+
+    def send_batch(self) -> bool:
+        """
+        Sends the next batch of segments.
+        Returns whether the transfer is finished
+        """
+        finished: bool = send_counted_batch(self.__sender, self.__report, self.__counters)
+        if finished:
+            self.__finish()
+        return finished
+
+    def feed(self, message: bytes) -> None:
+        """
+        Hands a NACK of the client to a reliable transfer
+        """
+        self.__reliable.feed(message)
+
+    def waiting(self) -> bool:
+        """
+        Returns whether a reliable transfer has nothing to send before the client's next NACK
+        """
+        return self.__reliable is not None and self.__reliable.waiting()
+
+    def expired(self) -> bool:
+        """
+        Finishes a reliable transfer whose client stayed silent too long.
+        Returns whether the transfer expired
+        """
+        if self.__reliable is None or not self.__reliable.check_timeout():
+            return False
+        self.__finish()
+        return True
+
+    def __finish(self) -> None:
+        self.__admission.release(self.__address[0], self.__file_size)
+        duration: float = time.perf_counter() - self.__start_time
+        self.__counters.finish_transfer(duration)
+        if logger.enabled(logger.DEBUG):
+            logger.debugging(f'Finished sending data in UDP connection {self.__address}: {self.__report}')
+        if self.__on_transfer is not None:
+            self.__on_transfer('UDP', self.__file_size, 0, duration)
+
+
+class EventServer:
+    """
+    Single-threaded server core, running the same protocol as Server.
+    One selector (epoll on Linux) multiplexes the TCP accept socket, the UDP request
+    socket and all active transfers, each of which is a resumable state machine that
+    sends whenever its socket is writable. Offers are sent from the same loop.
+    There are no worker threads, so the pool and queue sizes of the admission limits
+    together bound the transfers at once.
+    """
+    __udp_port: int
+    __tcp_port: int
+    __broadcast_port: int
+    __subnetmask: str
+    __reuse_udp_socket: bool
+    __reuse_port: bool
+    __announce: bool
+    __on_transfer: TransferCallback | None
+    __shutdown: bool
+
+    __offer_sock: socket.socket
+    __udp_sock: socket.socket
+    __tcp_sock: socket.socket
+    __wakeup_socks: tuple[socket.socket, socket.socket]
+    __selector: selectors.BaseSelector
+    __payload_engine: PayloadEngine
+    __payload_sink: PayloadSink
+    # transfers sending from the shared UDP socket, served round robin
+    __shared_udp_transfers: collections.deque
+    # TCP connections that did not send their request yet
+    __waiting_tcp_transfers: list[TcpTransfer]
+    # reliable UDP transfers by client address, with their socket and its event handler.
+    # A transfer waiting for its client's NACK is unregistered from the selector
+    __reliable_udp_transfers: dict[tuple[str, int], tuple[UdpTransfer, socket.socket, Callable[[int], None]]]
+    # UDP uploads being received, with their client address and size, by their socket
+    __udp_uploads: dict[socket.socket, tuple[UdpUpload, tuple[str, int], int]]
+    __admission: AdmissionControl
+    __max_transfers: int
+    broadcast_ip: str
+    # the event loop is a single thread, so all the counters live in one shard
+    stats: ServerStats
+    __counters: StatsShard
+
+    def __init__(self, udp_port: int, tcp_port: int, broadcast_port: int,
+                 subnetmask: str, reuse_udp_socket: bool = False, reuse_port: bool = False,
+                 announce: bool = True, on_transfer: TransferCallback | None = None,
+                 limits: AdmissionLimits | None = None):
+        self.__shutdown = False
+        self.__udp_port = udp_port
+        self.__tcp_port = tcp_port
+        self.__broadcast_port = broadcast_port
+        self.__subnetmask = subnetmask
+        self.__reuse_udp_socket = reuse_udp_socket
+        # allow several server processes to share the ports, load balanced by the kernel
+        self.__reuse_port = reuse_port
+        # whether to broadcast offers and show the waiting animation
+        self.__announce = announce
+        self.__on_transfer = on_transfer
+        self.broadcast_ip = ''
+        self.__payload_engine = PayloadEngine(pattern=True)
+        # uploads are never read, so every connection receives into the same buffer
+        self.__payload_sink = PayloadSink(discard=True)
+        self.__shared_udp_transfers = collections.deque()
+        self.__waiting_tcp_transfers = []
+        self.__reliable_udp_transfers = {}
+        self.__udp_uploads = {}
+        if limits is None:
+            limits = AdmissionLimits()
+        self.__max_transfers = limits.pool_size + limits.queue_size
+        self.__admission = AdmissionControl(limits, self.__max_transfers)
+        self.__wakeup_socks = socket.socketpair()
+        self.stats = ServerStats()
+
+    def run(self) -> None:
+        """
+        Runs the server: opens the UDP and TCP servers, and runs the event loop until
+        the server is shut down and all active transfers are finished
+        """
+        server_ip: str
+        server_ip, self.broadcast_ip = Server.resolve_addresses(self.__subnetmask)
+
+        self.__udp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.__tcp_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.__offer_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            if self.__reuse_port:
+                self.__udp_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+                self.__tcp_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            self.__udp_sock.bind(('', self.__udp_port))
+            self.__tcp_sock.bind(('', self.__tcp_port))
+            self.__tcp_sock.listen()
+            self.__offer_sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        except OSError as e:
+            logger.error(f'Error: failed to open server sockets: {e}')
+            self.__udp_sock.close()
+            self.__tcp_sock.close()
+            self.__offer_sock.close()
+            return
+        self.__udp_sock.setblocking(False)
+        self.__udp_sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, UDP_SEND_BUFFER_SIZE)
+        self.__tcp_sock.setblocking(False)
+        self.__wakeup_socks[0].setblocking(False)
+
+        self.__counters = self.stats.shard()
+        self.__selector = selectors.DefaultSelector()
+        self.__selector.register(self.__tcp_sock, selectors.EVENT_READ, self.__accept_tcp)
+        self.__selector.register(self.__udp_sock, selectors.EVENT_READ, self.__handle_udp_sock)
+        self.__selector.register(self.__wakeup_socks[0], selectors.EVENT_READ, self.__wake_up)
+
+        if self.__announce:
+            logger.info(f'Broadcasting to address {self.broadcast_ip}')
+            logger.info(f'Server started in event loop mode, listening on IP address {server_ip}')
+            teapot_gen.init()
+            threading.Thread(target=teapot_gen.start).start()
+        else:
+            logger.debugging(f'Server started in event loop mode, listening on IP address {server_ip}')
+
+        self.__event_loop()
+        self.__selector.close()
+        logger.debugging('Event loop stopped')
+
+    def shutdown(self) -> None:
+        """
+        Shuts down the server, preventing it from receiving further new client connections.
+        Finishes handling existing connections before termination
+        """
+        logger.info('Terminating server...')
+        self.__shutdown = True
+        teapot_gen.stop()
+        # wake the event loop up, so it closes the servers
+        self.__wakeup_socks[1].send(b'\0')
+
+    def __event_loop(self) -> None:
+        next_offer: float = time.monotonic()
+        while not self.__shutdown:
+            now: float = time.monotonic()
+            if now >= next_offer:
+                if self.__announce:
+                    self.__send_udp_offer()
+                next_offer = now + OFFER_INTERVAL
+                self.__expire_tcp_requests(now)
+                self.__expire_reliable_udp_transfers()
+                self.__expire_udp_uploads()
+            for key, mask in self.__selector.select(max(0.0, next_offer - time.monotonic())):
+                key.data(mask)
+
+        self.__close_servers()
+        # wrap up the active transfers - everything still registered, and the reliable
+        # transfers, which expire once their NACKs stop arriving at the closed server
+        while self.__selector.get_map() or self.__reliable_udp_transfers:
+            for key, mask in self.__selector.select(OFFER_INTERVAL):
+                key.data(mask)
+            self.__expire_tcp_requests(time.monotonic())
+            self.__expire_reliable_udp_transfers()
+            self.__expire_udp_uploads()
+
+    def __expire_tcp_requests(self, now: float) -> None:
+        """
+        Drops TCP connections which did not send their request before the deadline
+        """
+        self.__waiting_tcp_transfers = [transfer for transfer in self.__waiting_tcp_transfers
+                                        if transfer.waiting_for_request(now)]
+
+    def __close_servers(self) -> None:
+        """
+        Stops the offers and the TCP and UDP servers, leaving active transfers running
+        """
+        self.__offer_sock.close()
+        if self.__announce:
+            logger.debugging('Stopped sending offers')
+        self.__selector.unregister(self.__tcp_sock)
+        self.__tcp_sock.close()
+        logger.debugging('Closed TCP server')
+        self.__selector.unregister(self.__wakeup_socks[0])
+        self.__wakeup_socks[0].close()
+        self.__wakeup_socks[1].close()
+        if self.__shared_udp_transfers:
+            # the shared socket is still sending - stop only reading requests from it
+            self.__selector.modify(self.__udp_sock, selectors.EVENT_WRITE, self.__handle_udp_sock)
+        else:
+            self.__selector.unregister(self.__udp_sock)
+            self.__udp_sock.close()
+        logger.debugging('Closed UDP server')
+
+    def __wake_up(self, mask: int) -> None:
+        try:
+            self.__wakeup_socks[0].recv(MAX_MESSAGE_LEN)
+        except BlockingIOError:
+            pass
+
+    def __send_udp_offer(self) -> None:
+        message: bytes = Server.build_offer_message(self.__udp_port, self.__tcp_port)
+        try:
+            self.__offer_sock.sendto(message, (self.broadcast_ip, self.__broadcast_port))
+        except OSError as e:
+            logger.error(f'Error: failed to send offer: {e}')
+
+    def __accept_tcp(self, mask: int) -> None:
+        try:
+            client_sock, address = self.__tcp_sock.accept()
+        except BlockingIOError:
+            return
+        except OSError as e:
+            logger.error(f'Error: failed to accept new TCP client: {e}')
+            return
+        teapot_gen.stop()
+        self.__counters.tcp.accepted += 1
+        if logger.enabled(logger.DEBUG):
+            logger.debugging(f'Accepted TCP client {address}')
+        if self.__admission.active() + len(self.__waiting_tcp_transfers) >= self.__max_transfers:
+            # connections which sent their request since the last tick are counted as admitted too
+            self.__expire_tcp_requests(time.monotonic())
+        if self.__admission.active() + len(self.__waiting_tcp_transfers) >= self.__max_transfers:
+            Server.reject_tcp_client(client_sock, address, REJECT_BUSY, self.__counters.tcp)
+            return
+        self.__waiting_tcp_transfers.append(TcpTransfer(client_sock, address, self.__selector,
+                                                        self.__payload_engine, self.__payload_sink,
+                                                        self.__admission, self.__on_transfer, self.__counters.tcp))
+
+    def __handle_udp_sock(self, mask: int) -> None:
+        if mask & selectors.EVENT_READ:
+            self.__receive_udp_requests()
+        if mask & selectors.EVENT_WRITE:
+            self.__send_shared_udp_batch()
+
+    def __receive_udp_requests(self) -> None:
+        for _ in range(MAX_UDP_REQUESTS_PER_EVENT):
+            try:
+                data, address = self.__udp_sock.recvfrom(MAX_MESSAGE_LEN)
+            except BlockingIOError:
+                return
+            except OSError as e:
+                logger.error(f'Error: failed to receive new UDP message: {e}')
+                return
+            message_type: int | None = message_type_of(data)
+            if message_type == MSG_NACK:
+                self.__route_nack(data, address)
+                continue
+            if message_type == MSG_PROBE:
+                Server.echo_probe(self.__udp_sock, data, address, self.__counters.udp)
+                continue
+            teapot_gen.stop()
+            self.__counters.udp.accepted += 1
+            if logger.enabled(logger.DEBUG):
+                logger.debugging(f'Accepted UDP client {address}')
+            request: tuple[int, int, int, int] | None = Server.parse_udp_request(data)
+            if request is None:
+                self.__counters.udp.invalid_requests += 1
+                continue
+            file_size, client_max_payload_size, flags, seed = request
+            try:
+                direction: str = request_direction(flags)
+            except ProtocolError as e:
+                logger.error(f'Error: received invalid request from UDP client: {e}')
+                self.__counters.udp.invalid_requests += 1
+                continue
+            reason: int | None = self.__admission.admit(address[0], file_size,
+                                                        2 if direction == DIRECTION_BOTH else 1)
+            if reason is not None:
+                Server.reject_udp_request(self.__udp_sock, address, reason, self.__counters.udp)
+                continue
+            if direction != DIRECTION_DOWNLOAD:
+                self.__start_udp_upload(address, file_size, client_max_payload_size)
+            if direction != DIRECTION_UPLOAD:
+                self.__start_udp_transfer(address, file_size, client_max_payload_size, flags, seed)
+
+    def __start_udp_transfer(self, address: tuple[str, int], file_size: int, client_max_payload_size: int,
+                             flags: int, seed: int) -> None:
+        payload_size: int = negotiate_payload_size(address, client_max_payload_size)
+        pattern_seed: int | None = seed if flags & REQUEST_VERIFY else None
+        if flags & REQUEST_RELIABLE:
+            self.__start_reliable_udp_transfer(address, file_size, payload_size, pattern_seed)
+            return
+        if self.__reuse_udp_socket:
+            if not self.__shared_udp_transfers:
+                self.__selector.modify(self.__udp_sock, selectors.EVENT_READ | selectors.EVENT_WRITE,
+                                       self.__handle_udp_sock)
+            self.__shared_udp_transfers.append(UdpTransfer(self.__udp_sock, address, file_size, payload_size,
+                                                          self.__admission, self.__on_transfer,
+                                                          self.__counters.udp, seed=pattern_seed))
+            return
+
+        sock: socket.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, send_buffer_size(payload_size, UDP_SEND_BUFFER_SIZE))
+        sock.setblocking(False)
+        transfer: UdpTransfer = UdpTransfer(sock, address, file_size, payload_size, self.__admission,
+                                            self.__on_transfer, self.__counters.udp, seed=pattern_seed)
+
+        def handle_event(mask: int) -> None:
+            if transfer.send_batch():
+                self.__selector.unregister(sock)
+                sock.close()
+
+        self.__selector.register(sock, selectors.EVENT_WRITE, handle_event)
+
+    def __start_reliable_udp_transfer(self, address: tuple[str, int], file_size: int, payload_size: int,
+                                      seed: int | None) -> None:
+        """
+        Starts a reliable UDP transfer, always from its own socket: while it waits for the
+        client's NACKs, its socket is unregistered instead of being polled
+        """
+        sock: socket.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, send_buffer_size(payload_size, UDP_SEND_BUFFER_SIZE))
+        sock.setblocking(False)
+        transfer: UdpTransfer = UdpTransfer(sock, address, file_size, payload_size, self.__admission,
+                                            self.__on_transfer, self.__counters.udp, reliable=True, seed=seed)
+
+        def handle_event(mask: int) -> None:
+            if transfer.send_batch():
+                self.__close_reliable_udp_transfer(address)
+            elif transfer.waiting():
+                self.__selector.unregister(sock)
+
+        self.__reliable_udp_transfers[address] = (transfer, sock, handle_event)
+        self.__selector.register(sock, selectors.EVENT_WRITE, handle_event)
+
+    def __route_nack(self, data: bytes, address: tuple[str, int]) -> None:
+        """
+        Hands a NACK to the reliable UDP transfer of the client which sent it, resuming
+        the transfer if it was waiting
+        """
+        entry: tuple[UdpTransfer, socket.socket, Callable[[int], None]] | None = \
+            self.__reliable_udp_transfers.get(address)
+        if entry is None:
+            # the client repeats its final acknowledgement, which may outlive the transfer
+            if logger.enabled(logger.DEBUG):
+                logger.debugging(f'Ignored a NACK from {address}, which has no reliable UDP transfer')
+            return
+        transfer, sock, handle_event = entry
+        transfer.feed(data)
+        if sock not in self.__selector.get_map():
+            self.__selector.register(sock, selectors.EVENT_WRITE, handle_event)
+
+    def __start_udp_upload(self, address: tuple[str, int], file_size: int, max_payload_size: int) -> None:
+        """
+        Starts receiving a UDP client's upload on a socket of its own
+        """
+        sock: socket.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            sock.bind(('', 0))
+            upload: UdpUpload = UdpUpload(sock, address, file_size, max_payload_size, self.__counters.udp)
+            # the receiver makes the socket blocking, but the event loop never waits on it
+            sock.setblocking(False)
+            upload.start()
+        except OSError as e:
+            logger.error(f'Error: failed to receive upload from UDP client {address}: {e}')
+            sock.close()
+            self.__admission.release(address[0], file_size)
+            return
+
+        def handle_event(mask: int) -> None:
+            upload.receive(0)
+            if upload.finished():
+                self.__finish_udp_upload(sock)
+
+        self.__udp_uploads[sock] = (upload, address, file_size)
+        self.__selector.register(sock, selectors.EVENT_READ, handle_event)
+
+    def __expire_udp_uploads(self) -> None:
+        """
+        Finishes the uploads whose clients stopped sending
+        """
+        for sock, (upload, _, _) in list(self.__udp_uploads.items()):
+            if upload.finished():
+                self.__finish_udp_upload(sock)
+
+    def __finish_udp_upload(self, sock: socket.socket) -> None:
+        upload, address, file_size = self.__udp_uploads.pop(sock)
+        self.__admission.release(address[0], file_size)
+        duration: float = upload.finish()
+        self.__selector.unregister(sock)
+        sock.close()
+        if self.__on_transfer is not None:
+            self.__on_transfer('UDP', 0, upload.bytes_received, duration)
+
+    def __expire_reliable_udp_transfers(self) -> None:
+        for address, (transfer, _, _) in list(self.__reliable_udp_transfers.items()):
+            if transfer.expired():
+                self.__close_reliable_udp_transfer(address)
+
+    def __close_reliable_udp_transfer(self, address: tuple[str, int]) -> None:
+        _, sock, _ = self.__reliable_udp_transfers.pop(address)
+        if sock in self.__selector.get_map():
+            self.__selector.unregister(sock)
+        sock.close()
+
+    def __send_shared_udp_batch(self) -> None:
+        """
+        Sends one batch of the next transfer sharing the UDP socket, round robin
+        """
+        transfer: UdpTransfer = self.__shared_udp_transfers.popleft()
+        if not transfer.send_batch():
+            self.__shared_udp_transfers.append(transfer)
+        if self.__shared_udp_transfers:
+            return
+
+        if self.__shutdown:
+            self.__selector.unregister(self.__udp_sock)
+            self.__udp_sock.close()
+        else:
+            self.__selector.modify(self.__udp_sock, selectors.EVENT_READ, self.__handle_udp_sock)
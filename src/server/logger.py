@@ -1,9 +1,44 @@
+import atexit
+import json
+import queue
 import random
+import sys
+import threading
+import time
+from typing import TextIO
+
+DEBUG = 10
+INFO = 20
+ERROR = 40
+LEVEL_NAMES = {DEBUG: 'debug', INFO: 'info', ERROR: 'error'}
+LEVELS = {name: level for level, name in LEVEL_NAMES.items()}
+FORMAT_PLAIN = 'plain'
+FORMAT_JSON = 'json'
+# records waiting to be written; when the writer falls behind, new records are dropped
+# and counted instead of blocking the caller
+QUEUE_SIZE = 10000
+# records formatted and written together in a single write call
+BATCH_SIZE = 256
+
+sea_start_color=(193, 255, 254) # Teal
+sea_end_color=(0, 79, 118) # Deep Blue
+
+level: int = DEBUG
+log_format: str = FORMAT_PLAIN
+log_path: str | None = None
+color: bool = sys.stdout.isatty()
+stream: TextIO = sys.stdout
+records: queue.Queue = queue.Queue(QUEUE_SIZE)
+dropped: int = 0
+writer: threading.Thread | None = None
+writer_lock: threading.Lock = threading.Lock()
 
 def gradient_color(start_color, end_color, steps):
     """
     Generate a gradient between two RGB colors over a given number of steps.
     """
+    if steps < 2:
+        return [start_color]
     gradient = [
         (
             int(start_color[0] + (end_color[0] - start_color[0]) * i / (steps - 1)),
@@ -20,29 +55,116 @@ def rgb_to_ansi(r, g, b):
     """
     return f"\033[38;2;{r};{g};{b}m"
 
-def info(string):
+def configure(level_name: str = 'debug', format: str = FORMAT_PLAIN, path: str | None = None) -> None:
     """
-    Print a string where each character is in a random color from a sea gradient.
+    Sets the lowest level written, and where records are written: appended to a file in the
+    plain or JSON format, or to the standard output, colored only when it is a terminal
     """
-    sea_start_color=(193, 255, 254) # Teal
-    sea_end_color=(0, 79, 118) # Deep Blue
+    global level, log_format, log_path, color, stream
+    flush()
+    if stream is not sys.stdout:
+        stream.close()
+    level = LEVELS[level_name]
+    log_format = format
+    log_path = path
+    stream = sys.stdout if path is None else open(path, 'a')
+    color = path is None and sys.stdout.isatty()
 
-    gradient = gradient_color(sea_start_color, sea_end_color, len(string))
-    for char in string:
-        r, g, b = random.choice(gradient)  # Randomly pick a color from the gradient
-        print(rgb_to_ansi(r, g, b) + char, end="")
-    print("\033[0m")
+def settings() -> dict:
+    """
+    Returns the arguments of configure which reproduce the current configuration,
+    e.g. for a worker process
+    """
+    return {'level_name': LEVEL_NAMES[level], 'format': log_format, 'path': log_path}
+
+def enabled(record_level: int) -> bool:
+    """
+    Returns whether records of the level are written, so that callers can skip building
+    expensive messages
+    """
+    return record_level >= level
+
+def info(string):
+    """
+    Queues an info record, written in a sea gradient when the output is a terminal
+    """
+    if INFO >= level:
+        log(INFO, string)
 
 def error(string):
     """
-    Print a string in red.
+    Queues an error record, written in red when the output is a terminal
     """
-    print("\033[91m" + "!>ERR: " + string + "\033[0m")
+    if ERROR >= level:
+        log(ERROR, string)
 
 def debugging(string):
     """
-    Print en default.
+    Queues a debug record, written in italics when the output is a terminal.
+    Callers on the hot path check enabled(DEBUG) first, to skip building the message
+    """
+    if DEBUG >= level:
+        log(DEBUG, string)
+
+def log(record_level: int, string: str) -> None:
+    """
+    Queues a record for the writer thread, never blocking
+    """
+    global dropped
+    if writer is None:
+        start_writer()
+    try:
+        records.put_nowait((time.time(), record_level, string))
+    except queue.Full:
+        dropped += 1
+
+def flush() -> None:
+    """
+    Waits until every queued record is written
     """
-    print("\033[3m" + "?>DBG: " + string + "\033[0m")
+    if writer is not None:
+        records.join()
+
+def start_writer() -> None:
+    global writer
+    with writer_lock:
+        if writer is None:
+            writer = threading.Thread(target=write_loop, daemon=True)
+            writer.start()
+
+def write_loop() -> None:
+    global dropped
+    while True:
+        batch: list[tuple[float, int, str]] = [records.get()]
+        while len(batch) < BATCH_SIZE:
+            try:
+                batch.append(records.get_nowait())
+            except queue.Empty:
+                break
+        queued: int = len(batch)
+        if dropped > 0:
+            lost, dropped = dropped, 0
+            batch.append((time.time(), ERROR, f'{lost} log records dropped, the log output is too slow'))
+        try:
+            stream.write(''.join(format_record(*record) for record in batch))
+            stream.flush()
+        except (OSError, ValueError):
+            pass
+        for _ in range(queued):
+            records.task_done()
+
+def format_record(timestamp: float, record_level: int, string: str) -> str:
+    if log_format == FORMAT_JSON and log_path is not None:
+        return json.dumps({'time': timestamp, 'level': LEVEL_NAMES[record_level], 'message': string}) + '\n'
+    if not color:
+        stamp: str = time.strftime('%H:%M:%S', time.localtime(timestamp)) + f'.{int(timestamp % 1 * 1000):03d}'
+        return f'{stamp} {LEVEL_NAMES[record_level].upper():<5} {string}\n'
+    if record_level == ERROR:
+        return "\033[91m" + "!>ERR: " + string + "\033[0m\n"
+    if record_level == DEBUG:
+        return "\033[3m" + "?>DBG: " + string + "\033[0m\n"
+    # each character in a random color from a sea gradient
+    gradient = gradient_color(sea_start_color, sea_end_color, len(string))
+    return ''.join(rgb_to_ansi(*random.choice(gradient)) + char for char in string) + "\033[0m\n"
 
-# print_sea("Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod tempor incididunt ut labore et dolore magna aliqua. Ut enim ad minim veniam, quis nostrud exercitation ullamco laboris nisi ut aliquip ex ea commodo consequat. Duis aute irure dolor in reprehenderit in voluptate velit esse cillum dolore eu fugiat nulla pariatur. Excepteur sint occaecat cupidatat non proident, sunt in culpa qui officia deserunt mollit anim id est laborum.")
+atexit.register(flush)
@@ -1,42 +1,106 @@
+import argparse
+import os
 import sys
 import threading
 
+# the wire format and the transfer engines are shared by the server and the client
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common'))
+
 import logger
+import teapot_gen
+from admission import AdmissionLimits, DEFAULT_MAX_CLIENT_BYTES, DEFAULT_MAX_CLIENT_TRANSFERS
+from event_server import EventServer
+from prefork import PreforkServer
 from server import Server
-
-# command line arguments indexes
-UDP_PORT_INDEX = 1
-TCP_PORT_INDEX = 2
-BROADCAST_PORT_INDEX = 3
-SUBNETMASK_INDEX = 4
+from stats import StatsEndpoint
+from worker_pool import DEFAULT_POOL_SIZE, DEFAULT_QUEUE_SIZE
 
 
 def main() -> None:
-    udp_port: int
-    tcp_port: int
-    broadcast_port: int
-    subnetmask: str
-
-    try:
-        udp_port = int(sys.argv[UDP_PORT_INDEX])
-        tcp_port = int(sys.argv[TCP_PORT_INDEX])
-        broadcast_port = int(sys.argv[BROADCAST_PORT_INDEX])
-        subnetmask = sys.argv[SUBNETMASK_INDEX]
-    except Exception:
-        logger.error("Invalid command line arguments. Format: <udp_port> <tcp_port> <broadcast_port> <subnetmask>")
-        return
-    
-    server: Server = Server(udp_port, tcp_port, broadcast_port, subnetmask)
+    args: argparse.Namespace = parse_args()
+    logger.configure(args.log_level, args.log_format, args.log_file)
+    if args.no_animation:
+        teapot_gen.disable()
+
+    limits: AdmissionLimits = AdmissionLimits(args.pool_size, args.queue_size, args.max_client_transfers,
+                                              args.max_client_bytes)
+    server: Server | EventServer | PreforkServer
+    if args.workers > 0:
+        server = PreforkServer(args.udp_port, args.tcp_port, args.broadcast_port, args.subnetmask,
+                               args.workers, mode=args.mode, reuse_udp_socket=args.reuse_udp_socket,
+                               stats_port=args.stats_port, limits=limits)
+    elif args.mode == 'event':
+        server = EventServer(args.udp_port, args.tcp_port, args.broadcast_port, args.subnetmask,
+                             reuse_udp_socket=args.reuse_udp_socket, limits=limits)
+    else:
+        server = Server(args.udp_port, args.tcp_port, args.broadcast_port, args.subnetmask,
+                        reuse_udp_socket=args.reuse_udp_socket, limits=limits)
+    stats_endpoint: StatsEndpoint | None = None
+    if args.stats_port > 0 and args.workers == 0:
+        stats_endpoint = StatsEndpoint(server.stats, args.stats_port)
+        stats_endpoint.start()
     logger.info('Starting server. Press any key to terminate')
     threading.Thread(target=server.run).start()
-    threading.Thread(target=shutdown, args=(server, )).start()
+    threading.Thread(target=shutdown, args=(server, stats_endpoint)).start()
+
+def parse_args() -> argparse.Namespace:
+    """
+    Parses the server's command line arguments
+    """
+    parser: argparse.ArgumentParser = argparse.ArgumentParser(description='Speed test server')
+    parser.add_argument('udp_port', type=int)
+    parser.add_argument('tcp_port', type=int)
+    parser.add_argument('broadcast_port', type=int)
+    parser.add_argument('subnetmask', type=str)
+    parser.add_argument('--mode', choices=('threaded', 'event'), default='threaded',
+                        help='threaded: a thread per connection, event: a single-threaded event loop')
+    parser.add_argument('--workers', type=non_negative_int, default=0,
+                        help='run the server as this many worker processes sharing the ports (SO_REUSEPORT)')
+    parser.add_argument('--reuse-udp-socket', action='store_true',
+                        help='send UDP payloads from the server socket instead of a new socket per request')
+    parser.add_argument('--pool-size', type=positive_int, default=DEFAULT_POOL_SIZE,
+                        help='worker threads handling transfers, a bidirectional transfer runs one more helper '
+                             f'thread (default: {DEFAULT_POOL_SIZE})')
+    parser.add_argument('--queue-size', type=positive_int, default=DEFAULT_QUEUE_SIZE,
+                        help='transfers waiting for a worker before new requests are rejected as busy; '
+                             'in event mode, pool and queue size together bound the transfers at once '
+                             f'(default: {DEFAULT_QUEUE_SIZE})')
+    parser.add_argument('--max-client-transfers', type=positive_int, default=DEFAULT_MAX_CLIENT_TRANSFERS,
+                        help='concurrent transfers a single client address may run, and TCP connections it '
+                             f'may hold open before sending their request (default: {DEFAULT_MAX_CLIENT_TRANSFERS})')
+    parser.add_argument('--max-client-bytes', type=positive_int, default=DEFAULT_MAX_CLIENT_BYTES,
+                        help='bytes the active transfers of a single client address may request '
+                             f'(default: {DEFAULT_MAX_CLIENT_BYTES})')
+    parser.add_argument('--stats-port', type=int, default=0,
+                        help='serve live statistics on 127.0.0.1:PORT (/stats as JSON, /metrics for Prometheus); '
+                             'worker processes use PORT + worker number')
+    parser.add_argument('--log-level', choices=list(logger.LEVELS), default='debug',
+                        help='lowest level of the messages written (default: debug)')
+    parser.add_argument('--log-file', help='append the log to this file instead of the standard output')
+    parser.add_argument('--log-format', choices=[logger.FORMAT_PLAIN, logger.FORMAT_JSON], default=logger.FORMAT_PLAIN,
+                        help='format of the log file (default: plain)')
+    parser.add_argument('--no-animation', action='store_true',
+                        help='never show the idle animation (it is only shown on a terminal anyway)')
+    return parser.parse_args()
+
+def positive_int(value: str) -> int:
+    if not value.isdigit() or int(value) == 0:
+        raise argparse.ArgumentTypeError(f'expected a positive number, got: {value}')
+    return int(value)
+
+def non_negative_int(value: str) -> int:
+    if not value.isdigit():
+        raise argparse.ArgumentTypeError(f'expected a non-negative number, got: {value}')
+    return int(value)
 
-def shutdown(s: Server) -> None:
+def shutdown(s: Server | EventServer | PreforkServer, stats_endpoint: StatsEndpoint | None) -> None:
     """
     Listens for user input and then shuts down the server
     """
     input()
     s.shutdown()
+    if stats_endpoint is not None:
+        stats_endpoint.shutdown()
 
 
 if __name__ == '__main__':
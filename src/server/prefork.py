@@ -0,0 +1,197 @@
+import multiprocessing
+import multiprocessing.synchronize
+import socket
+import threading
+import time
+
+import logger
+from admission import AdmissionLimits
+from event_server import EventServer
+from server import Server
+from stats import StatsEndpoint
+
+OFFER_INTERVAL = 1
+
+
+class WorkerStats:
+    """
+    Transfer totals reported by a single worker process
+    """
+    transfers: int
+    bytes_sent: int
+    bytes_received: int
+    busy_time: float
+
+    def __init__(self):
+        self.transfers = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.busy_time = 0.0
+
+    def add(self, bytes_sent: int, bytes_received: int, duration: float) -> None:
+        self.transfers += 1
+        self.bytes_sent += bytes_sent
+        self.bytes_received += bytes_received
+        self.busy_time += duration
+
+
+def run_worker(worker_id: int, udp_port: int, tcp_port: int, subnetmask: str, mode: str,
+               reuse_udp_socket: bool, stop_event: multiprocessing.synchronize.Event,
+               stats_queue: multiprocessing.Queue, stats_port: int = 0, log_settings: dict | None = None,
+               limits: AdmissionLimits | None = None) -> None:
+    """
+    Entry point of a worker process: runs a server sharing the ports with the other
+    workers until the parent signals it to stop, reporting every finished transfer.
+    If a stats port is given, the worker serves its live statistics on stats_port + worker_id
+    """
+    if log_settings is not None:
+        logger.configure(**log_settings)
+
+    def report_transfer(protocol: str, bytes_sent: int, bytes_received: int, duration: float) -> None:
+        stats_queue.put((worker_id, protocol, bytes_sent, bytes_received, duration))
+
+    server_type: type = EventServer if mode == 'event' else Server
+    server: Server | EventServer = server_type(udp_port, tcp_port, 0, subnetmask,
+                                               reuse_udp_socket=reuse_udp_socket, reuse_port=True,
+                                               announce=False, on_transfer=report_transfer, limits=limits)
+    stats_endpoint: StatsEndpoint | None = None
+    if stats_port > 0:
+        stats_endpoint = StatsEndpoint(server.stats, stats_port + worker_id)
+        stats_endpoint.start()
+    server_thread: threading.Thread = threading.Thread(target=server.run)
+    server_thread.start()
+    stop_event.wait()
+    server.shutdown()
+    server_thread.join()
+    if stats_endpoint is not None:
+        stats_endpoint.shutdown()
+
+
+class PreforkServer:
+    """
+    Runs the server as a pool of worker processes, so transfers are not limited to a
+    single core by the GIL.
+    Every worker binds the TCP and UDP ports with SO_REUSEPORT, and the kernel spreads
+    new connections and requests across them. The parent process sends the offers and
+    collects per-worker statistics.
+    """
+    __udp_port: int
+    __tcp_port: int
+    __broadcast_port: int
+    __subnetmask: str
+    __workers_num: int
+    __mode: str
+    __reuse_udp_socket: bool
+    __stats_port: int
+    __limits: AdmissionLimits | None
+    __shutdown: bool
+
+    __offer_sock: socket.socket
+    __stop_event: multiprocessing.synchronize.Event
+    __stats_queue: multiprocessing.Queue
+    __workers: list[multiprocessing.Process]
+    __stats_thread: threading.Thread
+    __worker_stats: list[WorkerStats]
+    __start_time: float
+    broadcast_ip: str
+
+    def __init__(self, udp_port: int, tcp_port: int, broadcast_port: int, subnetmask: str,
+                 workers_num: int, mode: str = 'threaded', reuse_udp_socket: bool = False,
+                 stats_port: int = 0, limits: AdmissionLimits | None = None):
+        self.__udp_port = udp_port
+        self.__tcp_port = tcp_port
+        self.__broadcast_port = broadcast_port
+        self.__subnetmask = subnetmask
+        self.__workers_num = workers_num
+        self.__mode = mode
+        self.__reuse_udp_socket = reuse_udp_socket
+        self.__stats_port = stats_port
+        # the limits apply to every worker process on its own
+        self.__limits = limits
+        self.__shutdown = False
+        self.__workers = []
+        self.__worker_stats = [WorkerStats() for _ in range(workers_num)]
+        self.broadcast_ip = ''
+
+    def run(self) -> None:
+        """
+        Starts the worker processes and the statistics collector, and broadcasts offers
+        until the server is shut down
+        """
+        server_ip: str
+        server_ip, self.broadcast_ip = Server.resolve_addresses(self.__subnetmask)
+        self.__offer_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.__offer_sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+
+        # spawn rather than fork: the parent already runs threads, which do not survive a fork safely
+        context = multiprocessing.get_context('spawn')
+        self.__stop_event = context.Event()
+        self.__stats_queue = context.Queue()
+        self.__stats_thread = threading.Thread(target=self.collect_stats)
+        self.__stats_thread.start()
+        self.__start_time = time.perf_counter()
+        for worker_id in range(self.__workers_num):
+            worker: multiprocessing.Process = context.Process(
+                target=run_worker, args=(worker_id, self.__udp_port, self.__tcp_port, self.__subnetmask,
+                                         self.__mode, self.__reuse_udp_socket, self.__stop_event,
+                                         self.__stats_queue, self.__stats_port, logger.settings(),
+                                         self.__limits))
+            worker.start()
+            self.__workers.append(worker)
+
+        logger.info(f'Broadcasting to address {self.broadcast_ip}')
+        logger.info(f'Server started with {self.__workers_num} worker processes, '
+                    f'listening on IP address {server_ip}')
+
+        offer: bytes = Server.build_offer_message(self.__udp_port, self.__tcp_port)
+        while not self.__shutdown:
+            try:
+                self.__offer_sock.sendto(offer, (self.broadcast_ip, self.__broadcast_port))
+            except OSError as e:
+                if self.__shutdown:
+                    break
+                logger.error(f'Error: failed to send offer: {e}')
+            time.sleep(OFFER_INTERVAL)
+        logger.debugging('Stopped sending offers')
+
+    def shutdown(self) -> None:
+        """
+        Shuts down the workers, letting each of them finish its active transfers,
+        and prints the statistics of every worker
+        """
+        logger.info('Terminating server...')
+        self.__shutdown = True
+        self.__offer_sock.close()
+        self.__stop_event.set()
+        for worker in self.__workers:
+            worker.join()
+        self.__stats_queue.put(None)
+        self.__stats_thread.join()
+        self.print_stats()
+
+    def collect_stats(self) -> None:
+        """
+        Collects the transfers reported by the workers, until receiving a stop sentinel
+        """
+        while True:
+            message: tuple[int, str, int, int, float] | None = self.__stats_queue.get()
+            if message is None:
+                return
+            worker_id, _, bytes_sent, bytes_received, duration = message
+            self.__worker_stats[worker_id].add(bytes_sent, bytes_received, duration)
+
+    def print_stats(self) -> None:
+        """
+        Prints the transfer totals of every worker and of the whole pool
+        """
+        total: WorkerStats = WorkerStats()
+        for worker_id, stats in enumerate(self.__worker_stats):
+            logger.info(f'Worker #{worker_id}: {stats.transfers} transfers, {stats.bytes_sent} bytes sent, '
+                        f'{stats.bytes_received} bytes received, {stats.busy_time:.4f} seconds transferring')
+            total.transfers += stats.transfers
+            total.bytes_sent += stats.bytes_sent
+            total.bytes_received += stats.bytes_received
+        uptime: float = time.perf_counter() - self.__start_time
+        logger.info(f'All workers: {total.transfers} transfers, {total.bytes_sent} bytes sent '
+                    f'({(8 * total.bytes_sent / uptime):.4f} bits/second), {total.bytes_received} bytes received '
+                    f'({(8 * total.bytes_received / uptime):.4f} bits/second) on average over {uptime:.4f} seconds')
@@ -0,0 +1,169 @@
+import collections
+import queue
+import socket
+import time
+from array import array
+
+import logger
+from protocol import MSG_RETRANSMISSION, PAYLOAD_HEADER, ProtocolError, pack_payload_header_into, \
+    pack_segment_number_into, unpack_nack
+from udp_sender import PAYLOAD_BYTE, UdpSegmentSender, UdpSendReport, fill_pattern
+
+# segments sent beyond the first one the client has not acknowledged: bounds how far a
+# transfer runs ahead of its client, and so how much it may need to resend
+RETRANSMIT_WINDOW_BYTES = 16 * 1024 * 1024
+MIN_WINDOW_SEGMENTS = 64
+# a segment reported missing again within this time was probably reported before its
+# retransmission arrived, so it is not resent yet
+RETRANSMIT_HOLDOFF = 0.05
+# retransmissions sent in a single call, so new segments and feedback are not starved
+RETRANSMIT_BATCH = 64
+# a transfer waiting on a client which stays silent this long is given up
+FEEDBACK_TIMEOUT = 3.0
+
+
+class ReliableSegmentSender:
+    """
+    Sends a file to a UDP client like UdpSegmentSender, but never runs more than a window
+    of segments ahead of the client's acknowledgement, and resends the segments the client
+    reports missing in its NACKs.
+    The transfer is finished once the client acknowledged every segment, or stopped answering.
+    NACKs may be fed from another thread than the sending one
+    """
+    __sock: socket.socket
+    __address: tuple[str, int]
+    __file_size: int
+    __payload_size: int
+    __sender: UdpSegmentSender
+    __window: int
+    # when each segment of the window was last queued for retransmission, by segment % window
+    __queued_at: array
+    __retransmissions: collections.deque
+    __feedback: queue.SimpleQueue
+    __last_feedback: float
+    __datagram: bytearray
+    __view: memoryview
+    __seed: int | None
+    segments_amount: int
+    acked: int
+    timed_out: bool
+
+    def __init__(self, sock: socket.socket, address: tuple[str, int], file_size: int, payload_size: int,
+                 use_gso: bool = True, seed: int | None = None):
+        self.__sock = sock
+        self.__address = address
+        self.__file_size = file_size
+        self.__payload_size = payload_size
+        self.__seed = seed
+        self.__sender = UdpSegmentSender(sock, address, file_size, payload_size, use_gso, seed)
+        self.segments_amount = self.__sender.segments_amount
+        self.__window = max(MIN_WINDOW_SEGMENTS, RETRANSMIT_WINDOW_BYTES // (PAYLOAD_HEADER.size + payload_size))
+        self.__queued_at = array('d', [0.0]) * self.__window
+        self.__retransmissions = collections.deque()
+        self.__feedback = queue.SimpleQueue()
+        self.__last_feedback = time.monotonic()
+        self.acked = 0
+        self.timed_out = False
+        # retransmissions are sent one by one, each from this single datagram
+        self.__datagram = bytearray(PAYLOAD_BYTE * (PAYLOAD_HEADER.size + payload_size))
+        pack_payload_header_into(self.__datagram, 0, self.segments_amount, 0, MSG_RETRANSMISSION)
+        self.__view = memoryview(self.__datagram)
+
+    def feed(self, message: bytes) -> None:
+        """
+        Hands a NACK of the client to the sender
+        """
+        self.__feedback.put(message)
+
+    def finished(self) -> bool:
+        return self.acked >= self.segments_amount or self.timed_out
+
+    def waiting(self) -> bool:
+        """
+        Returns whether nothing can be sent before the client's next NACK
+        """
+        return not self.__retransmissions and self.__feedback.empty() and \
+            self.__sender.next_segment() >= min(self.segments_amount, self.acked + self.__window)
+
+    def send_next_batch(self, report: UdpSendReport) -> bool:
+        """
+        Handles the NACKs fed so far, then sends the segments reported missing, or else
+        the next batch of new segments within the window.
+        Returns whether the transfer is finished
+        """
+        self.__handle_feedback()
+        if self.__retransmissions:
+            self.__send_retransmissions(report)
+        elif not self.finished():
+            self.__sender.send_next_batch(report, self.acked + self.__window)
+        return self.finished()
+
+    def wait_for_feedback(self) -> None:
+        """
+        Blocks until the client's next NACK arrives, giving the transfer up if the client
+        stays silent
+        """
+        try:
+            message: bytes = self.__feedback.get(timeout=max(0.0, self.__last_feedback + FEEDBACK_TIMEOUT -
+                                                             time.monotonic()))
+        except queue.Empty:
+            self.__give_up()
+            return
+        self.__handle_nack(message)
+
+    def check_timeout(self) -> bool:
+        """
+        Gives the transfer up if it is waiting on a client which stayed silent too long.
+        Returns whether the transfer was given up
+        """
+        if not self.timed_out and self.waiting() and time.monotonic() - self.__last_feedback >= FEEDBACK_TIMEOUT:
+            self.__give_up()
+        return self.timed_out
+
+    def __give_up(self) -> None:
+        self.timed_out = True
+        logger.error(f'Error: UDP client {self.__address} stopped acknowledging, '
+                     f'{self.segments_amount - self.acked} segments left unacknowledged')
+
+    def __handle_feedback(self) -> None:
+        while not self.__feedback.empty():
+            self.__handle_nack(self.__feedback.get_nowait())
+
+    def __handle_nack(self, message: bytes) -> None:
+        try:
+            received_before, ranges = unpack_nack(message)
+        except ProtocolError as e:
+            logger.error(f'Error: received an invalid NACK from UDP client: {e}')
+            return
+        now: float = time.monotonic()
+        self.__last_feedback = now
+        sent: int = self.__sender.next_segment()
+        self.acked = max(self.acked, min(received_before, sent))
+        for first, count in ranges:
+            for segment in range(max(first, self.acked), min(first + count, sent)):
+                slot: int = segment % self.__window
+                if now - self.__queued_at[slot] >= RETRANSMIT_HOLDOFF:
+                    self.__queued_at[slot] = now
+                    self.__retransmissions.append(segment)
+
+    def __send_retransmissions(self, report: UdpSendReport) -> None:
+        for _ in range(min(RETRANSMIT_BATCH, len(self.__retransmissions))):
+            segment: int = self.__retransmissions[0]
+            if segment >= self.acked:
+                pack_segment_number_into(self.__datagram, 0, segment)
+                payload: int = min(self.__payload_size, self.__file_size - segment * self.__payload_size)
+                if self.__seed is not None:
+                    fill_pattern(self.__datagram, PAYLOAD_HEADER.size, self.__seed, segment * self.__payload_size,
+                                 payload)
+                try:
+                    self.__sock.sendto(self.__view[:PAYLOAD_HEADER.size + payload], self.__address)
+                    report.segments_sent += 1
+                    report.retransmitted += 1
+                    report.bytes_sent += payload
+                except BlockingIOError:
+                    return
+                except OSError as e:
+                    logger.error(f'Error: failed to resend segment number {segment} to udp client: {e}')
+                    report.send_errors += 1
+                report.calls += 1
+            self.__retransmissions.popleft()
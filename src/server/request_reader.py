@@ -0,0 +1,140 @@
+import socket
+
+from pattern import pattern_position
+from protocol import DIRECTION_DOWNLOAD, TCP_DIRECTION_PREFIXES, TCP_OFFSET_SEPARATOR, TCP_SEED_SEPARATOR
+
+# longest accepted TCP request line, including the newline
+MAX_REQUEST_LINE_LEN = 64
+# seconds a client has to send its whole request line
+REQUEST_READ_TIMEOUT = 5.0
+READ_CHUNK_SIZE = 4096
+
+
+class RequestError(Exception):
+    """
+    Raised when a client sends an invalid, oversized or incomplete request
+    """
+
+
+class TcpRequest:
+    """
+    A parsed TCP request line: which way the payload flows, how many bytes, where in the
+    file they start, and the seed of the verifiable pattern, if one was requested
+    """
+    direction: str
+    size: int
+    offset: int
+    seed: int | None
+
+    def __init__(self, direction: str, size: int, offset: int = 0, seed: int | None = None):
+        self.direction = direction
+        self.size = size
+        self.offset = offset
+        self.seed = seed
+
+    def pattern_seed(self) -> int | None:
+        """
+        Returns where in the pattern the payload sent for the request starts, or None if
+        the request is not verified
+        """
+        return None if self.seed is None else pattern_position(self.seed, self.offset)
+
+
+class RequestReader:
+    """
+    Reads a newline-terminated request line from a TCP client.
+    Data is received in large chunks into a preallocated buffer instead of one byte at
+    a time, the line length is bounded, and bytes received after the newline are kept.
+    Is fed data by a selector loop, which enforces the deadline of the request.
+    """
+    __max_line_len: int
+    __chunk: bytearray
+    __chunk_view: memoryview
+    __pending: bytearray
+    __line: bytes | None
+
+    def __init__(self, max_line_len: int = MAX_REQUEST_LINE_LEN):
+        self.__max_line_len = max_line_len
+        self.__chunk = bytearray(READ_CHUNK_SIZE)
+        self.__chunk_view = memoryview(self.__chunk)
+        self.__pending = bytearray()
+        self.__line = None
+
+    def receive(self, sock: socket.socket) -> bytes | None:
+        """
+        Receives one chunk from the socket and feeds it to the reader.
+        On a non-blocking socket, raises BlockingIOError if no data is available.
+        Returns the request line once it is complete, or None
+        """
+        received: int = sock.recv_into(self.__chunk_view)
+        if received == 0:
+            raise RequestError('connection closed before the request was complete')
+        return self.feed(self.__chunk_view[:received])
+
+    def feed(self, data: bytes | memoryview) -> bytes | None:
+        """
+        Adds received data to the reader.
+        Returns the request line once it is complete, or None
+        """
+        if self.__line is not None:
+            self.__pending += data
+            return self.__line
+
+        search_start: int = len(self.__pending)
+        self.__pending += data
+        newline_idx: int = self.__pending.find(b'\n', search_start)
+        if newline_idx == -1:
+            if len(self.__pending) >= self.__max_line_len:
+                raise RequestError(f'request line is longer than {self.__max_line_len} bytes')
+            return None
+        if newline_idx >= self.__max_line_len:
+            raise RequestError(f'request line is longer than {self.__max_line_len} bytes')
+
+        self.__line = bytes(self.__pending[:newline_idx])
+        del self.__pending[:newline_idx + 1]
+        return self.__line
+
+    def extra_bytes(self) -> bytes:
+        """
+        Returns the bytes received after the request line
+        """
+        return bytes(self.__pending)
+
+
+def parse_size(line: bytes) -> int:
+    """
+    Parses a requested amount of bytes out of a request line.
+    Raises RequestError if the line is not a decimal number
+    """
+    if line == b'':
+        return 0
+    if not line.isdigit():
+        raise RequestError('received a non-digit char from client in TCP connection!')
+    return int(line)
+
+
+def parse_request(line: bytes) -> TcpRequest:
+    """
+    Parses a request line: the direction of the transfer, given by an optional prefix,
+    the amount of bytes, and two optional suffixes - the offset of a byte range, and the
+    seed of the verifiable pattern.
+    Raises RequestError if the line is invalid
+    """
+    seed: int | None = None
+    line, separator, seed_digits = line.partition(TCP_SEED_SEPARATOR)
+    if separator:
+        if not seed_digits.isdigit():
+            raise RequestError('received an invalid pattern seed from client in TCP connection!')
+        seed = int(seed_digits)
+    offset: int = 0
+    line, separator, offset_digits = line.partition(TCP_OFFSET_SEPARATOR)
+    if separator:
+        if not offset_digits.isdigit():
+            raise RequestError('received an invalid range offset from client in TCP connection!')
+        offset = int(offset_digits)
+    for direction, prefix in TCP_DIRECTION_PREFIXES.items():
+        if prefix and line.startswith(prefix):
+            if separator:
+                raise RequestError(f'received a byte range for a TCP {direction}, ranges are only downloaded')
+            return TcpRequest(direction, parse_size(line[len(prefix):]), offset, seed)
+    return TcpRequest(DIRECTION_DOWNLOAD, parse_size(line), offset, seed)
@@ -1,30 +1,42 @@
+import selectors
 import socket
-import struct
 import threading
 import time
 import ipaddress
+from typing import Callable
 
 import teapot_gen
 import logger
+import protocol
+from admission import AdmissionControl, AdmissionLimits
+from payload import PayloadEngine, PayloadSink, SendReport
+from reliable_udp import ReliableSegmentSender
+from request_reader import RequestReader, RequestError, REQUEST_READ_TIMEOUT, TcpRequest, parse_request
+from stats import ProtocolCounters, ServerStats, send_counted_batch
+from udp_sender import UdpSegmentSender, UdpSendReport, negotiate_payload_size, send_buffer_size
+from udp_upload import UdpUpload
+from worker_pool import WorkerPool
 
 
-COOKIE = 0xabcddcba
-UDP_OFFER_MSG_CODE = 0x2
-UDP_REQUEST_MSG_CODE = 0x3
-UDP_PAYLOAD_MSG_CODE = 0x4
-# Constants for UDP request message type
-REQUEST_MESSAGE_LEN = 13
-REQUEST_COOKIE_INDEX = 0
-REQUEST_TYPE_INDEX = 4
-REQUEST_FILE_SIZE_INDEX = 5
+UDP_SEND_BUFFER_SIZE = 4 * 1024 * 1024
+# most TCP connections waiting for their request line at once, from all the clients together
+MAX_PENDING_TCP_REQUESTS = 1024
 
-MAX_UDP_MESSAGE_LEN = 1024
-MAX_PAYLOAD_SIZE = 1000
+# Called after every finished transfer with the protocol ('TCP' / 'UDP'), the amounts
+# of bytes sent and received and the transfer duration in seconds
+TransferCallback = Callable[[str, int, int, float], None]
 
 class Server:
     """
     Server class that listens for incoming connections from clients in either UDP or TCP.
-    When a client requests, the server sends an amount of data as requested.
+    When a client requests, the server sends an amount of data as requested, receives
+    the amount the client uploads, or both at once.
+    Requests are handled by a fixed pool of worker threads with a bounded pending queue.
+    TCP request lines are read by the TCP listener itself, so only an admitted request
+    ever occupies a worker. When the queue is full, or a client is over its limits, the
+    request is rejected right away with a reject message.
+    A bidirectional transfer runs its second half on a helper thread of the pool, so there
+    may be up to twice as many transfer threads as workers.
     """
     __udp_port: int
     __tcp_port: int
@@ -36,51 +48,103 @@ class Server:
 
     __subnetmask: str
     broadcast_ip: str
+
+    __payload_engine: PayloadEngine
+    __payload_sink: PayloadSink
+    __reuse_udp_socket: bool
+    __reuse_port: bool
+    __announce: bool
+    __on_transfer: TransferCallback | None
+    # reliable UDP transfers by client address, which the NACKs received by the UDP
+    # listener are handed to
+    __reliable_senders: dict[tuple[str, int], ReliableSegmentSender]
+    __reliable_senders_lock: threading.Lock
+    __pool: WorkerPool
+    __admission: AdmissionControl
+    __max_client_pending: int
+    # TCP connections waiting for their request line: the client address, the reader of
+    # the line, and the deadline for it to arrive
+    __pending_tcp: dict[socket.socket, tuple[tuple[str, int], RequestReader, float]]
+    # written to on shutdown, to wake up the TCP listener's selector
+    __wakeup_socks: tuple[socket.socket, socket.socket]
+    stats: ServerStats
     
     def __init__(self, udp_port: int, tcp_port: int, broadcast_port: int,
-                 subnetmask: str):
+                 subnetmask: str, reuse_udp_socket: bool = False, reuse_port: bool = False,
+                 announce: bool = True, on_transfer: TransferCallback | None = None,
+                 limits: AdmissionLimits | None = None):
         self.__shutdown = False
         self.__udp_port = udp_port
         self.__tcp_port = tcp_port
         self.__broadcast_port = broadcast_port
         self.__subnetmask = subnetmask
         self.broadcast_ip = ''
+        self.__payload_engine = PayloadEngine(pattern=True)
+        # uploads are never read, so every connection receives into the same buffer
+        self.__payload_sink = PayloadSink(discard=True)
+        self.__reuse_udp_socket = reuse_udp_socket
+        # allow several server processes to share the ports, load balanced by the kernel
+        self.__reuse_port = reuse_port
+        # whether to broadcast offers and show the waiting animation
+        self.__announce = announce
+        self.__on_transfer = on_transfer
+        self.__reliable_senders = {}
+        self.__reliable_senders_lock = threading.Lock()
+        if limits is None:
+            limits = AdmissionLimits()
+        self.__pool = WorkerPool(limits.pool_size, limits.queue_size)
+        # the pool bounds the transfers at once, the admission control only the transfers per client
+        self.__admission = AdmissionControl(limits)
+        # a client may not hold more connections without a request than it may run transfers
+        self.__max_client_pending = limits.max_client_transfers
+        self.__pending_tcp = {}
+        self.__wakeup_socks = socket.socketpair()
+        self.stats = ServerStats()
+        self.stats.watch_pool(self.__pool)
     
     def run(self) -> None:
         """
         Runs the server: starts UDP and TCP servers, and starts broadcasting
         offer messages
         """
-        # resolve server ip and broadcast ip
-        server_ip: str = socket.gethostbyname(socket.gethostname())
-        network_portion: str = ('.'.join(server_ip.split('.')[:-1])) + '.0'
-        self.broadcast_ip = str(ipaddress.IPv4Network(f'{network_portion}/{self.__subnetmask}').broadcast_address)
+        server_ip: str
+        server_ip, self.broadcast_ip = Server.resolve_addresses(self.__subnetmask)
 
         # Open UDP server
         self.__udp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         try:
+            if self.__reuse_port:
+                self.__udp_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
             self.__udp_sock.bind(('', self.__udp_port))
         except:
             logger.error(f'Error: failed to bind UDP server to port {self.__udp_port}')
             self.__udp_sock.close()
             return
 
+        self.__pool.start()
         udp_thread: threading.Thread = threading.Thread(target=self.listen_udp)
         udp_thread.start()
 
         # Open TCP serer
         self.__tcp_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         try:
+            if self.__reuse_port:
+                self.__tcp_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
             self.__tcp_sock.bind(('', self.__tcp_port))
         except:
             logger.error(f'Error: failed to bind TCP server to port {self.__tcp_port}')
             self.__udp_sock.close()
             self.__tcp_sock.close()
+            self.__pool.shutdown()
             return
 
         tcp_thread: threading.Thread = threading.Thread(target=self.listen_tcp)
         tcp_thread.start()
 
+        if not self.__announce:
+            logger.debugging(f'Server started, listening on IP address {server_ip}')
+            return
+
         # Open offer thread
         self.__offer_sock: socket.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         try:
@@ -91,6 +155,7 @@ class Server:
             self.__udp_sock.close()
             self.__tcp_sock.close()
             self.__offer_sock.close()
+            self.__pool.shutdown()
             return
         offer_thread: threading.Thread = threading.Thread(target=self.announce_offers)
         offer_thread.start()
@@ -101,6 +166,16 @@ class Server:
         teapot_gen.init()
         threading.Thread(target=teapot_gen.start).start()
 
+    @staticmethod
+    def resolve_addresses(subnetmask: str) -> tuple[str, str]:
+        """
+        Resolves the server IP address and the broadcast address of its network
+        """
+        server_ip: str = socket.gethostbyname(socket.gethostname())
+        network_portion: str = ('.'.join(server_ip.split('.')[:-1])) + '.0'
+        broadcast_ip: str = str(ipaddress.IPv4Network(f'{network_portion}/{subnetmask}').broadcast_address)
+        return server_ip, broadcast_ip
+
     def shutdown(self) -> None:
         """
         Shuts down the server, preventing it from receiving further new client connections.
@@ -109,10 +184,25 @@ class Server:
         logger.info('Terminating server...')
         self.__shutdown = True
 
-        self.__offer_sock.close()
-        # Enable UDP & TCP listeners to wrap up connections - close only reading from socket
+        if self.__announce:
+            self.__offer_sock.close()
+        # the TCP listener waits in a selector, which closing its socket does not always wake up
+        self.__wakeup_socks[1].send(b'\0')
+        self.__wakeup_socks[1].close()
+        # Enable UDP & TCP listeners to wrap up connections - close only reading from socket.
+        # Shutting the sockets down also wakes up the listener threads blocked on them
+        for sock, how in ((self.__tcp_sock, socket.SHUT_RDWR), (self.__udp_sock, socket.SHUT_RD)):
+            try:
+                sock.shutdown(how)
+            except OSError:
+                # unconnected sockets report ENOTCONN, but are still shut down
+                pass
         self.__tcp_sock.close()
-        self.__udp_sock.close()
+        if not self.__reuse_udp_socket:
+            # a shared UDP socket may still be sending - it is released with the server
+            self.__udp_sock.close()
+        # the workers finish the queued transfers before exiting
+        self.__pool.shutdown()
         teapot_gen.stop()
 
     def announce_offers(self) -> None:
@@ -127,18 +217,22 @@ class Server:
     def send_udp_offer(self) -> None:
         """
         Sends an broadcast offer to connect to the server.
-        Message structure:
+        """
+        message: bytes = Server.build_offer_message(self.__udp_port, self.__tcp_port)
+        self.__offer_sock.sendto(message, (self.broadcast_ip, self.__broadcast_port))
+
+    @staticmethod
+    def build_offer_message(udp_port: int, tcp_port: int) -> bytes:
+        """
+        Builds an offer message.
+        Message structure (see protocol.OFFER):
             - magic cookie, 4 bytes
-            - message code, 2 bytes
+            - message code, 1 byte
+            - protocol version, 1 byte
             - server UDP port, 2 bytes
             - server TCP port, 2 bytes
         """
-        message: bytes
-        message = struct.pack('I', COOKIE)
-        message += struct.pack('B', UDP_OFFER_MSG_CODE)
-        message += struct.pack('H', self.__udp_port)
-        message += struct.pack('H', self.__tcp_port)
-        self.__offer_sock.sendto(message, (self.broadcast_ip, self.__broadcast_port))
+        return protocol.pack_offer(udp_port, tcp_port)
         
     def listen_udp(self) -> None:
         """
@@ -146,109 +240,436 @@ class Server:
         """
         try:
             while not self.__shutdown:
-                data, address = self.__udp_sock.recvfrom(MAX_UDP_MESSAGE_LEN)
+                data, address = self.__udp_sock.recvfrom(protocol.MAX_MESSAGE_LEN)
+                if self.__shutdown:
+                    break
+                message_type: int | None = protocol.message_type_of(data)
+                if message_type == protocol.MSG_NACK:
+                    self.route_nack(data, address)
+                    continue
+                if message_type == protocol.MSG_PROBE:
+                    # echoed right away, so the round trip never waits for a worker
+                    Server.echo_probe(self.__udp_sock, data, address, self.stats.shard().udp)
+                    continue
                 teapot_gen.stop()
-                logger.debugging(f'Accepted UDP client {address}')
-                threading.Thread(target=self.handle_udp_connection, args=(data, address)).start()
+                self.stats.shard().udp.accepted += 1
+                if logger.enabled(logger.DEBUG):
+                    logger.debugging(f'Accepted UDP client {address}')
+                self.admit_udp_request(data, address)
         except:
-            logger.error('Error: failed to receive new UDP message. Wrapping up UDP server...')
-            self.__udp_sock.close()
+            if not self.__shutdown:
+                logger.error('Error: failed to receive new UDP message. Wrapping up UDP server...')
+                self.__udp_sock.close()
         logger.debugging('Closed UDP server')
 
+    def admit_udp_request(self, data: bytes, address: tuple[str, int]) -> None:
+        """
+        Validates a UDP request and queues it for a worker, unless it is rejected
+        """
+        counters: ProtocolCounters = self.stats.shard().udp
+        request: tuple[int, int, int, int] | None = Server.parse_udp_request(data)
+        if request is None:
+            counters.invalid_requests += 1
+            return
+        file_size, _, flags, _ = request
+        try:
+            direction: str = protocol.request_direction(flags)
+        except protocol.ProtocolError as e:
+            logger.error(f'Error: received invalid request from UDP client: {e}')
+            counters.invalid_requests += 1
+            return
+        transfers: int = 2 if direction == protocol.DIRECTION_BOTH else 1
+        reason: int | None = self.__admission.admit(address[0], file_size, transfers)
+        if reason is None and not self.__pool.submit(self.handle_udp_connection, request, direction, address):
+            self.__admission.release(address[0], file_size, transfers)
+            reason = protocol.REJECT_BUSY
+        if reason is not None:
+            Server.reject_udp_request(self.__udp_sock, address, reason, counters)
+
+    @staticmethod
+    def reject_udp_request(sock: socket.socket, address: tuple[str, int], reason: int,
+                           counters: ProtocolCounters) -> None:
+        counters.reject(reason)
+        if logger.enabled(logger.DEBUG):
+            logger.debugging(f'Rejected UDP client {address}: {protocol.reject_reason(reason)}')
+        try:
+            sock.sendto(protocol.pack_reject(reason), address)
+        except OSError as e:
+            logger.error(f'Error: failed to reject UDP client {address}: {e}')
+
+    @staticmethod
+    def echo_probe(sock: socket.socket, data: bytes, address: tuple[str, int], counters: ProtocolCounters) -> None:
+        """
+        Sends a latency probe back to the client which sent it, as a probe reply
+        """
+        try:
+            sock.sendto(protocol.probe_reply(data), address)
+        except protocol.ProtocolError as e:
+            logger.error(f'Error: received invalid probe from UDP client: {e}')
+            counters.invalid_requests += 1
+            return
+        except OSError as e:
+            logger.error(f'Error: failed to echo a probe to UDP client {address}: {e}')
+            return
+        counters.probes_echoed += 1
+
+    def route_nack(self, data: bytes, address: tuple[str, int]) -> None:
+        """
+        Hands a NACK to the reliable UDP transfer of the client which sent it
+        """
+        with self.__reliable_senders_lock:
+            sender: ReliableSegmentSender | None = self.__reliable_senders.get(address)
+        if sender is None:
+            # the client repeats its final acknowledgement, which may outlive the transfer
+            if logger.enabled(logger.DEBUG):
+                logger.debugging(f'Ignored a NACK from {address}, which has no reliable UDP transfer')
+            return
+        sender.feed(data)
+
     def listen_tcp(self):
         """
-        Listens for TCP connections from clients
+        Listens for TCP connections from clients, and reads their request lines with a
+        selector, each until its deadline. A request is handed to a worker only once it
+        arrived and was admitted, so connections which never send a request cannot hold
+        up the pool
         """
+        selector: selectors.BaseSelector = selectors.DefaultSelector()
         try:
             self.__tcp_sock.listen()
+            selector.register(self.__tcp_sock, selectors.EVENT_READ)
+            selector.register(self.__wakeup_socks[0], selectors.EVENT_READ)
 
             while not self.__shutdown:
-                client_sock, address = self.__tcp_sock.accept()
-                teapot_gen.stop()
-                logger.debugging(f'Accepted TCP client {address}')
-                threading.Thread(target=self.handle_tcp_connection, args=(client_sock, )).start()
+                timeout: float | None = None
+                if self.__pending_tcp:
+                    first_deadline: float = min(deadline for _, _, deadline in self.__pending_tcp.values())
+                    timeout = max(0.0, first_deadline - time.monotonic())
+                for key, _ in selector.select(timeout):
+                    if self.__shutdown:
+                        break
+                    if key.fileobj is self.__tcp_sock:
+                        self.accept_tcp_client(selector)
+                    elif key.fileobj is not self.__wakeup_socks[0]:
+                        self.read_tcp_request(selector, key.fileobj)
+                self.expire_tcp_requests(selector)
         except:
-            logger.error('Error: failed to accept new TCP client. Wrapping up TCP server...')
-            self.__tcp_sock.close()
+            if not self.__shutdown:
+                logger.error('Error: failed to accept new TCP client. Wrapping up TCP server...')
+                self.__tcp_sock.close()
+        for client_sock in self.__pending_tcp:
+            client_sock.close()
+        self.__pending_tcp.clear()
+        selector.close()
+        self.__wakeup_socks[0].close()
         logger.debugging('Closed TCP server')
 
-    def handle_udp_connection(self, data: bytes, address) -> None:
+    def accept_tcp_client(self, selector: selectors.BaseSelector) -> None:
         """
-        Handles a UDP client request
-        After processing the request, sends UDP packets according to the requested
-        file size
+        Accepts a TCP connection, and waits for its request line, unless its client
+        already has too many connections waiting
         """
-        if(len(data) < REQUEST_MESSAGE_LEN):
-            logger.error('Error: received invalid message length from UDP client!')
+        client_sock, address = self.__tcp_sock.accept()
+        teapot_gen.stop()
+        counters: ProtocolCounters = self.stats.shard().tcp
+        counters.accepted += 1
+        if logger.enabled(logger.DEBUG):
+            logger.debugging(f'Accepted TCP client {address}')
+        if len(self.__pending_tcp) >= MAX_PENDING_TCP_REQUESTS:
+            Server.reject_tcp_client(client_sock, address, protocol.REJECT_BUSY, counters)
             return
-        
-        cookie: int = struct.unpack('I', data[REQUEST_COOKIE_INDEX:REQUEST_TYPE_INDEX])[0]
-        if cookie != COOKIE:
-            logger.error(f'Error: received invalid cookie: {cookie}')
+        client_pending: int = sum(1 for pending_address, _, _ in self.__pending_tcp.values()
+                                  if pending_address[0] == address[0])
+        if client_pending >= self.__max_client_pending:
+            Server.reject_tcp_client(client_sock, address, protocol.REJECT_CLIENT_LIMIT, counters)
             return
-        
-        message_type: int = struct.unpack('B', data[REQUEST_TYPE_INDEX:REQUEST_FILE_SIZE_INDEX])[0]
-        if message_type != UDP_REQUEST_MSG_CODE:
-            logger.error(f'Error: received invalid message type: {message_type}. Expected: {UDP_REQUEST_MSG_CODE}')
+        client_sock.setblocking(False)
+        self.__pending_tcp[client_sock] = (address, RequestReader(), time.monotonic() + REQUEST_READ_TIMEOUT)
+        selector.register(client_sock, selectors.EVENT_READ)
+
+    def read_tcp_request(self, selector: selectors.BaseSelector, client_sock: socket.socket) -> None:
+        """
+        Reads the data a waiting TCP connection sent, and admits its request once the
+        whole line arrived
+        """
+        address, reader, _ = self.__pending_tcp[client_sock]
+        line: bytes | None
+        try:
+            line = reader.receive(client_sock)
+        except BlockingIOError:
+            return
+        except RequestError as e:
+            self.drop_tcp_request(selector, client_sock, f'invalid request from TCP client: {e}', invalid=True)
+            return
+        except OSError as e:
+            self.drop_tcp_request(selector, client_sock, f'TCP client failed to receive request {e}')
+            return
+        if line is None:
             return
-        
-        file_size: int = struct.unpack('Q', data[REQUEST_FILE_SIZE_INDEX:REQUEST_MESSAGE_LEN])[0]
 
-        segments_amount: int = (file_size // MAX_PAYLOAD_SIZE) + 1
-        message_start: bytes = struct.pack('I', COOKIE) + struct.pack('B', UDP_PAYLOAD_MSG_CODE) + \
-            struct.pack('Q', segments_amount)
+        selector.unregister(client_sock)
+        del self.__pending_tcp[client_sock]
+        # payload is sent over a blocking socket
+        client_sock.setblocking(True)
+        try:
+            request: TcpRequest = parse_request(line)
+        except RequestError as e:
+            self.stats.shard().tcp.invalid_requests += 1
+            logger.error(f'Error: invalid request from TCP client: {e}')
+            client_sock.close()
+            return
+        self.admit_tcp_request(client_sock, address, reader, request)
 
-        data_sent: int = 0
-        curr_segment = 0
+    def expire_tcp_requests(self, selector: selectors.BaseSelector) -> None:
+        """
+        Drops TCP connections which did not send their request before the deadline
+        """
+        now: float = time.monotonic()
+        expired: list[socket.socket] = [client_sock for client_sock, (_, _, deadline) in self.__pending_tcp.items()
+                                        if deadline <= now]
+        for client_sock in expired:
+            self.drop_tcp_request(selector, client_sock, 'invalid request from TCP client: timed out waiting '
+                                                         'for the request', invalid=True)
 
-        logger.debugging(f'Sending {file_size} bytes to client in {segments_amount} segments over UDP...')
-        sock: socket.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        while data_sent < file_size:
-            message: bytes = b''
-            message += message_start
-            message += struct.pack('Q', curr_segment)
-            curr_payload: int = min(MAX_PAYLOAD_SIZE, file_size - data_sent)
-            message += ('a' * curr_payload).encode()
-            try:
-                sock.sendto(message, address)
-            except Exception as e:
-                logger.error(f'Error: failed to send segment number {curr_segment} to udp client: {e}')
+    def drop_tcp_request(self, selector: selectors.BaseSelector, client_sock: socket.socket, reason: str,
+                         invalid: bool = False) -> None:
+        selector.unregister(client_sock)
+        del self.__pending_tcp[client_sock]
+        if invalid:
+            self.stats.shard().tcp.invalid_requests += 1
+        logger.error(f'Error: {reason}')
+        client_sock.close()
 
-            curr_segment += 1
-            data_sent += curr_payload
-        logger.debugging(f'Finished sending data in UDP connection ${address}')
+    def admit_tcp_request(self, client_sock: socket.socket, address: tuple[str, int], reader: RequestReader,
+                          request: TcpRequest) -> None:
+        """
+        Queues a TCP request for a worker, unless it is rejected
+        """
+        transfers: int = 2 if request.direction == protocol.DIRECTION_BOTH else 1
+        reason: int | None = self.__admission.admit(address[0], request.size, transfers)
+        if reason is None and not self.__pool.submit(self.handle_tcp_connection, client_sock, address, reader,
+                                                     request):
+            self.__admission.release(address[0], request.size, transfers)
+            reason = protocol.REJECT_BUSY
+        if reason is not None:
+            Server.reject_tcp_client(client_sock, address, reason, self.stats.shard().tcp)
 
-    def handle_tcp_connection(self, client_sock: socket.socket) -> None:
+    def handle_udp_connection(self, request: tuple[int, int, int, int], direction: str,
+                              address: tuple[str, int]) -> None:
         """
-        Handles a TCP client request
-        After processing the request, sends bytes as the requested file size
+        Handles an admitted UDP client request
+        Sends UDP packets according to the requested file size, receives the client's
+        upload, or both - the upload on a helper thread
         """
-        bytes_amount: int = 0
-        curr_char: str = ''
-        while curr_char != '\n':
-            try:
-                curr_char = client_sock.recv(1).decode()
-            except Exception as e:
-                logger.error(f'Error: TCP client failed to receive next char {e}')
-                client_sock.close()
-                return
-            
-            if not curr_char.isdigit() and curr_char != '\n':
-                logger.error('Error: received a non-digit char from client in TCP connection!')
-                client_sock.close()
-                return
-            if curr_char != '\n':
-                bytes_amount = (10 * bytes_amount) + int(curr_char)
-
-        logger.debugging(f'Sending {bytes_amount} bytes to client over TCP...')
-        sent_data: int = 0
-        while sent_data < bytes_amount:
+        file_size, client_max_payload_size, flags, seed = request
+        if direction == protocol.DIRECTION_UPLOAD:
             try:
-                sent_data += client_sock.send(('a' * min(1024, bytes_amount - sent_data)).encode())
-            except Exception:
-                logger.error(f'Error: failed to send data to tcp client!')
-                client_sock.close()
-                return
+                self.receive_udp_upload(address, file_size, client_max_payload_size)
+            finally:
+                self.__admission.release(address[0], file_size)
+            return
+        upload: threading.Thread | None = None
+        if direction == protocol.DIRECTION_BOTH:
+            upload = self.__pool.run_helper(self.receive_udp_upload, address, file_size, client_max_payload_size)
+        try:
+            self.send_udp_payload(address, file_size, client_max_payload_size, flags, seed)
+        finally:
+            if upload is not None:
+                upload.join()
+            self.__admission.release(address[0], file_size, 2 if upload is not None else 1)
+
+    def send_udp_payload(self, address: tuple[str, int], file_size: int, client_max_payload_size: int,
+                         flags: int, seed: int = 0) -> None:
+        """
+        Sends the requested file to a UDP client, as a series of payload segments.
+        A verified transfer carries the pattern, starting where the client's seed points
+        """
+        counters: ProtocolCounters = self.stats.shard().udp
+        payload_size: int = negotiate_payload_size(address, client_max_payload_size)
+        pattern_seed: int | None = seed if flags & protocol.REQUEST_VERIFY else None
+
+        sock: socket.socket
+        if self.__reuse_udp_socket:
+            # send from the server's UDP socket instead of opening a socket per request
+            sock = self.__udp_sock
+        else:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, send_buffer_size(payload_size, UDP_SEND_BUFFER_SIZE))
+        reliable: ReliableSegmentSender | None = None
+        sender: UdpSegmentSender | ReliableSegmentSender
+        if flags & protocol.REQUEST_RELIABLE:
+            sender = reliable = ReliableSegmentSender(sock, address, file_size, payload_size, seed=pattern_seed)
+            with self.__reliable_senders_lock:
+                self.__reliable_senders[address] = reliable
+        else:
+            sender = UdpSegmentSender(sock, address, file_size, payload_size, seed=pattern_seed)
+
+        if logger.enabled(logger.DEBUG):
+            logger.debugging(f'Sending {file_size} bytes to client in {sender.segments_amount} segments of '
+                             f'{payload_size} bytes over {"reliable " if reliable is not None else ""}UDP'
+                             f'{"" if pattern_seed is None else f" with pattern seed {pattern_seed}"}...')
+        counters.transfers_started += 1
+        start_time: float = time.perf_counter()
+        report: UdpSendReport = UdpSendReport()
+        while not send_counted_batch(sender, report, counters):
+            if reliable is not None and reliable.waiting():
+                reliable.wait_for_feedback()
+        if reliable is not None:
+            with self.__reliable_senders_lock:
+                self.__reliable_senders.pop(address, None)
+        if not self.__reuse_udp_socket:
+            sock.close()
+        duration: float = time.perf_counter() - start_time
+        counters.finish_transfer(duration)
+        if logger.enabled(logger.DEBUG):
+            logger.debugging(f'Finished sending data in UDP connection {address}: {report}')
+        if self.__on_transfer is not None:
+            self.__on_transfer('UDP', file_size, 0, duration)
+
+    def receive_udp_upload(self, address: tuple[str, int], file_size: int, max_payload_size: int) -> None:
+        """
+        Receives a UDP client's upload on a socket of its own, and reports back how much
+        of it arrived and how fast
+        """
+        sock: socket.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            sock.bind(('', 0))
+            upload: UdpUpload = UdpUpload(sock, address, file_size, max_payload_size, self.stats.shard().udp)
+            upload.start()
+            upload.receive_all()
+            duration: float = upload.finish()
+        except OSError as e:
+            logger.error(f'Error: failed to receive upload from UDP client {address}: {e}')
+            return
+        finally:
+            sock.close()
+        if self.__on_transfer is not None:
+            self.__on_transfer('UDP', 0, upload.bytes_received, duration)
+
+    @staticmethod
+    def parse_udp_request(data: bytes) -> tuple[int, int, int, int] | None:
+        """
+        Validates a UDP request message.
+        Returns the requested file size, the largest payload the client accepts, the
+        request flags and the pattern seed, or None if the message is invalid
+        """
+        try:
+            return protocol.unpack_request(data)
+        except protocol.ProtocolError as e:
+            logger.error(f'Error: received invalid request from UDP client: {e}')
+            return None
+
+    @staticmethod
+    def reject_tcp_client(client_sock: socket.socket, address: tuple[str, int], reason: int,
+                          counters: ProtocolCounters) -> None:
+        """
+        Sends a reject message in place of the payload, and closes the connection
+        """
+        counters.reject(reason)
+        if logger.enabled(logger.DEBUG):
+            logger.debugging(f'Rejected TCP client {address}: {protocol.reject_reason(reason)}')
+        try:
+            # a fresh connection has room for the message, so this never blocks
+            client_sock.sendall(protocol.pack_reject(reason))
+            client_sock.shutdown(socket.SHUT_WR)
+        except OSError as e:
+            logger.error(f'Error: failed to reject TCP client {address}: {e}')
+        client_sock.close()
+
+    def handle_tcp_connection(self, client_sock: socket.socket, address: tuple[str, int], reader: RequestReader,
+                              request: TcpRequest) -> None:
+        """
+        Handles an admitted TCP client request
+        Sends bytes as the requested file size, receives the bytes the client uploads, or
+        both at once - sending from a helper thread.
+        An upload is followed by a report of how fast it arrived
+        """
+        transfers: int = 2 if request.direction == protocol.DIRECTION_BOTH else 1
+        try:
+            self.serve_tcp_request(client_sock, reader, request)
+        finally:
+            self.__admission.release(address[0], request.size, transfers)
+
+    def serve_tcp_request(self, client_sock: socket.socket, reader: RequestReader, request: TcpRequest) -> None:
+        """
+        Runs an admitted TCP transfer, and closes the connection. A verified transfer sends
+        the pattern, from the offset of its range
+        """
+        counters: ProtocolCounters = self.stats.shard().tcp
+        direction: str = request.direction
+        bytes_amount: int = request.size
+        if logger.enabled(logger.DEBUG):
+            logger.debugging(f'Starting a TCP {direction} of {bytes_amount} bytes'
+                             f'{f" from offset {request.offset}" if request.offset else ""}...')
+        counters.transfers_started += 1
+        start_time: float = time.perf_counter()
+        report: SendReport = SendReport(request.pattern_seed())
+        sender: threading.Thread | None = None
+        send_failures: list[Exception] = []
+        try:
+            if direction == protocol.DIRECTION_DOWNLOAD:
+                self.send_tcp_payload(client_sock, bytes_amount, report)
+            else:
+                if direction == protocol.DIRECTION_BOTH:
+                    sender = self.__pool.run_helper(self.send_tcp_payload, client_sock, bytes_amount, report,
+                                                    send_failures)
+                upload_report: bytes = self.receive_tcp_upload(client_sock, bytes_amount, len(reader.extra_bytes()))
+                if sender is not None:
+                    sender.join()
+                    if send_failures:
+                        raise send_failures[0]
+                # the report follows the whole payload sent to the client
+                client_sock.sendall(upload_report)
+        except Exception as e:
+            logger.error(f'Error: TCP {direction} failed: {e}')
+            if sender is not None:
+                # unblocks the sending thread, if it is still sending
+                try:
+                    client_sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+                sender.join()
+            client_sock.close()
+            counters.send_errors += 1
+            counters.finish_transfer(time.perf_counter() - start_time)
+            return
             
         client_sock.close()
-        logger.debugging(f'Finished sending data in TCP connection')
+        duration: float = time.perf_counter() - start_time
+        counters.finish_transfer(duration)
+        if logger.enabled(logger.DEBUG):
+            logger.debugging(f'Finished TCP {direction}: {report}')
+        if self.__on_transfer is not None:
+            self.__on_transfer('TCP', 0 if direction == protocol.DIRECTION_UPLOAD else bytes_amount,
+                               0 if direction == protocol.DIRECTION_DOWNLOAD else bytes_amount, duration)
+
+    def send_tcp_payload(self, client_sock: socket.socket, bytes_amount: int, report: SendReport,
+                         failures: list[Exception] | None = None) -> None:
+        """
+        Sends the payload of a TCP transfer. When run on a helper thread, the failure is added
+        to the failures instead of raised
+        """
+        counters: ProtocolCounters = self.stats.shard().tcp
+        try:
+            while report.bytes_sent < bytes_amount:
+                counters.bytes_sent += self.__payload_engine.send_chunk(client_sock, bytes_amount - report.bytes_sent,
+                                                                        report)
+        except Exception as e:
+            if failures is None:
+                raise
+            failures.append(e)
+
+    def receive_tcp_upload(self, client_sock: socket.socket, bytes_amount: int, already_received: int) -> bytes:
+        """
+        Receives the rest of a TCP client's upload, past the bytes which arrived with the
+        request, into the shared sink.
+        Returns the report message of how much arrived and how fast, measured from the request
+        """
+        counters: ProtocolCounters = self.stats.shard().tcp
+        counters.bytes_received += min(already_received, bytes_amount)
+        bytes_left: int = bytes_amount - already_received
+        start_ns: int = time.perf_counter_ns()
+        while bytes_left > 0:
+            received: int = self.__payload_sink.receive_chunk(client_sock, bytes_left)
+            counters.bytes_received += received
+            bytes_left -= received
+        return protocol.pack_report(0, bytes_amount, time.perf_counter_ns() - start_ns)
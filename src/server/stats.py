@@ -0,0 +1,321 @@
+import http.server
+import json
+import threading
+import time
+
+import logger
+from protocol import REJECT_BUSY, REJECT_CLIENT_LIMIT
+from reliable_udp import ReliableSegmentSender
+from udp_sender import UdpSegmentSender, UdpSendReport
+from worker_pool import WorkerPool
+
+STATS_HOST = '127.0.0.1'
+JSON_PATH = '/stats'
+PROMETHEUS_PATH = '/metrics'
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4'
+METRIC_PREFIX = 'speedtest_'
+
+
+class ProtocolCounters:
+    """
+    Counters of a single protocol (TCP or UDP)
+    """
+    accepted: int
+    invalid_requests: int
+    rejected_busy: int
+    rejected_client_limit: int
+    rejected_too_large: int
+    transfers_started: int
+    transfers_finished: int
+    bytes_sent: int
+    datagrams_sent: int
+    retransmissions: int
+    bytes_received: int
+    datagrams_received: int
+    send_errors: int
+    probes_echoed: int
+    handler_seconds: float
+    handler_max_seconds: float
+
+    def __init__(self):
+        self.accepted = 0
+        self.invalid_requests = 0
+        self.rejected_busy = 0
+        self.rejected_client_limit = 0
+        self.rejected_too_large = 0
+        self.transfers_started = 0
+        self.transfers_finished = 0
+        self.bytes_sent = 0
+        self.datagrams_sent = 0
+        self.retransmissions = 0
+        self.bytes_received = 0
+        self.datagrams_received = 0
+        self.send_errors = 0
+        self.probes_echoed = 0
+        self.handler_seconds = 0.0
+        self.handler_max_seconds = 0.0
+
+    def finish_transfer(self, duration: float) -> None:
+        self.transfers_finished += 1
+        self.handler_seconds += duration
+        self.handler_max_seconds = max(self.handler_max_seconds, duration)
+
+    def reject(self, reason: int) -> None:
+        if reason == REJECT_BUSY:
+            self.rejected_busy += 1
+        elif reason == REJECT_CLIENT_LIMIT:
+            self.rejected_client_limit += 1
+        else:
+            self.rejected_too_large += 1
+
+    def add(self, other: 'ProtocolCounters') -> None:
+        self.accepted += other.accepted
+        self.invalid_requests += other.invalid_requests
+        self.rejected_busy += other.rejected_busy
+        self.rejected_client_limit += other.rejected_client_limit
+        self.rejected_too_large += other.rejected_too_large
+        self.transfers_started += other.transfers_started
+        self.transfers_finished += other.transfers_finished
+        self.bytes_sent += other.bytes_sent
+        self.datagrams_sent += other.datagrams_sent
+        self.retransmissions += other.retransmissions
+        self.bytes_received += other.bytes_received
+        self.datagrams_received += other.datagrams_received
+        self.send_errors += other.send_errors
+        self.probes_echoed += other.probes_echoed
+        self.handler_seconds += other.handler_seconds
+        self.handler_max_seconds = max(self.handler_max_seconds, other.handler_max_seconds)
+
+    def to_dict(self) -> dict:
+        return {'accepted': self.accepted, 'invalid_requests': self.invalid_requests,
+                'rejected_busy': self.rejected_busy, 'rejected_client_limit': self.rejected_client_limit,
+                'rejected_too_large': self.rejected_too_large,
+                'active_transfers': self.transfers_started - self.transfers_finished,
+                'transfers_finished': self.transfers_finished, 'bytes_sent': self.bytes_sent,
+                'datagrams_sent': self.datagrams_sent, 'retransmissions': self.retransmissions,
+                'bytes_received': self.bytes_received, 'datagrams_received': self.datagrams_received,
+                'send_errors': self.send_errors, 'probes_echoed': self.probes_echoed,
+                'handler_seconds': self.handler_seconds, 'handler_max_seconds': self.handler_max_seconds}
+
+
+class StatsShard:
+    """
+    The counters of a single thread. Only the owning thread writes them, so they are
+    updated without locks
+    """
+    tcp: ProtocolCounters
+    udp: ProtocolCounters
+
+    def __init__(self):
+        self.tcp = ProtocolCounters()
+        self.udp = ProtocolCounters()
+
+    def add(self, other: 'StatsShard') -> None:
+        self.tcp.add(other.tcp)
+        self.udp.add(other.udp)
+
+
+class ServerStats:
+    """
+    Live statistics of a server.
+    Every thread updates a shard of its own, taken once per thread, so the send loops
+    never take a lock. Snapshots sum all the shards; the shards of threads which have
+    exited are folded into a single retired shard, so the registry does not grow with
+    the amount of handler threads
+    """
+    __lock: threading.Lock
+    __local: threading.local
+    __shards: list[tuple[threading.Thread, StatsShard]]
+    __retired: StatsShard
+    __start_time: float
+    __last_snapshot_time: float
+    __last_bytes_sent: int
+    __pool: WorkerPool | None
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__local = threading.local()
+        self.__shards = []
+        self.__retired = StatsShard()
+        self.__start_time = time.monotonic()
+        self.__last_snapshot_time = self.__start_time
+        self.__last_bytes_sent = 0
+        self.__pool = None
+
+    def watch_pool(self, pool: WorkerPool) -> None:
+        """
+        Adds the load of a worker pool to the snapshots
+        """
+        self.__pool = pool
+
+    def shard(self) -> StatsShard:
+        """
+        Returns the counters of the calling thread
+        """
+        shard: StatsShard | None = getattr(self.__local, 'shard', None)
+        if shard is None:
+            shard = StatsShard()
+            self.__local.shard = shard
+            with self.__lock:
+                self.__shards.append((threading.current_thread(), shard))
+        return shard
+
+    def snapshot(self) -> dict:
+        """
+        Returns the sum of all the counters, along with the send rate since the previous
+        snapshot and since the server started
+        """
+        total: StatsShard = StatsShard()
+        with self.__lock:
+            alive: list[tuple[threading.Thread, StatsShard]] = []
+            for thread, shard in self.__shards:
+                if thread.is_alive():
+                    alive.append((thread, shard))
+                else:
+                    self.__retired.add(shard)
+            self.__shards = alive
+            total.add(self.__retired)
+            for _, shard in alive:
+                total.add(shard)
+
+            now: float = time.monotonic()
+            bytes_sent: int = total.tcp.bytes_sent + total.udp.bytes_sent
+            interval: float = now - self.__last_snapshot_time
+            recent_rate: float = 0.0 if interval <= 0 else (bytes_sent - self.__last_bytes_sent) / interval
+            self.__last_snapshot_time = now
+            self.__last_bytes_sent = bytes_sent
+
+        uptime: float = now - self.__start_time
+        snapshot: dict = {'uptime_seconds': uptime,
+                          'bytes_per_second': recent_rate,
+                          'average_bytes_per_second': 0.0 if uptime <= 0 else bytes_sent / uptime,
+                          'tcp': total.tcp.to_dict(), 'udp': total.udp.to_dict()}
+        if self.__pool is not None:
+            snapshot['worker_pool'] = self.__pool.snapshot()
+        return snapshot
+
+    @staticmethod
+    def to_prometheus(snapshot: dict) -> str:
+        """
+        Formats a snapshot in the Prometheus text exposition format
+        """
+        lines: list[str] = []
+
+        def metric(name: str, type: str, help: str, values: list[tuple[str, float]]) -> None:
+            lines.append(f'# HELP {METRIC_PREFIX}{name} {help}')
+            lines.append(f'# TYPE {METRIC_PREFIX}{name} {type}')
+            for labels, value in values:
+                lines.append(f'{METRIC_PREFIX}{name}{labels} {value}')
+
+        def per_protocol(key: str) -> list[tuple[str, float]]:
+            return [(f'{{protocol="{protocol}"}}', snapshot[protocol][key]) for protocol in ('tcp', 'udp')]
+
+        metric('uptime_seconds', 'gauge', 'Seconds since the server started',
+               [('', snapshot['uptime_seconds'])])
+        metric('connections_accepted_total', 'counter', 'Accepted TCP connections and UDP requests',
+               per_protocol('accepted'))
+        metric('invalid_requests_total', 'counter', 'Requests rejected as invalid', per_protocol('invalid_requests'))
+        metric('rejected_requests_total', 'counter', 'Requests rejected by the admission control',
+               [(f'{{protocol="{protocol}",reason="{reason}"}}', snapshot[protocol][f'rejected_{reason}'])
+                for protocol in ('tcp', 'udp') for reason in ('busy', 'client_limit', 'too_large')])
+        metric('active_transfers', 'gauge', 'Transfers currently being sent or received',
+               per_protocol('active_transfers'))
+        metric('bytes_sent_total', 'counter', 'Payload bytes sent', per_protocol('bytes_sent'))
+        metric('datagrams_sent_total', 'counter', 'UDP datagrams sent', [('', snapshot['udp']['datagrams_sent'])])
+        metric('retransmissions_total', 'counter', 'UDP segments sent again after a NACK',
+               [('', snapshot['udp']['retransmissions'])])
+        metric('bytes_received_total', 'counter', 'Payload bytes received from uploading clients',
+               per_protocol('bytes_received'))
+        metric('datagrams_received_total', 'counter', 'UDP datagrams received from uploading clients',
+               [('', snapshot['udp']['datagrams_received'])])
+        metric('send_errors_total', 'counter', 'Failed send calls', per_protocol('send_errors'))
+        metric('probes_echoed_total', 'counter', 'UDP latency probes echoed back to clients',
+               [('', snapshot['udp']['probes_echoed'])])
+        metric('handler_duration_seconds_sum', 'counter', 'Total time spent on finished transfers',
+               per_protocol('handler_seconds'))
+        metric('handler_duration_seconds_count', 'counter', 'Finished transfers',
+               per_protocol('transfers_finished'))
+        metric('handler_duration_seconds_max', 'gauge', 'Longest finished transfer',
+               per_protocol('handler_max_seconds'))
+        if 'worker_pool' in snapshot:
+            pool: dict = snapshot['worker_pool']
+            metric('worker_pool_workers', 'gauge', 'Worker threads', [('', pool['workers'])])
+            metric('worker_pool_busy_workers', 'gauge', 'Worker threads running a transfer',
+                   [('', pool['busy_workers'])])
+            metric('worker_pool_helper_threads', 'gauge',
+                   'Threads running the second half of a bidirectional transfer, next to a busy worker',
+                   [('', pool['helper_threads'])])
+            metric('worker_pool_queue_size', 'gauge', 'Capacity of the pending queue', [('', pool['queue_size'])])
+            metric('worker_pool_queue_depth', 'gauge', 'Transfers waiting for a worker', [('', pool['queue_depth'])])
+            metric('worker_pool_peak_queue_depth', 'gauge', 'Most transfers ever waiting for a worker',
+                   [('', pool['peak_queue_depth'])])
+        return '\n'.join(lines) + '\n'
+
+
+def send_counted_batch(sender: UdpSegmentSender | ReliableSegmentSender, report: UdpSendReport,
+                       counters: ProtocolCounters) -> bool:
+    """
+    Sends the next batch of a UDP transfer, and adds what it sent to the counters.
+    Returns whether the transfer is finished
+    """
+    segments_sent, send_errors, bytes_sent = report.segments_sent, report.send_errors, report.bytes_sent
+    retransmitted: int = report.retransmitted
+    finished: bool = sender.send_next_batch(report)
+    counters.datagrams_sent += report.segments_sent - segments_sent
+    counters.retransmissions += report.retransmitted - retransmitted
+    counters.send_errors += report.send_errors - send_errors
+    counters.bytes_sent += report.bytes_sent - bytes_sent
+    return finished
+
+
+class StatsEndpoint:
+    """
+    A local HTTP endpoint serving the statistics of a server, as JSON on /stats and in
+    the Prometheus text format on /metrics
+    """
+    __stats: ServerStats
+    __http_server: http.server.ThreadingHTTPServer
+    __thread: threading.Thread
+
+    def __init__(self, stats: ServerStats, port: int, host: str = STATS_HOST):
+        self.__stats = stats
+        self.__http_server = http.server.ThreadingHTTPServer((host, port), self.__build_handler())
+        self.__http_server.daemon_threads = True
+        self.__thread = threading.Thread(target=self.__http_server.serve_forever)
+
+    def start(self) -> None:
+        self.__thread.start()
+        host, port = self.__http_server.server_address[:2]
+        logger.info(f'Serving statistics on http://{host}:{port}{JSON_PATH} and {PROMETHEUS_PATH}')
+
+    def shutdown(self) -> None:
+        self.__http_server.shutdown()
+        self.__http_server.server_close()
+        self.__thread.join()
+
+    def __build_handler(self) -> type:
+        stats: ServerStats = self.__stats
+
+        class StatsRequestHandler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self) -> None:
+                body: bytes
+                content_type: str
+                if self.path == JSON_PATH:
+                    body = json.dumps(stats.snapshot()).encode()
+                    content_type = 'application/json'
+                elif self.path == PROMETHEUS_PATH:
+                    body = ServerStats.to_prometheus(stats.snapshot()).encode()
+                    content_type = PROMETHEUS_CONTENT_TYPE
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format: str, *args) -> None:
+                logger.debugging(f'Stats request: {format % args}')
+
+        return StatsRequestHandler
@@ -1,3 +1,5 @@
+import sys
+import threading
 import time
 
 color_map = {
@@ -10,12 +12,18 @@ color_map = {
     ' ': (0, 0, 0)         # Black (for whitespace)
 }
 
-clear: bool = False
-stop_print: bool = False
-parsed_pixels: str = ''
+# the teapot is drawn pixel by pixel and then erased pixel by pixel, at this many pixels per second
+PIXELS_PER_SECOND = 100
+FRAMES_PER_SECOND = 10
+WHITESPACE = 'w'
+
+# every frame of the animation, each a single string redrawing the whole teapot
+frames: list[str] = []
 lines: int = 0
-line_idx: int = 0
-inline_idx: int = 0
+# the animation is only shown on a terminal
+enabled: bool = sys.stdout.isatty()
+stop_event: threading.Event = threading.Event()
+generation: int = 0
 
 # Function to convert RGB to ANSI escape code for terminal
 def rgb_to_ansi(r, g, b):
@@ -42,51 +50,69 @@ def parse_pixels(raw_list):
     
 
 def init():
-    global parsed_pixels
+    """
+    Builds the frames of the animation, once
+    """
+    global frames
     global pixels_raw
     global lines
+    if frames or not enabled:
+        return
     parsed_pixels = parse_pixels(pixels_raw)
     lines = len(parsed_pixels)
-    
+    frames = build_frames(parsed_pixels)
 
-# Print teapot pixels with colored backgrounds
-def step():
-    global clear
-    while True:
-        color = update_lines()
-
-        if color == 'w':  # Treat 'w' as whitespace (no color, just reset)
-            print("\033[0m  ", end ='')  # Reset color after whitespace
-        elif clear:
-            print("\033[0m  ", end ='', flush=True)
-            break
-        else:
-            r, g, b = color_map[color]
-            ansi_code = rgb_to_ansi(r, g, b)  # Convert to ANSI color code
-            print(f"{ansi_code}  \033[0m", end='', flush=True)  # Print color
-            break
-
-
-def update_lines():
-    global inline_idx
-    global lines
-    global line_idx
-    global clear
-    row = parsed_pixels[line_idx]
-    if inline_idx == len(row):
-        inline_idx = 0
-        line_idx += 1
-        print()
-    if line_idx == len(parsed_pixels):
-        line_idx = 0
-        row = parsed_pixels[line_idx]
-        print('\033[F' * 17, flush=True)
-        clear = not clear
-    ret = row[inline_idx]
-    inline_idx += 1
-    return ret
+
+def disable():
+    """
+    Turns the animation off, e.g. when measuring throughput
+    """
+    global enabled
+    enabled = False
+    stop()
 
 
+def build_frames(parsed_pixels):
+    """
+    Renders the frames of a whole cycle: first drawing the teapot, then erasing it,
+    advancing as many pixels per frame as are drawn between two frames
+    """
+    # the order the pixels are drawn in, skipping whitespace
+    draw_order = {}
+    for row_idx, row in enumerate(parsed_pixels):
+        for col_idx, color in enumerate(row):
+            if color != WHITESPACE:
+                draw_order[(row_idx, col_idx)] = len(draw_order)
+    pixels_per_frame = max(1, PIXELS_PER_SECOND // FRAMES_PER_SECOND)
+    cycle = []
+    for erasing in (False, True):
+        for drawn in range(pixels_per_frame, len(draw_order) + pixels_per_frame, pixels_per_frame):
+            cycle.append(render_frame(parsed_pixels, draw_order, drawn, erasing))
+    return cycle
+
+
+def render_frame(parsed_pixels, draw_order, drawn, erasing):
+    """
+    Renders a frame where the first drawn pixels are shown (or, when erasing, hidden),
+    with a single color code for every run of same colored pixels
+    """
+    frame = []
+    for row_idx, row in enumerate(parsed_pixels):
+        runs = []
+        for col_idx, color in enumerate(row):
+            order = draw_order.get((row_idx, col_idx))
+            if order is None or (order < drawn) == erasing:
+                color = WHITESPACE
+            if runs and runs[-1][0] == color:
+                runs[-1][1] += 1
+            else:
+                runs.append([color, 1])
+        for color, count in runs:
+            frame.append("\033[0m" if color == WHITESPACE else rgb_to_ansi(*color_map[color]))
+            frame.append("  " * count)
+        frame.append("\033[0m\n")
+    return ''.join(frame)
+
 
 # teapot pixel data entered manually as a 2D array
 pixels_raw = [
@@ -108,17 +134,30 @@ pixels_raw = [
     ['w9', 'g8', 'w7']
 ]
 
+
 def start():
-    global stop_print, clear
-    global line_idx, inline_idx
-    stop_print = False
-    clear = False
-    line_idx = 0
-    inline_idx = 0
-    while not stop_print:
-        step()
-        time.sleep(0.01)
+    """
+    Shows the animation at a fixed frame rate until stopped, writing each frame
+    with a single write
+    """
+    global generation
+    if not enabled:
+        return
+    init()
+    generation += 1
+    own_generation = generation
+    stop_event.clear()
+    frame_idx = 0
+    next_frame = time.monotonic()
+    # frames after the first move the cursor back up to redraw in place
+    redraw = ''
+    while not stop_event.is_set() and own_generation == generation:
+        sys.stdout.write(redraw + frames[frame_idx])
+        sys.stdout.flush()
+        redraw = f'\033[{lines}F'
+        frame_idx = (frame_idx + 1) % len(frames)
+        next_frame += 1 / FRAMES_PER_SECOND
+        stop_event.wait(max(0.0, next_frame - time.monotonic()))
 
 def stop():
-    global stop_print
-    stop_print = True
+    stop_event.set()
@@ -0,0 +1,153 @@
+import socket
+import time
+
+import logger
+from protocol import PAYLOAD_HEADER, ProtocolError, pack_ready, pack_report, unpack_payload_header
+from stats import ProtocolCounters
+from udp_receiver import UdpReceiver
+from udp_sender import negotiate_payload_size
+from udp_tracker import SegmentTracker
+
+# an upload ends once no segment arrived for this many seconds
+UPLOAD_INACTIVITY_TIMEOUT = 1.0
+# seconds the client has to start uploading after the ready message
+UPLOAD_START_TIMEOUT = 3.0
+# the ready and report messages are sent a few times, in case some are lost
+CONTROL_MESSAGE_REPEATS = 3
+
+
+class UdpUpload:
+    """
+    Receives the segments a client uploads on a socket of its own, in batches into the
+    preallocated slots of a UdpReceiver, and tracks them in a segment bitmap, just like the
+    client receives downloads.
+    The ready message tells the client which port to upload to and the payload size of the
+    segments, and the final report tells it how much payload arrived and how fast.
+    The socket is connected to the client, so no other host can inject segments, and a
+    segment whose header does not match the admitted size is dropped - a forged header
+    never sizes the bitmap
+    """
+    __sock: socket.socket
+    __address: tuple[str, int]
+    __file_size: int
+    __payload_size: int
+    __segments_amount: int
+    __receiver: UdpReceiver
+    __counters: ProtocolCounters
+    __start_ns: int
+    __last_ns: int
+    __last_receive: float
+    tracker: SegmentTracker | None
+    datagrams: int
+    invalid_datagrams: int
+    bytes_received: int
+
+    def __init__(self, sock: socket.socket, address: tuple[str, int], file_size: int, max_payload_size: int,
+                 counters: ProtocolCounters):
+        self.__sock = sock
+        self.__address = address
+        self.__file_size = file_size
+        self.__counters = counters
+        self.__payload_size = negotiate_payload_size(address, max_payload_size)
+        self.__segments_amount = -(-file_size // self.__payload_size)
+        # only the client's own datagrams arrive on a connected socket
+        sock.connect(address)
+        # the receiver makes the socket blocking; its reads never block by themselves
+        self.__receiver = UdpReceiver(sock, PAYLOAD_HEADER.size + self.__payload_size)
+        self.tracker = SegmentTracker(0) if file_size == 0 else None
+        self.datagrams = 0
+        self.invalid_datagrams = 0
+        self.bytes_received = 0
+        self.__start_ns = self.__last_ns = time.perf_counter_ns()
+        self.__last_receive = time.monotonic()
+        self.__counters.transfers_started += 1
+
+    def start(self) -> None:
+        """
+        Sends the ready message, from which the receive rate is measured
+        """
+        port: int = self.__sock.getsockname()[1]
+        if logger.enabled(logger.DEBUG):
+            logger.debugging(f'Receiving {self.__file_size} bytes from client {self.__address} over UDP '
+                             f'on port {port}...')
+        self.__start_ns = self.__last_ns = time.perf_counter_ns()
+        self.__last_receive = time.monotonic()
+        self.__send_control_message(pack_ready(port, self.__payload_size))
+
+    def receive(self, timeout: float) -> int:
+        """
+        Waits up to timeout seconds for segments, then receives a batch of them.
+        Returns the amount of datagrams received
+        """
+        received: int = self.__receiver.receive(timeout)
+        if received == 0:
+            return 0
+        self.__last_ns = time.perf_counter_ns()
+        self.__last_receive = time.monotonic()
+        bytes_received: int = self.bytes_received
+        for slot in range(received):
+            message_len: int = self.__receiver.lengths[slot]
+            if message_len < PAYLOAD_HEADER.size:
+                logger.error(f'Error: received a truncated segment from UDP client {self.__address}')
+                continue
+            try:
+                segments_amount, segment, _ = unpack_payload_header(self.__receiver.view,
+                                                                    slot * self.__receiver.slot_size)
+            except ProtocolError as e:
+                logger.error(f'Error: received an invalid segment from UDP client {self.__address}: {e}')
+                continue
+            if segments_amount != self.__segments_amount or segment >= self.__segments_amount:
+                # counted, and reported once the upload is over
+                self.invalid_datagrams += 1
+                continue
+            if self.tracker is None:
+                self.tracker = SegmentTracker(self.__segments_amount)
+            self.datagrams += 1
+            if self.tracker.record(segment):
+                self.bytes_received += message_len - PAYLOAD_HEADER.size
+        self.__counters.datagrams_received += received
+        self.__counters.bytes_received += self.bytes_received - bytes_received
+        return received
+
+    def finished(self) -> bool:
+        """
+        Returns whether every segment arrived, or the client stopped sending
+        """
+        if self.tracker is not None and self.tracker.complete():
+            return True
+        timeout: float = UPLOAD_START_TIMEOUT if self.tracker is None else UPLOAD_INACTIVITY_TIMEOUT
+        return time.monotonic() - self.__last_receive >= timeout
+
+    def receive_all(self) -> None:
+        """
+        Receives the whole upload over a blocking socket
+        """
+        while not self.finished():
+            self.receive(UPLOAD_INACTIVITY_TIMEOUT)
+
+    def finish(self) -> float:
+        """
+        Sends the report to the client.
+        Returns the duration of the upload in seconds
+        """
+        duration_ns: int = self.__last_ns - self.__start_ns
+        self.__send_control_message(pack_report(self.datagrams, self.bytes_received, duration_ns))
+        duration: float = duration_ns / 1e9
+        self.__counters.finish_transfer(duration)
+        if self.invalid_datagrams > 0:
+            self.__counters.invalid_requests += self.invalid_datagrams
+            logger.error(f'Error: dropped {self.invalid_datagrams} segments from UDP client {self.__address} '
+                         f'which did not match its upload of {self.__segments_amount} segments')
+        if logger.enabled(logger.DEBUG):
+            segments: str = '0' if self.tracker is None else f'{self.tracker.received}/{self.tracker.segments_amount}'
+            logger.debugging(f'Finished receiving data in UDP connection {self.__address}: {self.bytes_received} '
+                             f'bytes in {segments} segments, {self.datagrams} datagrams')
+        return duration
+
+    def __send_control_message(self, message: bytes) -> None:
+        for _ in range(CONTROL_MESSAGE_REPEATS):
+            try:
+                self.__sock.send(message)
+            except OSError as e:
+                logger.error(f'Error: failed to send a message to UDP client {self.__address}: {e}')
+                return
@@ -0,0 +1,114 @@
+import queue
+import threading
+from typing import Callable
+
+import logger
+
+DEFAULT_POOL_SIZE = 64
+DEFAULT_QUEUE_SIZE = 128
+
+
+class WorkerPool:
+    """
+    A fixed amount of worker threads, running the tasks of a bounded queue in order.
+    A task submitted while the queue is full is refused right away instead of waiting,
+    so the caller can reject the client which sent it.
+    A task may start a helper thread for work which must run alongside it, e.g. the second
+    half of a bidirectional transfer. Helpers are outside the pool - there are up to as many
+    of them as workers - and are counted in the snapshots
+    """
+    __workers: list[threading.Thread]
+    __tasks: queue.Queue
+    __lock: threading.Lock
+    __busy: int
+    __helpers: int
+    __peak_queue_depth: int
+    __started: bool
+    __closed: bool
+    size: int
+    queue_size: int
+
+    def __init__(self, size: int = DEFAULT_POOL_SIZE, queue_size: int = DEFAULT_QUEUE_SIZE):
+        self.size = size
+        self.queue_size = queue_size
+        self.__tasks = queue.Queue(queue_size)
+        self.__lock = threading.Lock()
+        self.__busy = 0
+        self.__helpers = 0
+        self.__peak_queue_depth = 0
+        self.__started = False
+        self.__closed = False
+        self.__workers = [threading.Thread(target=self.__work, name=f'worker-{idx}') for idx in range(size)]
+
+    def start(self) -> None:
+        self.__started = True
+        for worker in self.__workers:
+            worker.start()
+
+    def submit(self, task: Callable, *args) -> bool:
+        """
+        Queues a task for the next free worker.
+        Returns False if the queue is full, or the pool is shut down
+        """
+        if self.__closed:
+            return False
+        try:
+            self.__tasks.put_nowait((task, args))
+        except queue.Full:
+            return False
+        with self.__lock:
+            self.__peak_queue_depth = max(self.__peak_queue_depth, self.__tasks.qsize())
+        return True
+
+    def run_helper(self, task: Callable, *args) -> threading.Thread:
+        """
+        Runs a task on a helper thread, next to the worker which calls this.
+        Returns the started thread, which the worker must join
+        """
+        helper: threading.Thread = threading.Thread(target=self.__help, args=(task, args))
+        with self.__lock:
+            self.__helpers += 1
+        helper.start()
+        return helper
+
+    def shutdown(self) -> None:
+        """
+        Refuses further tasks. The workers finish the queued tasks, and then exit
+        """
+        self.__closed = True
+        if not self.__started:
+            return
+        for _ in self.__workers:
+            # blocks while the queue is full, until the workers make room
+            self.__tasks.put((None, ()))
+
+    def join(self) -> None:
+        for worker in self.__workers:
+            worker.join()
+
+    def snapshot(self) -> dict:
+        return {'workers': self.size, 'busy_workers': self.__busy, 'helper_threads': self.__helpers,
+                'queue_size': self.queue_size,
+                'queue_depth': self.__tasks.qsize(), 'peak_queue_depth': self.__peak_queue_depth}
+
+    def __work(self) -> None:
+        while True:
+            task, args = self.__tasks.get()
+            if task is None:
+                return
+            with self.__lock:
+                self.__busy += 1
+            try:
+                task(*args)
+            except Exception as e:
+                logger.error(f'Error: a worker task failed: {e}')
+            finally:
+                with self.__lock:
+                    self.__busy -= 1
+
+    def __help(self, task: Callable, args: tuple) -> None:
+        try:
+            task(*args)
+        finally:
+            with self.__lock:
+                self.__helpers -= 1
@@ -0,0 +1,45 @@
+import os
+import socket
+import sys
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src', 'common'))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src', 'client'))
+
+import protocol
+from client import Client
+
+
+def serve_once(reply: bytes) -> int:
+    """
+    Answers the first TCP request line with the given reply, and closes the connection.
+    Returns the port it listens on
+    """
+    listen_sock: socket.socket = socket.create_server(('127.0.0.1', 0))
+
+    def serve() -> None:
+        with listen_sock:
+            client_sock, _ = listen_sock.accept()
+            with client_sock:
+                request: bytes = b''
+                while not request.endswith(b'\n'):
+                    request += client_sock.recv(64)
+                client_sock.sendall(reply)
+
+    threading.Thread(target=serve, daemon=True).start()
+    return listen_sock.getsockname()[1]
+
+
+def test_download_shorter_than_reject_message_succeeds():
+    port: int = serve_once(b'abc')
+    assert Client(0, 3, 1, 0).tcp_connect('127.0.0.1', port, 1)
+
+
+def test_reject_message_in_place_of_short_download_is_a_rejection():
+    port: int = serve_once(protocol.pack_reject(protocol.REJECT_BUSY))
+    assert not Client(0, 3, 1, 0).tcp_connect('127.0.0.1', port, 1)
+
+
+def test_short_download_closed_early_fails():
+    port: int = serve_once(b'ab')
+    assert not Client(0, 3, 1, 0).tcp_connect('127.0.0.1', port, 1)